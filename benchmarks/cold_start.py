@@ -0,0 +1,59 @@
+"""Measure API cold-start time.
+
+Each run starts a fresh interpreter, imports the app and serves a first
+request, as a serverless instance does on a cold start. Reports the import
+time, the first /hello and the first /cache_stats, and which heavy packages
+had been loaded by then.
+
+    python benchmarks/cold_start.py [runs]
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+HEAVY = ["billboard", "bs4", "databases", "httpx", "spotipy", "sqlalchemy"]
+
+SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+from fastapi.testclient import TestClient
+from trainingsong.server.api import app
+imported = time.perf_counter()
+client = TestClient(app)
+client.get("/hello")
+hello = time.perf_counter()
+client.get("/cache_stats")
+stats = time.perf_counter()
+print(json.dumps({{
+    "import_ms": 1000 * (imported - start),
+    "hello_ms": 1000 * (hello - imported),
+    "cache_stats_ms": 1000 * (stats - hello),
+    "loaded": [m for m in {HEAVY!r} if m in sys.modules],
+}}))
+"""
+
+
+def run_once():
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=ROOT,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(runs=5):
+    results = [run_once() for _ in range(runs)]
+    for key in ("import_ms", "hello_ms", "cache_stats_ms"):
+        print(f"{key:15} {statistics.median(r[key] for r in results):8.1f} ms (median)")
+    print("heavy packages loaded:", ", ".join(results[-1]["loaded"]) or "none")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
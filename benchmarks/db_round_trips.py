@@ -0,0 +1,91 @@
+"""Count database round trips per API request.
+
+Replays the statements the token lookups in /email_in_db and
+create_spotify_client issue for one request against a throwaway SQLite
+database, and counts statements and pool checkouts.
+
+    python benchmarks/db_round_trips.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from trainingsong.server import db  # noqa: E402
+
+EMAIL = "bench@example.com"
+
+
+def legacy_request(engine):
+    """The pre-pooling request: each endpoint opened an ORM session around
+    get_tokens and ran an extra SELECT ... LIMIT 5 when the session closed,
+    with no token cache."""
+    for _endpoint in ("/email_in_db", "create_spotify_client"):
+        with engine.connect() as connection:
+            connection.execute(db.tokens.select().where(db.tokens.c.email == EMAIL))
+        with engine.connect() as connection:
+            connection.execute(db.tokens.select().limit(5))
+
+
+def current_request(_engine):
+    for _endpoint in ("/email_in_db", "create_spotify_client"):
+        db.get_tokens(EMAIL)
+
+
+def measure(engine, request, runs=100):
+    counts = {"statements": 0, "checkouts": 0}
+
+    def count_statement(*_args):
+        counts["statements"] += 1
+
+    def count_checkout(*_args):
+        counts["checkouts"] += 1
+
+    event.listen(engine, "before_cursor_execute", count_statement)
+    event.listen(engine.pool, "checkout", count_checkout)
+    start = time.perf_counter()
+    for _ in range(runs):
+        request(engine)
+    elapsed = time.perf_counter() - start
+    event.remove(engine, "before_cursor_execute", count_statement)
+    event.remove(engine.pool, "checkout", count_checkout)
+
+    return {
+        "statements_per_request": counts["statements"] / runs,
+        "checkouts_per_request": counts["checkouts"] / runs,
+        "ms_per_request": 1000 * elapsed / runs,
+    }
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(
+            f"sqlite:///{tmp}/bench.db",
+            future=True,
+            **db._engine_options("sqlite://"),
+        )
+        db._engine = engine
+        db.metadata.create_all(engine)
+        db.store_tokens(EMAIL, "access", "refresh", int(time.time()) + 3600)
+
+        db.TOKEN_CACHE.clear()
+        results = {"before": measure(engine, legacy_request)}
+        db.TOKEN_CACHE.clear()
+        results["after (cold cache)"] = measure(engine, current_request, runs=1)
+        results["after (warm cache)"] = measure(engine, current_request)
+
+    for name, result in results.items():
+        print(
+            f"{name:20} {result['statements_per_request']:4.1f} statements "
+            f"{result['checkouts_per_request']:4.1f} connections "
+            f"{result['ms_per_request']:7.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""Microbenchmarks for the song resolution hot path.
+
+Runs offline: Billboard and the Spotify Web API are stubbed, and tokens live
+in a throwaway SQLite database. Each case reports per-call times in
+microseconds, and the results are written as JSON so runs from different
+commits can be compared.
+
+    python benchmarks/microbench.py [--output results.json] [--compare old.json]
+
+"cold" cases clear the relevant in-process cache before every call, so they
+time the stubbed upstream path plus the cache bookkeeping; "warm" cases are
+served from the cache.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# pylint: disable=wrong-import-position
+import httpx  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+
+from trainingsong import db_utils  # noqa: E402
+from trainingsong.server import (  # noqa: E402
+    billboard_io,
+    db,
+    ratelimit,
+    resolve,
+    spotify,
+)
+from trainingsong.server.api import app  # noqa: E402
+from trainingsong.server.chart_index import Song  # noqa: E402
+from trainingsong.server.hard_coded import hard_coded_song  # noqa: E402
+from trainingsong.server.logs import ROOT_LOGGER  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+EMAIL = "bench@example.com"
+SONG = Song(artist="Elton John", weeks=2, title="Lucy In The Sky With Diamonds")
+TRACK = {
+    "external_urls": {"spotify": "https://open.spotify.com/track/1"},
+    "name": SONG.title,
+    "uri": "spotify:track:1",
+}
+
+
+def _spotify_handler(request: httpx.Request) -> httpx.Response:
+    "Stub Spotify Web API"
+    if request.url.path.endswith("/search"):
+        return httpx.Response(200, json={"tracks": {"items": [TRACK]}})
+    if request.url.path.endswith("/devices"):
+        return httpx.Response(200, json={"devices": [{"id": "1"}]})
+    return httpx.Response(204)
+
+
+async def _fetch_chart(_chart, _target_date):
+    "Stub billboard.com"
+    return [SONG]
+
+
+def timeit(func, min_time=0.2, repeat=5):
+    "Per-call times in microseconds for each of repeat batches"
+    func()  # warm up
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / repeat or number >= 1 << 20:
+            break
+        number *= 2
+
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    times = [1e6 * t for t in times]
+    return {
+        "median_us": statistics.median(times),
+        "min_us": min(times),
+        "max_us": max(times),
+        "calls": number * repeat,
+    }
+
+
+def cases(client):
+    date = datetime.date(1975, 10, 19)
+    token = db_utils.encrypt("access")
+
+    def cold(cache, func):
+        def run():
+            cache.clear()
+            func()
+
+        return run
+
+    def get_root():
+        response = client.get("/", params={"email": EMAIL, "p": 75, "autoplay": True})
+        assert response.status_code == 200, response.text
+
+    def get_root_cold():
+        for cache in (billboard_io.CHART_CACHE, spotify.TRACK_CACHE, db.TOKEN_CACHE):
+            cache.clear()
+        get_root()
+
+    return {
+        "percentage_to_date": lambda: resolve.percentage_to_date(75.8),
+        "chart_week": lambda: resolve.chart_week(date),
+        "hard_coded_song": lambda: hard_coded_song(22, "hot-100"),
+        "encrypt": lambda: db_utils.encrypt("access"),
+        "decrypt": lambda: db_utils.decrypt(token),
+        "get_billboard_data (cold)": cold(
+            billboard_io.CHART_CACHE, lambda: billboard_io.get_billboard_data(75.8)
+        ),
+        "get_billboard_data (warm)": lambda: billboard_io.get_billboard_data(75.8),
+        "get_tokens (cold)": cold(db.TOKEN_CACHE, lambda: db.get_tokens(EMAIL)),
+        "get_tokens (warm)": lambda: db.get_tokens(EMAIL),
+        "GET / (cold)": get_root_cold,
+        "GET / (warm)": get_root,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(__file__) or ".",
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(min_time):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp, contextlib.ExitStack() as stack:
+        engine = create_engine(f"sqlite:///{tmp}/bench.db", future=True)
+        db.metadata.create_all(engine)
+        stack.enter_context(patch.object(db, "_engine", engine))
+        # Keep the *_async token functions on the SQLite engine
+        stack.enter_context(patch.object(db, "_connect_retry_at", float("inf")))
+        stack.enter_context(patch.object(billboard_io, "load_index", lambda _c: None))
+        stack.enter_context(
+            patch("billboard.ChartData", lambda *_a, **_k: [SONG]),
+        )
+        stack.enter_context(patch.object(billboard_io, "fetch_chart", _fetch_chart))
+        http_client = httpx.AsyncClient(transport=httpx.MockTransport(_spotify_handler))
+        stack.enter_context(
+            patch.object(spotify, "get_http_client", lambda: http_client)
+        )
+        # Time the request path, not the upstream rate limits it would queue on
+        for limiter in ratelimit.LIMITERS.values():
+            stack.enter_context(patch.object(limiter, "rate", 1e9))
+            stack.enter_context(patch.object(limiter, "burst", 10**9))
+            stack.enter_context(patch.object(limiter, "_tokens", float(10**9)))
+        # The routes log every request
+        logging.getLogger(ROOT_LOGGER).setLevel(logging.WARNING)
+
+        db.store_tokens(EMAIL, "access", "refresh", int(time.time()) + 3600)
+        client = TestClient(app)
+        for name, func in cases(client).items():
+            results[name] = timeit(func, min_time=min_time)
+    return results
+
+
+def compare(results, baseline):
+    print(f"\n{'case':28} {'baseline':>12} {'now':>12} {'ratio':>7}")
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            continue
+        ratio = result["median_us"] / old["median_us"]
+        print(
+            f"{name:28} {old['median_us']:10.2f}us {result['median_us']:10.2f}us"
+            f" {ratio:6.2f}x"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="JSON file, default results/<commit>.json")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    parser.add_argument(
+        "--min-time", type=float, default=0.2, help="seconds spent per case"
+    )
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = run(args.min_time)
+    for name, result in results.items():
+        print(f"{name:28} {result['median_us']:10.2f} us (median)")
+
+    report = {
+        "commit": commit,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
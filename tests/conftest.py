@@ -0,0 +1,44 @@
+import pytest
+
+from trainingsong.server.billboard_io import CHART_CACHE
+from trainingsong.server.db import TOKEN_CACHE
+from trainingsong.server.spotify import TRACK_CACHE
+
+CACHES = (CHART_CACHE, TRACK_CACHE, TOKEN_CACHE)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    "Keep in-process caches from leaking results between tests"
+    for cache in CACHES:
+        cache.clear()
+    yield
+    for cache in CACHES:
+        cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def track_table(monkeypatch):
+    "Keep TRACK_CACHE off the default database; tests that want it use their own"
+    monkeypatch.setattr(TRACK_CACHE.backend, "_exists", False)
+
+
+@pytest.fixture(autouse=True)
+def response_cache_dir(tmp_path, monkeypatch):
+    "Give each test its own client response cache"
+    from trainingsong import response_cache
+
+    response_cache.close()
+    monkeypatch.setattr(response_cache, "CACHE_DIR", tmp_path / "response-cache")
+    yield response_cache.CACHE_DIR
+    response_cache.close()
+
+
+@pytest.fixture(autouse=True)
+def sweep_dir(tmp_path, monkeypatch):
+    "Keep sweeps out of the user cache dir and out of the environment"
+    from trainingsong import sweep
+
+    monkeypatch.setattr(sweep, "SWEEP_DIR", tmp_path / "sweeps")
+    monkeypatch.delenv(sweep.SWEEP_ENV, raising=False)
+    return sweep.SWEEP_DIR
@@ -1,6 +1,15 @@
+import asyncio
+import subprocess
+import sys
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 
+from trainingsong.server import api
 from trainingsong.server.api import app
+from trainingsong.server.resolve import StateData
 
 client = TestClient(app)
 
@@ -9,3 +18,231 @@ def test_hello():
     response = client.get("/hello")
     assert response.status_code == 200
     assert response.json() == {"hello": "world"}
+
+
+@patch("trainingsong.server.spotify.create_spotify_client")
+def test_root(mock_create_spotify_client):
+    sp = AsyncMock()
+    sp.search.return_value = {
+        "tracks": {
+            "items": [
+                {
+                    "external_urls": {"spotify": "https://open.spotify.com/track/1"},
+                    "name": "22",
+                    "uri": "spotify:track:1",
+                }
+            ]
+        }
+    }
+    sp.devices.return_value = {"devices": [{"id": "1"}]}
+    mock_create_spotify_client.return_value = sp
+
+    response = client.get(
+        "/", params={"email": "user@example.com", "p": 22, "autoplay": True}
+    )
+
+    assert response.status_code == 200
+    assert response.json()["spotify_link"] == "https://open.spotify.com/track/1"
+    assert response.json()["errors"] == ""
+    sp.start_playback.assert_awaited_once_with(device_id=None, uris=["spotify:track:1"])
+
+    timing = response.headers["Server-Timing"]
+    for stage in ("spotify_search", "devices", "playback", "total"):
+        assert f"{stage};dur=" in timing
+
+    exposition = client.get("/metrics").text
+    assert 'trainingsong_stage_seconds_count{stage="spotify_search"}' in exposition
+    assert 'trainingsong_request_seconds_count{route="/",status="200"}' in exposition
+    assert 'trainingsong_cache_hit_ratio{cache="track_cache"}' in exposition
+
+
+def test_hello_cold_start_skips_heavy_imports():
+    # Serverless cold starts only pay for what the first route needs
+    statement = (
+        "import sys\n"
+        "from fastapi.testclient import TestClient\n"
+        "from trainingsong.server.api import app\n"
+        "assert TestClient(app).get('/hello').status_code == 200\n"
+        "print(sorted(m for m in ('billboard', 'bs4', 'databases', 'spotipy',"
+        " 'sqlalchemy', 'cryptography') if m in sys.modules))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", statement], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
+
+
+def _spotify_stub(delay=0.0):
+    async def search(**_kwargs):
+        await asyncio.sleep(delay)
+        return {
+            "tracks": {
+                "items": [
+                    {
+                        "external_urls": {
+                            "spotify": "https://open.spotify.com/track/1"
+                        },
+                        "name": "Island Girl",
+                        "uri": "spotify:track:1",
+                    }
+                ]
+            }
+        }
+
+    async def devices():
+        await asyncio.sleep(delay)
+        return {"devices": [{"id": "1"}]}
+
+    sp = AsyncMock()
+    sp.search.side_effect = search
+    sp.devices.side_effect = devices
+    return sp
+
+
+@patch("trainingsong.server.spotify.create_spotify_client")
+@patch("trainingsong.server.billboard_io.get_billboard_data_async")
+def test_root_runs_independent_stages_concurrently(mock_billboard, mock_client):
+    sp = _spotify_stub(delay=0.2)
+
+    async def billboard(p, chart):
+        await asyncio.sleep(0.2)
+        return StateData("Island Girl", "Elton John", None, "", "", p, chart)
+
+    async def spotify_client(*_args):
+        await asyncio.sleep(0.2)
+        return sp
+
+    mock_billboard.side_effect = billboard
+    mock_client.side_effect = spotify_client
+
+    start = time.perf_counter()
+    response = client.get(
+        "/", params={"email": "user@example.com", "p": 75, "autoplay": True}
+    )
+    elapsed = time.perf_counter() - start
+
+    assert response.status_code == 200
+    assert response.json()["spotify_link"] == "https://open.spotify.com/track/1"
+    # Two pairs of 0.2s stages, rather than four stages in a row
+    assert elapsed < 0.7
+
+
+@patch.dict(api.STAGE_TIMEOUTS, {"spotify_search": 0.05})
+@patch("trainingsong.server.spotify.create_spotify_client")
+def test_root_stage_timeout_cancels_other_stages(mock_client):
+    sp = _spotify_stub(delay=1)
+    mock_client.return_value = sp
+
+    start = time.perf_counter()
+    response = client.get(
+        "/", params={"email": "user@example.com", "p": 22, "autoplay": True}
+    )
+
+    assert response.status_code == 504
+    assert response.json()["detail"] == "spotify_search timed out"
+    # The device listing was cancelled rather than waited for
+    assert time.perf_counter() - start < 0.5
+    sp.start_playback.assert_not_awaited()
+
+
+@patch("trainingsong.server.spotify.store_tokens_async")
+@patch("trainingsong.server.spotify.get_tokens_async", return_value=None)
+@patch("trainingsong.server.spotify._spotify_oauth")
+@patch("trainingsong.server.billboard_io.get_billboard_data_async")
+def test_first_request_stores_tokens_when_the_chart_is_missing(
+    mock_billboard, mock_oauth, _mock_get_tokens, mock_store_tokens
+):
+    def get_access_token(code):
+        # The code is used up as soon as Spotify sees it
+        time.sleep(0.2)
+        return {"access_token": "a", "refresh_token": "r", "expires_at": 1}
+
+    mock_oauth.return_value = MagicMock(get_access_token=get_access_token)
+    mock_billboard.side_effect = HTTPException(status_code=404, detail="No chart")
+
+    with TestClient(app) as test_client:
+        response = test_client.get(
+            "/",
+            params={"email": "new@example.com", "p": 75, "spotify_client_code": "c"},
+        )
+        assert response.status_code == 404
+
+        # The exchange outlives the failed request, so the tokens are kept
+        deadline = time.monotonic() + 2
+        while not mock_store_tokens.await_count and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+    mock_store_tokens.assert_awaited_once_with("new@example.com", "a", "r", 1)
+
+
+def test_root_rejects_remote_redirect_uri():
+    response = client.get(
+        "/",
+        params={
+            "email": "user@example.com",
+            "p": 22,
+            "spotify_client_code": "code",
+            "redirect_uri": "https://example.com/local_callback",
+        },
+    )
+    assert response.status_code == 400
+
+
+@patch("trainingsong.server.spotify.create_spotify_client")
+def test_live_sends_a_song_only_when_the_bucket_changes(mock_client):
+    sp = _spotify_stub()
+    sp.expires_at = time.time() + 3600
+    mock_client.return_value = sp
+
+    with client.websocket_connect("/live?email=user@example.com") as websocket:
+        websocket.send_json({"p": 22})
+        first = websocket.receive_json()
+        # The same hard-coded song, then a new one
+        for p in (22.3, 0.227, 24):
+            websocket.send_json({"p": p})
+        second = websocket.receive_json()
+        websocket.send_text("not json")
+        error = websocket.receive_json()
+
+    assert (first["song_name"], second["song_name"]) == ("22", "24K Magic")
+    assert error == {"errors": 'Send updates as {"p": <metric>}'}
+    # One client for the session and one search per song
+    assert mock_client.await_count == 1
+    assert sp.search.await_count == 2
+
+
+@patch("trainingsong.server.spotify.create_spotify_client")
+def test_live_recreates_client_when_token_expires(mock_client):
+    sp = _spotify_stub()
+    sp.expires_at = time.time() + 10
+    mock_client.return_value = sp
+
+    with client.websocket_connect("/live?email=user@example.com") as websocket:
+        for p in (22, 24):
+            websocket.send_json({"p": p})
+            websocket.receive_json()
+
+    assert mock_client.await_count == 2
+
+
+@patch("trainingsong.server.spotify.create_spotify_client")
+def test_live_reports_spotify_errors_and_carries_on(mock_client):
+    from trainingsong.server.spotify import SpotifyError
+
+    revoked = AsyncMock(expires_at=time.time() + 3600)
+    revoked.search.side_effect = SpotifyError(401, "The access token expired")
+    sp = _spotify_stub()
+    sp.expires_at = time.time() + 3600
+    mock_client.side_effect = [revoked, sp]
+
+    with client.websocket_connect("/live?email=user@example.com") as websocket:
+        websocket.send_json({"p": 22})
+        error = websocket.receive_json()
+        websocket.send_json({"p": 22})
+        song = websocket.receive_json()
+
+    assert error["percentage"] == 22
+    assert "access token expired" in error["errors"]
+    # The session stayed open, with a new client for the failed token
+    assert song["song_name"] == "22"
+    assert mock_client.await_count == 2
@@ -1,9 +1,12 @@
+import asyncio
 import datetime
+from pathlib import Path
 
 from unittest.mock import patch
 import pytest
 
 from trainingsong.server.billboard_io import (
+    _parse_chart_page,
     get_billboard_data,
     get_number_one_song,
     Song,
@@ -55,3 +58,44 @@ def test_get_number_one_song(
     mock_billboard_ChartData.return_value = chart_output, expected_target_date
     result = get_number_one_song(percentage=percentage)
     assert result[1] == expected_target_date
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_for_a_chart_week_share_one_fetch():
+    from trainingsong.server.billboard_io import get_number_one_song_async
+
+    song = Song(artist="Elton John", weeks=2, title="Island Girl")
+    calls = []
+
+    async def fetch_chart(chart, target_date):
+        calls.append((chart, target_date))
+        await asyncio.sleep(0.05)
+        return [song]
+
+    with patch("trainingsong.server.billboard_io.fetch_chart", fetch_chart), patch(
+        "trainingsong.server.billboard_io.load_index", return_value=None
+    ):
+        # 75.8% and 75.81% fall in the same chart week
+        results = await asyncio.gather(
+            *(get_number_one_song_async(p) for p in [75.8] * 5 + [75.81] * 5)
+        )
+
+    assert [result[0] for result in results] == [song] * 10
+    # The chart is fetched for the week, whichever date missed first
+    assert calls == [("hot-100", datetime.date(1975, 10, 25))]
+
+
+def test_parse_chart_page_reads_a_recorded_page():
+    import billboard
+
+    page = Path(__file__).parent / "data" / "billboard" / "hot-100" / "1975-10-25.html"
+    chart_data = billboard.ChartData("hot-100", date="1975-10-25", fetch=False)
+    _parse_chart_page(chart_data, page.read_text())
+
+    assert chart_data.date == "1975-10-25"
+    number_one = chart_data[0]
+    assert (number_one.title, number_one.artist, number_one.weeks) == (
+        "Bad Blood",
+        "Neil Sedaka",
+        6,
+    )
@@ -0,0 +1,88 @@
+import datetime
+from unittest.mock import MagicMock, patch
+
+from trainingsong.server.billboard_io import (
+    CHART_CACHE,
+    chart_week,
+    get_number_one_song,
+)
+from trainingsong.server.cache import Expiring, LRUCache
+
+
+def test_lru_eviction_and_stats():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # evicts b, the least recently used
+
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+    assert len(cache) == 2
+
+
+def test_ttl_expiry():
+    cache = LRUCache(ttl=60)
+    with patch("time.monotonic", return_value=0):
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=1000)
+    with patch("time.monotonic", return_value=100):
+        assert cache.get("a") is None
+        assert cache.get("b") == 2
+
+
+def test_backend_read_and_write_through():
+    backend = MagicMock()
+    backend.load.return_value = "stored"
+    cache = LRUCache(backend=backend)
+
+    assert cache.get("a") == "stored"
+    assert cache.get("a") == "stored"
+    backend.load.assert_called_once_with("a")
+    assert cache.stats()["backend_hits"] == 1
+
+    cache.set("b", "new")
+    backend.save.assert_called_once_with("b", "new")
+
+
+def test_backend_values_keep_their_remaining_ttl():
+    backend = MagicMock()
+    backend.load.return_value = Expiring("stored", 10)
+    cache = LRUCache(backend=backend, ttl_for=lambda value: 1000)
+
+    with patch("time.monotonic", return_value=0):
+        assert cache.get("a") == "stored"
+    with patch("time.monotonic", return_value=5):
+        assert cache.get("a") == "stored"
+    with patch("time.monotonic", return_value=20):
+        assert "a" not in cache
+    assert backend.load.call_count == 1
+
+
+def test_backend_errors_are_misses():
+    backend = MagicMock()
+    backend.load.side_effect = RuntimeError("db down")
+    cache = LRUCache(backend=backend)
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_chart_week_rounds_up_to_saturday():
+    assert chart_week(datetime.date(1975, 10, 19)) == datetime.date(1975, 10, 25)
+    assert chart_week(datetime.date(1975, 10, 25)) == datetime.date(1975, 10, 25)
+
+
+@patch("billboard.ChartData")
+def test_same_chart_week_shares_one_fetch(mock_billboard_ChartData):
+    mock_billboard_ChartData.return_value = [MagicMock(title="Bad Blood")]
+
+    # 75.8 and 75.81 both fall in the week of 1975-10-25
+    first, first_date = get_number_one_song(75.8)
+    second, second_date = get_number_one_song(75.81)
+
+    assert first is second
+    assert first_date != second_date
+    mock_billboard_ChartData.assert_called_once_with("hot-100", date="1975-10-25")
+    assert CHART_CACHE.stats()["hits"] == 1
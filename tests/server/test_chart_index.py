@@ -0,0 +1,106 @@
+import datetime
+from unittest.mock import patch
+
+import pytest
+
+from trainingsong.server import billboard_io
+from trainingsong.server.chart_index import (
+    ChartIndex,
+    Song,
+    clear_indexes,
+    load_index,
+    write_index,
+)
+
+WEEKS = [
+    (
+        datetime.date(1975, 10, 11),
+        Song(artist="Bee Gees", weeks=4, title="Jive Talkin'"),
+    ),
+    (
+        datetime.date(1975, 10, 18),
+        Song(artist="Elton John", weeks=10, title="Island Girl"),
+    ),
+    (
+        datetime.date(1975, 10, 25),
+        Song(artist="Neil Sedaka", weeks=7, title="Bad Blood"),
+    ),
+]
+
+
+@pytest.fixture
+def index_dir(tmp_path):
+    # write out of order to check the index sorts its rows
+    write_index(tmp_path / "hot-100.idx", reversed(WEEKS))
+    clear_indexes()
+    yield tmp_path
+    clear_indexes()
+
+
+def test_lookup_exact_and_between_weeks(index_dir):
+    index = ChartIndex(index_dir / "hot-100.idx")
+    assert len(index) == 3
+
+    song, week = index.lookup(datetime.date(1975, 10, 18))
+    assert (song.title, week) == ("Island Girl", datetime.date(1975, 10, 18))
+
+    # dates between chart weeks round up to the next published chart
+    song, week = index.lookup(datetime.date(1975, 10, 19))
+    assert (song.title, song.artist, song.weeks) == ("Bad Blood", "Neil Sedaka", 7)
+    assert week == datetime.date(1975, 10, 25)
+
+    assert index.lookup(datetime.date(1975, 10, 5))[0].title == "Jive Talkin'"
+    # Outside the index, the song could be anything
+    assert index.lookup(datetime.date(1970, 1, 1)) is None
+    assert index.lookup(datetime.date(1975, 10, 26)) is None
+    index.close()
+
+
+def test_lookup_in_a_gap_is_none(tmp_path):
+    write_index(
+        tmp_path / "hot-100.idx",
+        [
+            WEEKS[2],
+            (
+                datetime.date(1990, 1, 6),
+                Song(artist="Phil Collins", weeks=12, title="Another Day in Paradise"),
+            ),
+        ],
+    )
+    index = ChartIndex(tmp_path / "hot-100.idx")
+    assert index.lookup(datetime.date(1982, 6, 1)) is None
+    assert index.lookup(datetime.date(1990, 1, 1))[1] == datetime.date(1990, 1, 6)
+    index.close()
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "bad.idx"
+    path.write_bytes(b"not an index at all")
+    with pytest.raises(ValueError):
+        ChartIndex(path)
+
+
+@patch("billboard.ChartData")
+def test_get_number_one_song_uses_index(mock_billboard_ChartData, index_dir):
+    with patch.object(
+        billboard_io, "load_index", lambda chart: load_index(chart, index_dir)
+    ):
+        song, target_date = billboard_io.get_number_one_song(75.8)
+
+    assert target_date == datetime.date(1975, 10, 19)
+    assert song.title == "Bad Blood"
+    mock_billboard_ChartData.assert_not_called()
+
+
+def test_load_index_picks_up_rebuilt_index(tmp_path):
+    clear_indexes()
+    assert load_index("hot-100", tmp_path) is None
+
+    write_index(tmp_path / "hot-100.idx", WEEKS[:1])
+    first = load_index("hot-100", tmp_path)
+    assert len(first) == 1
+    assert load_index("hot-100", tmp_path) is first
+
+    write_index(tmp_path / "hot-100.idx", WEEKS)
+    assert len(load_index("hot-100", tmp_path)) == 3
+    clear_indexes()
@@ -1,7 +1,10 @@
 import os
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from dotenv import load_dotenv
+from sqlalchemy import create_engine
 
 from trainingsong.server import db
 
@@ -65,3 +68,129 @@ def test_tokens():
     with db.database_session():
         result = db.get_tokens(EMAIL)
         assert result is None
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True)
+    db.metadata.create_all(engine)
+    monkeypatch.setattr(db, "_engine", engine)
+    return engine
+
+
+def test_token_cache_write_through(sqlite_engine):
+    EMAIL = "test@example.com"
+    EXPIRES_AT = int(time.time()) + 3600
+
+    db.store_tokens(EMAIL, "access_token", "refresh_token", EXPIRES_AT)
+    with patch.object(db, "decrypt") as mock_decrypt:
+        result = db.get_tokens(EMAIL)
+    mock_decrypt.assert_not_called()
+    assert result["access_token"] == "access_token"
+
+    db.update_tokens(EMAIL, "new_access_token", "new_refresh_token", EXPIRES_AT)
+    assert db.get_tokens(EMAIL)["refresh_token"] == "new_refresh_token"
+    assert db.TOKEN_CACHE.stats()["misses"] == 0
+
+    db.delete_tokens(EMAIL)
+    assert db.get_tokens(EMAIL) is None
+
+
+def test_token_cache_reads_through_once(sqlite_engine):
+    EMAIL = "test@example.com"
+    db.store_tokens(EMAIL, "access_token", "refresh_token", int(time.time()) + 3600)
+    db.TOKEN_CACHE.clear()
+
+    assert db.get_tokens(EMAIL)["access_token"] == "access_token"
+    assert db.get_tokens(EMAIL)["access_token"] == "access_token"
+    assert db.TOKEN_CACHE.stats()["misses"] == 1
+
+
+def test_expired_tokens_are_not_cached(sqlite_engine):
+    EMAIL = "test@example.com"
+    db.store_tokens(EMAIL, "access_token", "refresh_token", int(time.time()) - 1)
+
+    db.get_tokens(EMAIL)
+    assert db.TOKEN_CACHE.stats()["hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_async_tokens_fall_back_to_sync_engine(sqlite_engine):
+    EMAIL = "test@example.com"
+    assert db.database is None
+
+    await db.store_tokens_async(EMAIL, "access", "refresh", int(time.time()) + 60)
+    db.TOKEN_CACHE.clear()
+    assert (await db.get_tokens_async(EMAIL))["access_token"] == "access"
+
+    await db.delete_tokens_async(EMAIL)
+    assert await db.get_tokens_async(EMAIL) is None
+
+
+@pytest.mark.asyncio
+async def test_async_tokens_use_connection_pool(monkeypatch):
+    EMAIL = "test@example.com"
+    database = AsyncMock(is_connected=True)
+    row = MagicMock(
+        _mapping={
+            "email": EMAIL,
+            "access_token": db.encrypt("access"),
+            "refresh_token": db.encrypt("refresh"),
+            "expires_at": int(time.time()) + 60,
+        }
+    )
+    database.fetch_one.return_value = row
+    monkeypatch.setattr(db, "database", database)
+
+    assert (await db.get_tokens_async(EMAIL))["refresh_token"] == "refresh"
+    assert (await db.get_tokens_async(EMAIL))["refresh_token"] == "refresh"
+    database.fetch_one.assert_awaited_once()
+
+    await db.update_tokens_async(EMAIL, "new", "new_refresh", int(time.time()) + 60)
+    database.execute.assert_awaited_once()
+    assert (await db.get_tokens_async(EMAIL))["access_token"] == "new"
+
+
+@pytest.mark.asyncio
+async def test_failed_connect_is_retried_after_a_backoff(monkeypatch):
+    pool = AsyncMock(is_connected=True)
+    pools = MagicMock(side_effect=[OSError("database restarting"), pool])
+    monkeypatch.setattr("databases.Database", pools)
+    monkeypatch.setattr(db, "database", None)
+    monkeypatch.setattr(db, "_connect_failures", 0)
+    monkeypatch.setattr(db, "_connect_retry_at", 0.0)
+
+    assert not await db._async_ready()
+    # Within the backoff the sync engine is used without trying again
+    assert not await db._async_ready()
+    assert pools.call_count == 1
+    assert db._connect_retry_at > time.monotonic()
+
+    monkeypatch.setattr(db, "_connect_retry_at", time.monotonic())
+    assert await db._async_ready()
+    assert db.database is pool
+    assert db._connect_failures == 0
+
+
+def test_store_tokens_upserts(sqlite_engine):
+    EMAIL = "test@example.com"
+    db.store_tokens(EMAIL, "access", "refresh", 1)
+    db.store_tokens(EMAIL, "new_access", "new_refresh", 2)
+    db.TOKEN_CACHE.clear()
+
+    with db.database_session() as connection:
+        result = db.get_tokens(EMAIL, connection=connection)
+    assert result["access_token"] == "new_access"
+    assert result["expires_at"] == 2
+
+
+def test_create_cache_tables_keeps_tokens(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True)
+    db.metadata.create_all(engine, tables=[db.tokens])
+    monkeypatch.setattr(db, "_engine", engine)
+    db.store_tokens("a@example.com", "access", "refresh", 2**40)
+
+    db.main(["create-cache-tables"])
+
+    assert db.has_table("track_cache") and db.has_table("chart_cache")
+    assert db.get_tokens("a@example.com")["refresh_token"] == "refresh"
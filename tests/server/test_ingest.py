@@ -0,0 +1,190 @@
+import datetime
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import create_engine
+
+from trainingsong.server import db
+from trainingsong.server import ingest as ingest_module
+from trainingsong.server.chart_index import ChartIndex, Song
+from trainingsong.server.ingest import (
+    _Ingestion,
+    _number_one,
+    ingest,
+    latest_week,
+    main,
+    recorded_pages,
+)
+
+PAGES = Path(__file__).parent / "data" / "billboard"
+FIRST_WEEK = datetime.date(1975, 10, 25)
+LAST_WEEK = datetime.date(1975, 11, 8)
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True)
+    db.metadata.create_all(engine)
+    monkeypatch.setattr(db, "_engine", engine)
+    return engine
+
+
+def counting(fetch, calls, fail=()):
+    async def wrapper(chart, week):
+        calls.append(week)
+        if week in fail:
+            raise HTTPException(status_code=502, detail="Billboard request failed")
+        return await fetch(chart, week)
+
+    return wrapper
+
+
+@pytest.mark.asyncio
+async def test_ingest_stores_number_ones_from_recorded_pages(sqlite_engine):
+    report = await ingest(
+        "hot-100",
+        # A Monday, which rounds up to the chart week
+        start=datetime.date(1975, 10, 20),
+        end=LAST_WEEK,
+        batch_size=2,
+        fetch=recorded_pages(PAGES),
+    )
+
+    assert (report.fetched, report.stored, report.failed) == (3, 3, [])
+    assert report.checkpoint == LAST_WEEK
+    assert db.get_chart_song("hot-100", FIRST_WEEK)["title"] == "Bad Blood"
+    assert db.get_chart_song("hot-100", LAST_WEEK)["weeks"] == 5
+    assert db.get_ingest_checkpoint("hot-100") == LAST_WEEK
+
+
+@pytest.mark.asyncio
+async def test_ingest_resumes_after_failed_weeks(sqlite_engine):
+    calls = []
+    middle_week = FIRST_WEEK + datetime.timedelta(days=7)
+    report = await ingest(
+        "hot-100",
+        start=FIRST_WEEK,
+        end=LAST_WEEK,
+        fetch=counting(recorded_pages(PAGES), calls, fail=[middle_week]),
+    )
+    assert report.failed == [middle_week]
+    # Later weeks are stored, but the checkpoint stops before the gap
+    assert report.checkpoint == FIRST_WEEK
+
+    calls.clear()
+    report = await ingest(
+        "hot-100",
+        start=FIRST_WEEK,
+        end=LAST_WEEK,
+        fetch=counting(recorded_pages(PAGES), calls),
+    )
+    assert calls == [middle_week]
+    assert report.checkpoint == LAST_WEEK
+
+
+@pytest.mark.asyncio
+async def test_ingest_tops_up_new_weeks(sqlite_engine):
+    calls = []
+    fetch = counting(recorded_pages(PAGES), calls)
+    await ingest("hot-100", start=FIRST_WEEK, end=FIRST_WEEK, fetch=fetch)
+
+    calls.clear()
+    # The week after the recorded pages has no chart yet
+    report = await ingest(
+        "hot-100",
+        start=FIRST_WEEK,
+        end=LAST_WEEK + datetime.timedelta(days=7),
+        fetch=fetch,
+    )
+
+    assert calls == [FIRST_WEEK + datetime.timedelta(days=7 * i) for i in range(1, 4)]
+    assert (report.stored, report.empty) == (2, 1)
+    # The week may just not be published yet, so it's left for the next run
+    assert report.checkpoint == LAST_WEEK
+
+    calls.clear()
+    await ingest(
+        "hot-100",
+        start=FIRST_WEEK,
+        end=LAST_WEEK + datetime.timedelta(days=7),
+        fetch=fetch,
+    )
+    assert calls == [LAST_WEEK + datetime.timedelta(days=7)]
+
+
+def test_only_empty_weeks_before_a_charted_one_are_done():
+    weeks = [FIRST_WEEK + datetime.timedelta(days=7 * i) for i in range(5)]
+    run = _Ingestion("hot-100", weeks, done=set())
+    song = Song(artist="Neil Sedaka", weeks=7, title="Bad Blood")
+    for week, number_one in zip(weeks, [None, song, None, song, None]):
+        run.record(week, number_one)
+
+    # Before the chart starts and in a gap are fine; the last week isn't
+    assert run._advance_checkpoint() == weeks[3]
+
+
+@pytest.mark.asyncio
+async def test_monday_charts_are_their_weeks_number_one():
+    class Page(list):
+        date = "1958-08-11"
+
+    async def fetch(chart, week):
+        return Page(["Poor Little Fool"])
+
+    # Charts until 1962 are dated on Mondays; fetching the Saturday serves the
+    # chart two days later, which is still the week's
+    assert await _number_one(fetch, "hot-100", datetime.date(1958, 8, 9)) == (
+        "Poor Little Fool"
+    )
+    # but billboard.com's nearest chart to a week weeks before isn't
+    assert await _number_one(fetch, "hot-100", datetime.date(1958, 7, 26)) is None
+
+
+def test_ingest_writes_the_chart_index(sqlite_engine, tmp_path):
+    main(
+        [
+            "hot-100",
+            f"--start={FIRST_WEEK}",
+            f"--end={LAST_WEEK}",
+            f"--pages={PAGES}",
+            f"--index={tmp_path / 'hot-100.idx'}",
+        ]
+    )
+
+    index = ChartIndex(tmp_path / "hot-100.idx")
+    assert len(index) == 3
+    song, week = index.lookup(FIRST_WEEK)
+    assert (song.title, week) == ("Bad Blood", FIRST_WEEK)
+    index.close()
+
+
+def test_latest_week_is_a_published_saturday():
+    # Wednesday 2024-05-15: that Saturday's chart may not be out yet
+    assert latest_week(datetime.date(2024, 5, 15)) == datetime.date(2024, 5, 11)
+
+
+def test_ingest_refuses_to_write_a_partial_index(sqlite_engine, tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        ingest_module,
+        "recorded_pages",
+        lambda directory: counting(
+            recorded_pages(directory), calls, fail={datetime.date(1975, 11, 1)}
+        ),
+    )
+    path = tmp_path / "hot-100.idx"
+
+    with pytest.raises(SystemExit) as exc:
+        main(
+            [
+                "hot-100",
+                f"--start={FIRST_WEEK}",
+                f"--end={LAST_WEEK}",
+                f"--pages={PAGES}",
+                f"--index={path}",
+            ]
+        )
+
+    assert exc.value.code != 0
+    assert not path.exists()
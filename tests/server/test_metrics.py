@@ -0,0 +1,47 @@
+import logging
+
+from trainingsong.server import metrics
+from trainingsong.server.logs import LogfmtFormatter
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram("test_seconds", "Test", ("stage",), buckets=(0.1, 1))
+    histogram.observe(0.05, "a")
+    histogram.observe(0.5, "a")
+    histogram.observe(5, "a")
+
+    lines = histogram.render()
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+    assert histogram.count("a") == 3
+
+
+def test_stage_records_timings():
+    with metrics.request_timings() as timings:
+        with metrics.stage("test_stage"):
+            pass
+    assert [name for name, _elapsed in timings] == ["test_stage"]
+    assert metrics.STAGE_SECONDS.count("test_stage") >= 1
+
+    header = metrics.server_timing([("billboard", 0.0123)], 0.05)
+    assert header == "billboard;dur=12.3, total;dur=50.0"
+
+
+def test_upstream_counter():
+    before = metrics.UPSTREAM_REQUESTS.value("test_upstream", "error")
+    metrics.record_upstream("test_upstream", ok=False)
+    assert metrics.UPSTREAM_REQUESTS.value("test_upstream", "error") == before + 1
+    assert 'upstream="test_upstream",outcome="error"' in metrics.render()
+
+
+def test_logfmt_formatter():
+    record = logging.makeLogRecord(
+        {"name": "trainingsong.server.api", "levelname": "INFO", "msg": "song found"}
+    )
+    record.errors = ""
+    record.status = 200
+    line = LogfmtFormatter().format(record)
+    assert 'level=info logger=trainingsong.server.api msg="song found"' in line
+    assert line.endswith('errors="" status=200')
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock
+
+import httpx
+import pytest
+
+from trainingsong.server import metrics, ratelimit
+from trainingsong.server.ratelimit import TokenBucket, retry_after, send
+from trainingsong.server.spotify import SpotifyError, start_playback
+
+
+@pytest.fixture(autouse=True)
+def fresh_limiters(monkeypatch):
+    monkeypatch.setitem(ratelimit.LIMITERS, "test", TokenBucket("test", 100, 2))
+    monkeypatch.setitem(ratelimit.DEADLINES, "test", 1.0)
+    monkeypatch.setattr(ratelimit, "BACKOFF_BASE", 0.01)
+
+
+def responses(*statuses, headers=None):
+    "A request function returning each status in turn"
+    calls = []
+
+    async def request():
+        calls.append(time.monotonic())
+        return httpx.Response(statuses[len(calls) - 1], headers=headers)
+
+    return request, calls
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_queues_past_the_burst():
+    bucket = ratelimit.LIMITERS["test"]
+    start = time.monotonic()
+    waits = await asyncio.gather(*(bucket.acquire() for _ in range(4)))
+
+    # Two go straight away, then one every 10ms
+    assert waits[:2] == [0, 0]
+    assert time.monotonic() - start >= 0.015
+    assert metrics.UPSTREAM_QUEUE_DEPTH.value("test") == 0
+    assert metrics.UPSTREAM_WAIT_SECONDS.count("test") >= 4
+
+
+@pytest.mark.asyncio
+async def test_send_honours_retry_after():
+    request, calls = responses(429, 200, headers={"Retry-After": "0.1"})
+    before = metrics.UPSTREAM_RETRIES.value("test", "throttled")
+
+    response = await send("test", request)
+
+    assert response.status_code == 200
+    assert calls[1] - calls[0] >= 0.1
+    assert metrics.UPSTREAM_RETRIES.value("test", "throttled") == before + 1
+
+
+@pytest.mark.asyncio
+async def test_send_gives_up_at_the_deadline():
+    request, calls = responses(*[503] * 100)
+
+    start = time.monotonic()
+    response = await send("test", request, deadline=0.2)
+
+    assert response.status_code == 503
+    assert 1 < len(calls) < 100
+    assert time.monotonic() - start < 0.3
+
+
+@pytest.mark.asyncio
+async def test_send_does_not_wait_past_the_deadline_for_retry_after():
+    request, calls = responses(429, 200, headers={"Retry-After": "60"})
+
+    response = await send("test", request)
+
+    assert response.status_code == 429
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_send_retries_connection_errors():
+    attempts = []
+
+    async def request():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise httpx.ConnectError("refused")
+        return httpx.Response(200)
+
+    response = await send("test", request)
+    assert response.status_code == 200
+    assert len(attempts) == 3
+
+
+def test_retry_after_parses_dates():
+    response = httpx.Response(
+        429, headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    )
+    assert retry_after(response) == 0
+    assert retry_after(httpx.Response(429)) is None
+
+
+@pytest.mark.asyncio
+async def test_start_playback_raises_on_failure():
+    sp = AsyncMock()
+    sp.start_playback.side_effect = SpotifyError(404, "No active device found")
+    with pytest.raises(ValueError, match="No active device"):
+        await start_playback(sp, "spotify:track:1")
@@ -0,0 +1,118 @@
+import datetime
+import time
+
+import pytest
+from sqlalchemy import create_engine
+
+from trainingsong.server import db
+from trainingsong.server.chart_index import Song, write_index
+from trainingsong.server.resolve_tracks import (
+    TRACK_MAX_AGE,
+    chart_songs,
+    resolve_tracks,
+)
+from trainingsong.server.spotify import TrackTableBackend
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True)
+    db.metadata.create_all(engine)
+    monkeypatch.setattr(db, "_engine", engine)
+    return engine
+
+
+class FakeSpotify:
+    def __init__(self):
+        self.queries = []
+
+    async def search(self, q, **_kwargs):
+        self.queries.append(q)
+        if q.startswith("Unknown"):
+            return {"tracks": {"items": []}}
+        return {
+            "tracks": {
+                "items": [
+                    {
+                        "external_urls": {"spotify": "https://open.spotify.com/k"},
+                        "name": f"{q} (Karaoke Version)",
+                        "uri": "spotify:track:karaoke",
+                    },
+                    {
+                        "external_urls": {"spotify": f"https://open.spotify.com/{q}"},
+                        "name": q,
+                        "uri": f"spotify:track:{q}",
+                    },
+                ]
+            }
+        }
+
+
+def test_chart_songs_include_indexes_and_hard_coded_songs(sqlite_engine, tmp_path):
+    db.store_chart_batch(
+        "hot-100", [(datetime.date(1975, 10, 25), "Bad Blood", "Neil Sedaka", 6)]
+    )
+    write_index(
+        tmp_path / "hot-100.idx",
+        [
+            (
+                datetime.date(1975, 11, 1),
+                Song(artist="Elton John", weeks=4, title="Island Girl"),
+            )
+        ],
+    )
+
+    songs = chart_songs(tmp_path)
+
+    assert {("Bad Blood", "Neil Sedaka"), ("Island Girl", "Elton John")} <= songs
+    assert ("22", "Taylor Swift") in songs
+    assert ("Never Gonna Give You Up", "Rick Astley") in songs
+
+
+@pytest.mark.asyncio
+async def test_resolve_tracks_only_searches_missing_or_stale_songs(sqlite_engine):
+    sp = FakeSpotify()
+    songs = {("Bad Blood", "Neil Sedaka"), ("Unknown Song", "Nobody")}
+
+    report = await resolve_tracks(sp, songs, workers=2, batch_size=1)
+
+    assert (report.searched, report.found, report.not_found) == (2, 1, 1)
+    # Requests now find the original recording with a key lookup
+    assert TrackTableBackend().load(("bad blood", "neil sedaka")) == (
+        "https://open.spotify.com/Bad Blood Neil Sedaka",
+        "Bad Blood Neil Sedaka",
+        "spotify:track:Bad Blood Neil Sedaka",
+    )
+
+    sp.queries.clear()
+    songs.add(("Island Girl", "Elton John"))
+    report = await resolve_tracks(sp, songs)
+    # The unknown song's search is too recent to retry
+    assert sp.queries == ["Island Girl Elton John"]
+
+    with db.database_session() as connection:
+        connection.execute(
+            db.track_cache.update().values(
+                cached_at=int(time.time()) - TRACK_MAX_AGE - 1
+            )
+        )
+    sp.queries.clear()
+    report = await resolve_tracks(sp, songs)
+    assert sorted(sp.queries) == [
+        "Bad Blood Neil Sedaka",
+        "Island Girl Elton John",
+        "Unknown Song Nobody",
+    ]
+
+
+def test_track_backend_reads_the_table_only_if_it_exists(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True)
+    monkeypatch.setattr(db, "_engine", engine)
+    backend = TrackTableBackend()
+    backend.save(("vogue", "madonna"), ("link", "Vogue", "spotify:track:1"))
+    assert backend.load(("vogue", "madonna")) is None
+
+    db.metadata.create_all(engine)
+    backend = TrackTableBackend()
+    backend.save(("vogue", "madonna"), ("link", "Vogue", "spotify:track:1"))
+    assert backend.load(("vogue", "madonna")) == ("link", "Vogue", "spotify:track:1")
@@ -0,0 +1,83 @@
+import pytest
+from cryptography.fernet import Fernet, InvalidToken
+from sqlalchemy import create_engine
+
+from trainingsong import db_utils
+from trainingsong.server import db
+from trainingsong.server.rotate_keys import rotate_tokens
+
+OLD_KEY = Fernet.generate_key().decode()
+NEW_KEY = Fernet.generate_key().decode()
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", future=True)
+    db.metadata.create_all(engine)
+    monkeypatch.setattr(db, "_engine", engine)
+    return engine
+
+
+def use_keys(monkeypatch, key, old_keys=""):
+    monkeypatch.setenv("ENCRYPT_KEY", key)
+    monkeypatch.setenv("OLD_ENCRYPT_KEYS", old_keys)
+    db_utils._fernets.cache_clear()
+    db_utils._fernet.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def reset_keys():
+    yield
+    db_utils._fernets.cache_clear()
+    db_utils._fernet.cache_clear()
+
+
+def test_old_keys_still_decrypt(monkeypatch):
+    use_keys(monkeypatch, OLD_KEY)
+    token = db_utils.encrypt("access")
+
+    use_keys(monkeypatch, NEW_KEY, OLD_KEY)
+    assert db_utils.decrypt(token) == "access"
+    rotated = db_utils.rotate(token)
+    assert rotated != token
+    assert db_utils.rotate(rotated) == rotated
+
+    use_keys(monkeypatch, NEW_KEY)
+    assert db_utils.decrypt(rotated) == "access"
+    with pytest.raises(InvalidToken):
+        db_utils.decrypt(token)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_rotate_tokens(sqlite_engine, monkeypatch, workers):
+    use_keys(monkeypatch, OLD_KEY)
+    with db.database_session() as connection:
+        for i in range(25):
+            db.store_tokens(f"user{i:02}@example.com", f"a{i}", f"r{i}", 0, connection)
+
+    use_keys(monkeypatch, NEW_KEY, OLD_KEY)
+    # Written under the new key already, e.g. by a refresh during the rotation
+    db.store_tokens("user03@example.com", "a3", "r3", 0)
+
+    report = rotate_tokens(batch_size=4, workers=workers)
+    assert (report.scanned, report.rotated, report.failed) == (25, 24, [])
+    assert report.last_email == "user24@example.com"
+
+    # Nothing is left under the old key, so running again changes nothing
+    assert rotate_tokens(batch_size=4, workers=workers).rotated == 0
+    db.TOKEN_CACHE.clear()
+    use_keys(monkeypatch, NEW_KEY)
+    assert db.get_tokens("user17@example.com")["refresh_token"] == "r17"
+
+
+def test_rotate_tokens_reports_undecryptable_rows(sqlite_engine, monkeypatch):
+    use_keys(monkeypatch, Fernet.generate_key().decode())
+    db.store_tokens("lost@example.com", "a", "r", 0)
+    use_keys(monkeypatch, OLD_KEY)
+    db.store_tokens("kept@example.com", "a", "r", 0)
+
+    use_keys(monkeypatch, NEW_KEY, OLD_KEY)
+    report = rotate_tokens(workers=1, after="kept@example.com")
+
+    assert report.failed == ["lost@example.com"]
+    assert report.scanned == 1
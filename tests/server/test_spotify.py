@@ -0,0 +1,290 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from trainingsong.server import spotify
+from trainingsong.server.spotify import (
+    NOT_FOUND,
+    NOT_FOUND_TTL,
+    TRACK_CACHE,
+    TRACK_FLIGHTS,
+    AsyncSpotify,
+    SpotifyError,
+    TrackTableBackend,
+    pick_track,
+    spotify_link,
+)
+
+SEARCH_RESULT = {
+    "tracks": {
+        "items": [
+            {
+                "external_urls": {"spotify": "https://open.spotify.com/track/1"},
+                "name": "Vogue",
+                "uri": "spotify:track:1",
+            }
+        ]
+    }
+}
+
+
+@pytest.mark.asyncio
+async def test_spotify_link_is_cached():
+    sp = AsyncMock()
+    sp.search.return_value = SEARCH_RESULT
+
+    first = await spotify_link(sp, "Vogue", "Madonna")
+    second = await spotify_link(sp, " vogue", "MADONNA ")
+
+    assert (
+        first
+        == second
+        == (
+            "https://open.spotify.com/track/1",
+            "Vogue",
+            "spotify:track:1",
+        )
+    )
+    sp.search.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_not_found_is_cached_for_a_limited_time():
+    sp = AsyncMock()
+    sp.search.return_value = {"tracks": {"items": []}}
+
+    with patch("time.monotonic", return_value=0):
+        for _ in range(2):
+            with pytest.raises(HTTPException) as e:
+                await spotify_link(sp, "Not A Song", "Nobody")
+            assert e.value.status_code == 404
+    sp.search.assert_called_once()
+
+    with patch("time.monotonic", return_value=NOT_FOUND_TTL + 1):
+        with pytest.raises(HTTPException):
+            await spotify_link(sp, "Not A Song", "Nobody")
+    assert sp.search.call_count == 2
+    assert TRACK_CACHE.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_searches_share_one_request():
+    async def search(**_kwargs):
+        await asyncio.sleep(0.05)
+        return SEARCH_RESULT
+
+    sp = AsyncMock()
+    sp.search.side_effect = search
+
+    results = await asyncio.gather(
+        *(spotify_link(sp, "Vogue", "Madonna") for _ in range(10))
+    )
+
+    assert len(set(results)) == 1
+    sp.search.assert_called_once()
+    assert len(TRACK_FLIGHTS) == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_searches_share_errors():
+    async def search(**_kwargs):
+        await asyncio.sleep(0.05)
+        raise SpotifyError(503, "unavailable")
+
+    sp = AsyncMock()
+    sp.search.side_effect = search
+
+    results = await asyncio.gather(
+        *(spotify_link(sp, "Vogue", "Madonna") for _ in range(5)),
+        return_exceptions=True,
+    )
+
+    assert all(isinstance(result, SpotifyError) for result in results)
+    sp.search.assert_called_once()
+    # Errors aren't cached, so the next request tries again
+    sp.search.side_effect = None
+    sp.search.return_value = SEARCH_RESULT
+    await spotify_link(sp, "Vogue", "Madonna")
+    assert sp.search.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_another_users_auth_error_isnt_shared():
+    async def revoked(**_kwargs):
+        await asyncio.sleep(0.05)
+        raise SpotifyError(401, "The access token expired")
+
+    revoked_sp = AsyncMock()
+    revoked_sp.search.side_effect = revoked
+    sp = AsyncMock()
+    sp.search.return_value = SEARCH_RESULT
+
+    revoked_result, result = await asyncio.gather(
+        spotify_link(revoked_sp, "Vogue", "Madonna"),
+        spotify_link(sp, "Vogue", "Madonna"),
+        return_exceptions=True,
+    )
+
+    # Only the user whose token failed sees the error
+    assert isinstance(revoked_result, SpotifyError)
+    assert result[2] == "spotify:track:1"
+    sp.search.assert_called_once()
+
+
+@patch("trainingsong.server.spotify.db")
+def test_backend_expires_not_found_rows(mock_db):
+    backend = TrackTableBackend()
+    mock_db.get_track.return_value = {"uri": None, "cached_at": 0}
+    assert backend.load(("a", "b")) is None
+
+    with patch("time.time", return_value=1000):
+        mock_db.get_track.return_value = {"uri": None, "cached_at": 900}
+        # Only what's left of the row's TTL, not a fresh one
+        assert backend.load(("a", "b")) == (NOT_FOUND, NOT_FOUND_TTL - 100)
+
+    backend.save(("a", "b"), NOT_FOUND)
+    mock_db.store_track.assert_called_once_with("a", "b", None, None, None)
+
+
+@pytest.mark.asyncio
+async def test_async_spotify_requests():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if request.url.path == "/v1/me/player/play":
+            return httpx.Response(404, json={"error": {"message": "No device"}})
+        return httpx.Response(200, json=SEARCH_RESULT)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    with patch("trainingsong.server.spotify.get_http_client", return_value=client):
+        sp = AsyncSpotify(auth="token")
+        assert await sp.search(q="Vogue Madonna", limit=1) == SEARCH_RESULT
+        with pytest.raises(SpotifyError) as e:
+            await sp.start_playback(uris=["spotify:track:1"])
+    await client.aclose()
+
+    assert e.value.http_status == 404
+    assert requests[0].headers["Authorization"] == "Bearer token"
+    assert requests[0].url.params["q"] == "Vogue Madonna"
+
+
+def _token_info(expires_in, access_token="old"):
+    return {
+        "email": "user@example.com",
+        "access_token": access_token,
+        "refresh_token": "refresh",
+        "expires_at": int(time.time()) + expires_in,
+    }
+
+
+@pytest.fixture
+def token_store(monkeypatch):
+    "Patch the token storage and OAuth calls, returning the OAuth mock"
+    monkeypatch.setattr(spotify, "REFRESH_INTERVAL", 0)
+    monkeypatch.setattr(spotify, "update_tokens_async", AsyncMock())
+    oauth = MagicMock()
+
+    def refresh_access_token(_refresh_token):
+        time.sleep(0.1)
+        return _token_info(3600, access_token="new")
+
+    oauth.refresh_access_token.side_effect = refresh_access_token
+    monkeypatch.setattr(spotify, "_spotify_oauth", lambda *_args: oauth)
+    return oauth
+
+
+@pytest.mark.asyncio
+async def test_token_near_expiry_is_refreshed_in_the_background(
+    token_store, monkeypatch
+):
+    monkeypatch.setattr(
+        spotify, "get_tokens_async", AsyncMock(return_value=_token_info(60))
+    )
+
+    start = time.perf_counter()
+    sp = await spotify.create_spotify_client(None, "user@example.com")
+
+    # The request uses the still-valid token without waiting for the refresh
+    assert sp.auth == "old"
+    assert time.perf_counter() - start < 0.1
+    await asyncio.gather(*spotify._background_tasks)
+    token_store.refresh_access_token.assert_called_once_with("refresh")
+    spotify.update_tokens_async.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_expired_requests_share_one_refresh(token_store, monkeypatch):
+    monkeypatch.setattr(
+        spotify, "get_tokens_async", AsyncMock(return_value=_token_info(-60))
+    )
+
+    clients = await asyncio.gather(
+        *(spotify.create_spotify_client(None, "user@example.com") for _ in range(5))
+    )
+
+    assert [sp.auth for sp in clients] == ["new"] * 5
+    token_store.refresh_access_token.assert_called_once()
+    spotify.update_tokens_async.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_refresh_active_tokens_skips_idle_users(token_store, monkeypatch):
+    monkeypatch.setattr(
+        spotify, "get_tokens_async", AsyncMock(return_value=_token_info(60))
+    )
+    monkeypatch.setattr(spotify, "_active_users", OrderedDict())
+    spotify._active_users["active@example.com"] = time.time()
+    spotify._active_users["idle@example.com"] = time.time() - spotify.ACTIVE_WINDOW - 1
+
+    await spotify.refresh_active_tokens()
+
+    spotify.get_tokens_async.assert_awaited_once_with("active@example.com")
+    token_store.refresh_access_token.assert_called_once()
+    assert list(spotify._active_users) == ["active@example.com"]
+
+
+def test_pick_track_prefers_the_original_recording():
+    def track(uri, name, artist, album="Single", popularity=50):
+        return {
+            "uri": uri,
+            "name": name,
+            "artists": [{"name": artist}],
+            "album": {"name": album},
+            "popularity": popularity,
+        }
+
+    items = [
+        track("karaoke", "Vogue (Karaoke Version)", "Sing Along Stars", popularity=90),
+        track("tribute", "Vogue", "Madonna Tribute Band", album="Tribute to Madonna"),
+        track("remix", "Vogue - Remix", "Other Artist", popularity=80),
+        track("original", "Vogue", "Madonna", album="I'm Breathless", popularity=70),
+    ]
+
+    assert pick_track(items, "Vogue", "Madonna")["uri"] == "original"
+    # Featured artists are credited in Billboard's artist name
+    assert pick_track(items, "Vogue", "Madonna Featuring Someone")["uri"] == "original"
+
+
+def test_refresh_loop_is_off_on_vercel():
+    # Frozen instances would run the loop inside someone's request
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from trainingsong.server import spotify; print(spotify.REFRESH_INTERVAL)",
+        ],
+        env={**os.environ, "VERCEL": "1"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == "0.0"
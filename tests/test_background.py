@@ -0,0 +1,31 @@
+from unittest.mock import patch
+
+import pytest
+
+from trainingsong.background import _SongWorker
+
+
+@patch("trainingsong.background.ts")
+def test_rapid_calls_are_coalesced(mock_ts):
+    mock_ts.side_effect = lambda p, **kwargs: (p, {"song_info": f"song {p}"})
+    worker = _SongWorker(debounce=0.1)
+
+    futures = [worker.submit(p, verbose=False) for p in (90, 91, 92)]
+    assert worker.flush(timeout=5)
+
+    mock_ts.assert_called_once_with(92, verbose=False)
+    assert [f.result() for f in futures] == [(92, {"song_info": "song 92"})] * 3
+
+
+@patch("trainingsong.background.ts")
+def test_errors_reach_the_future(mock_ts):
+    mock_ts.side_effect = ValueError("No email found")
+    worker = _SongWorker(debounce=0)
+
+    future = worker.submit(92)
+    with pytest.raises(ValueError):
+        future.result(timeout=5)
+
+    mock_ts.side_effect = None
+    mock_ts.return_value = (93, {})
+    assert worker.submit(93).result(timeout=5) == (93, {})
@@ -0,0 +1,55 @@
+import subprocess
+import sys
+
+import pytest
+
+# Only needed for the first-time OAuth flow, on the server or once a call is
+# made, so none of these should load when a training script imports ts
+HEAVY_MODULES = [
+    "billboard",
+    "cryptography",
+    "dotenv",
+    "fastapi",
+    "httpx",
+    "pydantic",
+    "requests",
+    "spotipy",
+    "sqlalchemy",
+    "starlette",
+    "uvicorn",
+    "webbrowser",
+]
+
+
+def imported_modules(statement):
+    "Top-level package names imported by running statement, per -X importtime"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = set()
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith("import time:") and "|" in line:
+            name = line.rsplit("|", 1)[1].strip()
+            modules.add(name.split(".")[0])
+    return modules
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "from trainingsong import ts",
+        "from trainingsong import ts_async",
+    ],
+)
+def test_import_is_light(statement):
+    eager = sorted(set(HEAVY_MODULES) & imported_modules(statement))
+    assert not eager, f"`{statement}` eagerly imports {eager}"
+
+
+def test_heavy_modules_load_on_first_use():
+    modules = imported_modules("import trainingsong; trainingsong.core._get_session()")
+    assert "requests" in modules
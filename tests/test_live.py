@@ -0,0 +1,89 @@
+import socket
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+import uvicorn
+
+from trainingsong.live import LiveSession
+from trainingsong.server.api import app
+
+pytest.importorskip("websockets")
+
+
+@pytest.fixture
+def registered(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".email").write_text(
+        '{"email": "user@example.com", "registered": true}'
+    )
+
+
+@pytest.fixture
+def live_url():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]})
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield f"ws://127.0.0.1:{sock.getsockname()[1]}/live"
+    server.should_exit = True
+    thread.join(5)
+    sock.close()
+
+
+class FakeSpotify:
+    expires_at = time.time() + 3600
+
+    def __init__(self):
+        self.searches = 0
+
+    async def search(self, q, **_kwargs):
+        self.searches += 1
+        track = {
+            "external_urls": {"spotify": f"https://open.spotify.com/track/{q}"},
+            "name": q,
+            "uri": f"spotify:track:{q}",
+        }
+        return {"tracks": {"items": [track]}}
+
+    async def devices(self):
+        return {"devices": [{"id": "1"}]}
+
+    async def start_playback(self, **_kwargs):
+        return None
+
+
+def test_live_session_reports_each_new_song(registered, live_url, capsys):
+    sp = FakeSpotify()
+    with patch("trainingsong.server.spotify.create_spotify_client", return_value=sp):
+        session = LiveSession(url=live_url)
+        for p in (0.22, 0.223, 0.228, 0.24):
+            session.update(p)
+        session.close()
+
+    out = capsys.readouterr().out
+    assert "Here's 22 by Taylor Swift" in out
+    assert "Here's 24K Magic by Bruno Mars" in out
+    assert sp.searches == 2
+
+
+@patch("trainingsong.background.ts_async")
+def test_live_session_falls_back_to_ts_async(mock_ts_async, registered):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        url = f"ws://127.0.0.1:{sock.getsockname()[1]}/live"
+
+    session = LiveSession(url=url, autoplay=False)
+    session.update(0.9)
+    # The same chart week, so the same song: no call at all
+    session.update(0.9001)
+    session.close()
+
+    mock_ts_async.assert_called_once_with(
+        0.9, chart="hot-100", autoplay=False, verbose=True, metric="accuracy"
+    )
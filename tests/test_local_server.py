@@ -0,0 +1,54 @@
+import socket
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+
+from trainingsong.local_server import wait_for_oauth_code
+
+
+def _redirect_uri(authorise_url):
+    return parse_qs(urlparse(authorise_url).query)["redirect_uri"][0]
+
+
+def _port_is_free(port):
+    with socket.socket() as sock:
+        return sock.connect_ex(("127.0.0.1", port)) != 0
+
+
+def test_wait_for_oauth_code_returns_code_and_shuts_down():
+    def browser(url):
+        # Spotify redirecting back once the user has authorised
+        redirect_uri = _redirect_uri(url)
+        threading.Thread(
+            target=requests.get,
+            args=(redirect_uri,),
+            kwargs={"params": {"code": "abc"}, "timeout": 5},
+        ).start()
+
+    code, redirect_uri = wait_for_oauth_code(browser, port=0, timeout=10)
+
+    assert code == "abc"
+    port = urlparse(redirect_uri).port
+    assert redirect_uri == f"http://127.0.0.1:{port}/local_callback"
+    assert _port_is_free(port)
+    assert not any(t.name == "trainingsong-oauth" for t in threading.enumerate())
+
+
+def test_wait_for_oauth_code_times_out():
+    with pytest.raises(TimeoutError):
+        wait_for_oauth_code(lambda _url: None, port=0, timeout=0.1)
+    assert not any(t.name == "trainingsong-oauth" for t in threading.enumerate())
+
+
+def test_wait_for_oauth_code_reports_denied_authorisation():
+    def browser(url):
+        threading.Thread(
+            target=requests.get,
+            args=(_redirect_uri(url),),
+            kwargs={"params": {"error": "access_denied"}, "timeout": 5},
+        ).start()
+
+    with pytest.raises(ValueError, match="access_denied"):
+        wait_for_oauth_code(browser, port=0, timeout=10)
@@ -0,0 +1,127 @@
+import multiprocessing
+import time
+from unittest.mock import patch
+
+import responses
+
+from trainingsong import response_cache
+from trainingsong.core import ts
+from trainingsong.ts_utils import URL
+
+RESPONSE = {
+    "spotify_link": "https://open.spotify.com/track/1",
+    "song_name": "Island Girl",
+    "artist_name": "Elton John",
+    "target_date": "1975-10-19",
+    "percentage": 75.8,
+    "chart": "hot-100",
+    "errors": "",
+    "song_info": "The Number 1 song 75.8% through the 1900s on the hot-100 chart was "
+    "Island Girl by Elton John. \nThe date was 1975-10-19 and the song was on the "
+    "chart for 2 weeks.",
+    "open_link": "",
+}
+
+
+def test_same_chart_week_is_a_hit():
+    response_cache.put(75.8, "hot-100", RESPONSE)
+
+    cached = response_cache.get(75.81, "hot-100")
+
+    assert cached["song_name"] == "Island Girl"
+    assert cached["percentage"] == 75.81
+    assert cached["target_date"] == "1975-10-23"
+    assert "75.81% through" in cached["song_info"]
+    assert "The date was 1975-10-23" in cached["song_info"]
+    assert cached["open_link"] == "True"
+    assert response_cache.get(76.5, "hot-100") is None
+    assert response_cache.get(75.8, "billboard-200") is None
+
+
+def test_hard_coded_buckets():
+    assert response_cache.cache_key(22.1, "hot-100") == ("hot-100", "hard-coded-22")
+    assert response_cache.cache_key(0.229, "hot-100") == ("hot-100", "hard-coded-22")
+
+
+def test_failed_responses_are_not_cached():
+    response_cache.put(75.8, "hot-100", {"detail": "No chart data found"})
+    assert response_cache.get(75.8, "hot-100") is None
+
+
+def test_entries_expire():
+    response_cache.put(75.8, "hot-100", RESPONSE)
+    with patch("time.time", return_value=2**40):
+        assert response_cache.get(75.8, "hot-100") is None
+
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    monkeypatch.setattr(response_cache, "MAX_ENTRIES", 2)
+    now = int(time.time())
+    with patch("time.time", side_effect=range(now, now + 10)):
+        response_cache.put(60, "hot-100", RESPONSE)
+        response_cache.put(70, "hot-100", RESPONSE)
+        response_cache.get(60, "hot-100")
+        response_cache.put(80, "hot-100", RESPONSE)
+
+    assert response_cache.get(60, "hot-100") is not None
+    assert response_cache.get(70, "hot-100") is None
+    assert response_cache.get(80, "hot-100") is not None
+
+
+def _write_and_read(cache_dir, worker):
+    response_cache.CACHE_DIR = cache_dir
+    for i in range(20):
+        p = 53 + worker + i / 100
+        response_cache.put(p, "hot-100", RESPONSE)
+        assert response_cache.get(p, "hot-100") is not None
+
+
+def test_processes_share_the_cache(response_cache_dir):
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=_write_and_read, args=(response_cache_dir, i))
+        for i in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+
+    assert [worker.exitcode for worker in workers] == [0] * 4
+    assert response_cache.get(53.05, "hot-100") is not None
+
+
+@responses.activate
+def test_ts_skips_the_network_on_a_hit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".email").write_text(
+        '{"email": "user@example.com", "registered": true}'
+    )
+    responses.add(responses.GET, URL, json=RESPONSE, status=200)
+
+    with patch("webbrowser.open") as open_browser:
+        ts(75.8, autoplay=False, verbose=False)
+        _acc, response = ts(75.81, autoplay=False, verbose=False)
+        ts(75.805, autoplay=False, verbose=False)
+
+    assert len(responses.calls) == 1
+    assert response["song_name"] == "Island Girl"
+    # A sweep's repeat calls don't open a tab each
+    open_browser.assert_called_once_with(RESPONSE["spotify_link"])
+
+
+@responses.activate
+def test_ts_with_autoplay_calls_the_api(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".email").write_text(
+        '{"email": "user@example.com", "registered": true}'
+    )
+    responses.add(responses.GET, URL, json=RESPONSE, status=200)
+
+    with patch("webbrowser.open") as open_browser:
+        ts(75.8, verbose=False)
+        ts(75.81, verbose=False)
+
+    # Only the API can start playback
+    assert len(responses.calls) == 2
+    open_browser.assert_not_called()
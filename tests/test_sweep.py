@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import responses
+
+from trainingsong import sweep
+from trainingsong.core import ts
+from trainingsong.ts_utils import URL
+
+
+@pytest.fixture
+def registered(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".email").write_text(
+        '{"email": "user@example.com", "registered": true}'
+    )
+
+
+def test_reduce_metrics():
+    values = [0.7, 0.9, 0.8, 0.6]
+    assert sweep.reduce_metrics(values, "max") == 0.9
+    assert sweep.reduce_metrics(values, "min") == 0.6
+    assert sweep.reduce_metrics(values, "last") == 0.6
+    assert sweep.reduce_metrics(values, "top-k", k=2) == pytest.approx(0.85)
+    with pytest.raises(ValueError):
+        sweep.reduce_metrics([], "max")
+
+
+def _trial(sweep_dir, metric):
+    sweep.SWEEP_DIR = sweep_dir
+    os.environ[sweep.SWEEP_ENV] = "grid"
+    ts(metric, verbose=False)
+
+
+def test_trials_in_other_processes_report(sweep_dir):
+    context = multiprocessing.get_context("spawn")
+    trials = [
+        context.Process(target=_trial, args=(sweep_dir, 60 + i)) for i in range(8)
+    ]
+    for trial in trials:
+        trial.start()
+    for trial in trials:
+        trial.join(30)
+
+    assert [trial.exitcode for trial in trials] == [0] * 8
+    assert sorted(sweep.metrics("grid")) == [60 + i for i in range(8)]
+
+
+@responses.activate
+def test_sweep_makes_one_api_call(registered):
+    responses.add(responses.GET, URL, json={"song_info": "mock song info"}, status=200)
+
+    with sweep.sweep("lr-search", reduce="max", autoplay=False, verbose=False):
+        for metric in (0.71, 0.93, 0.88):
+            _acc, response = ts(metric, verbose=False)
+            assert response == {"sweep": "lr-search"}
+
+    assert len(responses.calls) == 1
+    query = parse_qs(urlparse(responses.calls[0].request.url).query)
+    assert query["p"] == ["0.93"]
+    assert sweep.metrics("lr-search") == []
+    assert sweep.active_sweep() is None
@@ -2,7 +2,14 @@ import pytest
 import responses
 from fastapi.testclient import TestClient
 
-from trainingsong.core import _is_valid_email, _training_song, local_app
+from trainingsong.core import (
+    _email_registered,
+    _get_email,
+    _is_valid_email,
+    _training_song,
+    local_app,
+    ts,
+)
 from trainingsong.ts_utils import URL
 
 client = TestClient(local_app)
@@ -37,3 +44,42 @@ def test_spotify_callback():
     response = client.get("/local_callback", params={"code": "12345"})
     assert response.status_code == 200
     assert response.text == '"Success! You can close this window."'
+
+
+@responses.activate
+def test_ts_skips_email_check_once_registered(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".email").write_text('{"email": "user@example.com"}')
+    responses.add(
+        responses.GET,
+        URL + "/email_in_db",
+        json={"present_in_db": "True"},
+        status=200,
+    )
+    responses.add(
+        responses.GET,
+        URL,
+        json={"song_info": "mock song info"},
+        status=200,
+    )
+
+    ts(92, autoplay=False, verbose=False)
+    ts(93, autoplay=False, verbose=False)
+
+    urls = [call.request.url.split("?")[0] for call in responses.calls]
+    assert urls == [URL + "/email_in_db", URL + "/", URL + "/"]
+    assert _email_registered()
+
+
+@responses.activate
+def test_server_error_forgets_registration(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / ".email").write_text(
+        '{"email": "user@example.com", "registered": true}'
+    )
+    responses.add(responses.GET, URL, json={"errors": "oops"}, status=500)
+
+    _training_song(92, verbose=False)
+
+    assert not _email_registered()
+    assert _get_email() == "user@example.com"
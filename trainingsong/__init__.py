@@ -1,6 +1,28 @@
 "Audio Motivation for model building - plays song based on model performance"
 
-# from trainingsong.server import api, spotify, billboard_io, db
-import trainingsong.core as core
-from trainingsong import db_utils, ts_utils
-from trainingsong.core import ts
+# Attributes are imported on first access so that `from trainingsong import ts`
+# stays cheap in training scripts. See tests/test_import_time.py.
+
+import importlib
+
+_LAZY_ATTRIBUTES = {
+    "ts": ("trainingsong.core", "ts"),
+    "ts_async": ("trainingsong.background", "ts_async"),
+    "live": ("trainingsong.live", "live"),
+    "core": ("trainingsong.core", None),
+    "db_utils": ("trainingsong.db_utils", None),
+    "ts_utils": ("trainingsong.ts_utils", None),
+}
+
+__all__ = ["ts", "ts_async", "live"]
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module_name, attribute = _LAZY_ATTRIBUTES[name]
+    module = importlib.import_module(module_name)
+    value = module if attribute is None else getattr(module, attribute)
+    globals()[name] = value
+    return value
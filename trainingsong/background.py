@@ -0,0 +1,115 @@
+"""Non-blocking ts() for training loops.
+
+ts_async hands the metric to a single background worker and returns a
+Future straight away. Calls that arrive while the worker is waiting or busy
+are coalesced so only the latest metric is sent, and pending calls are
+flushed when the interpreter exits so the final song still plays.
+"""
+
+import atexit
+import threading
+import time
+from concurrent.futures import Future, wait
+from typing import Any, Dict, List, Optional, Tuple
+
+from trainingsong.core import ts
+
+# How long the worker waits for further calls before sending the latest one
+DEBOUNCE_SECONDS = 0.25
+# Longest the interpreter waits at exit for the final song
+FLUSH_TIMEOUT = 30
+
+
+class _SongWorker:
+    "Single background thread that sends the latest pending ts() call"
+
+    def __init__(self, debounce: float = DEBOUNCE_SECONDS):
+        self.debounce = debounce
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending: Optional[Tuple[Tuple[Any, ...], Dict[str, Any]]] = None
+        self._waiters: List[Future] = []
+        self._outstanding: List[Future] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, *args: Any, **kwargs: Any) -> Future:
+        future: Future = Future()
+        with self._lock:
+            self._pending = (args, kwargs)
+            self._waiters.append(future)
+            self._outstanding.append(future)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="trainingsong-worker", daemon=True
+                )
+                self._thread.start()
+        self._wakeup.set()
+        return future
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.debounce)
+            with self._lock:
+                self._wakeup.clear()
+                pending, waiters = self._pending, self._waiters
+                self._pending, self._waiters = None, []
+            if pending is None:
+                continue
+
+            # Superseded calls share the result of the call that was sent
+            waiters = [f for f in waiters if f.set_running_or_notify_cancel()]
+            if waiters:
+                args, kwargs = pending
+                try:
+                    result = ts(*args, **kwargs)
+                except BaseException as e:  # pylint: disable=broad-except
+                    for future in waiters:
+                        future.set_exception(e)
+                else:
+                    for future in waiters:
+                        future.set_result(result)
+
+            with self._lock:
+                self._outstanding = [f for f in self._outstanding if not f.done()]
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        "Wait for every submitted call to finish. Returns False on timeout"
+        with self._lock:
+            outstanding = list(self._outstanding)
+        _done, not_done = wait(outstanding, timeout=timeout)
+        return not not_done
+
+
+_worker = _SongWorker()
+
+
+def ts_async(
+    input_percentage,
+    chart: str = "hot-100",
+    autoplay: bool = True,
+    verbose: bool = True,
+    metric: str = "accuracy",
+) -> Future:
+    """Non-blocking ts(). Takes the same arguments and returns a Future that
+    resolves to ts()'s (acc, response). If several calls arrive before the
+    worker gets to them, only the latest metric is sent and all of their
+    futures resolve to its result.
+
+    Run ts() once in the foreground first if you haven't set up your email
+    and Spotify authorisation yet, since that flow is interactive."""
+    return _worker.submit(
+        input_percentage,
+        chart=chart,
+        autoplay=autoplay,
+        verbose=verbose,
+        metric=metric,
+    )
+
+
+def flush(timeout: Optional[float] = FLUSH_TIMEOUT) -> bool:
+    "Block until pending ts_async calls have been sent"
+    return _worker.flush(timeout)
+
+
+atexit.register(flush)
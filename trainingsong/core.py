@@ -1,18 +1,38 @@
-"""Entry point"""
+"""Entry point
+
+Keep module-level imports light: this is imported by training scripts, so
+requests, webbrowser and the OAuth server (uvicorn, fastapi) are only
+imported when a call first needs them. tests/test_import_time.py checks this.
+"""
 
 import json
 import os
 import re
-import time
-import webbrowser
-from threading import Thread
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
+
+from trainingsong.ts_utils import LOCAL_REDIRECT_URI, URL
+
+if TYPE_CHECKING:
+    import requests
+
+# (connect, read) timeouts for calls to the API
+TIMEOUT = (5, 15)
+EMAIL_FILE = ".email"
 
-import requests
-import uvicorn
-from fastapi import FastAPI, Request
+_session: Optional["requests.Session"] = None
 
-from trainingsong.ts_utils import AUTH_URL, OAUTH_CODE, URL
+
+def _get_session() -> "requests.Session":
+    "A pooled keep-alive session, so repeated ts() calls reuse one connection"
+    global _session
+    if _session is None:
+        import requests
+
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
 
 
 def _training_song(
@@ -22,6 +42,8 @@ def _training_song(
     verbose: Optional[bool] = True,
     email: Optional[str] = None,
     metric: Optional[str] = "accuracy",
+    oauth_code: Optional[str] = None,
+    redirect_uri: str = LOCAL_REDIRECT_URI,
 ) -> Tuple[Union[float, List[float], None], Dict[str, Any]]:
     """Return the training song for a given percentage
     Outputs: (acc, response)"""
@@ -30,18 +52,38 @@ def _training_song(
         "p": p,
         "autoplay": autoplay,
         "chart": chart,
-        "spotify_client_code": OAUTH_CODE,
+        "spotify_client_code": oauth_code,
         "email": email,
     }
+    if oauth_code and redirect_uri != LOCAL_REDIRECT_URI:
+        # The server must send the same redirect URI when it exchanges the code
+        params["redirect_uri"] = redirect_uri
 
-    raw_response = requests.get(
+    raw_response = _get_session().get(
         URL,
         params=params,
-        timeout=15,
+        timeout=TIMEOUT,
     )
+    if raw_response.status_code >= 500:
+        # e.g. the server lost our tokens, so check registration again next time
+        _forget_email_registered()
 
     response = raw_response.json()
 
+    _report(p, response, verbose, metric)
+    _open_link(response)
+
+    return p, response
+
+
+def _open_link(response: Dict[str, Any]):
+    if "open_link" in response and response["open_link"]:
+        import webbrowser
+
+        webbrowser.open(response["spotify_link"])
+
+
+def _report(p: float, response: Dict[str, Any], verbose: bool, metric: str):
     if verbose:
         print(f"Congrats your model's {metric} was ", p, "%!")
         if response and "song_info" in response:
@@ -51,11 +93,6 @@ def _training_song(
     if "errors" in response:
         print(response["errors"])
 
-    if "open_link" in response and response["open_link"]:
-        webbrowser.open(response["spotify_link"])
-
-    return p, response
-
 
 def ts(
     input_percentage: Union[float, List[float]],
@@ -73,11 +110,45 @@ def ts(
     autoplay (bool): Whether to autoplay the song. Defaults to False.
     verbose (bool): Whether to print the song info. Defaults to False.
 
+    Inside a sweep (see trainingsong.sweep) the metric is only recorded, and
+    one song plays for the whole sweep at the end.
+
+    Responses are cached on disk per chart week (see trainingsong.response_cache),
+    so without autoplay, repeat calls in a week already seen skip the API and
+    open the song's link once per process.
+
     Outputs:
     acc: The accuracy of your model. In the same form as you put it in.
     response: The response from the server as a dictionary.
     """
 
+    # if the input percentage is a list, we want to take the final value
+    accuracy = (
+        input_percentage
+        if isinstance(input_percentage, (float, int))
+        else input_percentage[-1]
+    )
+
+    from trainingsong import sweep
+
+    sweep_name = sweep.active_sweep()
+    if sweep_name:
+        # One song plays for the whole sweep when it's collected
+        sweep.report(accuracy, sweep_name)
+        if verbose:
+            print(f"Reported {metric} {accuracy} to sweep {sweep_name}")
+        return accuracy, {"sweep": sweep_name}
+
+    from trainingsong import response_cache
+
+    # Playback needs the API, so only calls that open links use the cache
+    response = None if autoplay else response_cache.get(accuracy, chart)
+    if response is not None:
+        # Seen this chart week before, so just open the song
+        _report(accuracy, response, verbose, metric)
+        _open_link(response)
+        return accuracy, response
+
     email = _get_email()
     if not email:
         set_email()
@@ -88,26 +159,18 @@ def ts(
             "No email found. Please run from the command line or add an email to a .email file in the root directory to proceed. "
         )
 
-    email_in_db = _check_email(email)
+    email_in_db = _email_registered() or _check_email(email)
+    if email_in_db:
+        _mark_email_registered(email)
 
+    oauth_code, redirect_uri = None, LOCAL_REDIRECT_URI
     if not email_in_db:
-        # start the local server in a new thread
-        if not OAUTH_CODE:
-            server_thread = Thread(target=_start_local_server)
-            server_thread.start()
-
-            webbrowser.open(AUTH_URL)
+        # Serve the OAuth callback locally until the user has authorised
+        import webbrowser
 
-            # wait for the user to authorize and for the server to capture the OAuth code
-            while not OAUTH_CODE:
-                time.sleep(0.5)
+        from trainingsong.local_server import wait_for_oauth_code
 
-    # if the input percentage is a list, we want to take the final value
-    accuracy = (
-        input_percentage
-        if isinstance(input_percentage, (float, int))
-        else input_percentage[-1]
-    )
+        oauth_code, redirect_uri = wait_for_oauth_code(webbrowser.open)
 
     acc, response = _training_song(
         accuracy,
@@ -116,34 +179,29 @@ def ts(
         verbose=verbose,
         email=email,
         metric=metric,
+        oauth_code=oauth_code,
+        redirect_uri=redirect_uri,
     )
+    response_cache.put(accuracy, chart, response)
     if not email_in_db:
         print(
             """
 
 Thanks for using Training Song!
 For your first time, we used a local server to listen for your Spotify authorisation code.
-You can exit this process now.
 For future uses an access token is stored securely."""
         )
     return acc, response
 
 
-local_app = FastAPI()
-
-
-@local_app.get("/local_callback")
-async def spotify_callback(request: Request):
-    "Callback for the local server to capture the OAuth code"
-    global OAUTH_CODE
-    OAUTH_CODE = request.query_params.get("code")
-    print("Got code:", OAUTH_CODE)
-    return "Success! You can close this window."
+def __getattr__(name: str):
+    # The local OAuth server moved to trainingsong.local_server so importing
+    # core doesn't import fastapi and uvicorn
+    if name in ("local_app", "spotify_callback", "wait_for_oauth_code"):
+        from trainingsong import local_server
 
-
-def _start_local_server():
-    "Start the local server"
-    uvicorn.run(local_app, host="0.0.0.0", port=8000)
+        return getattr(local_server, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def _is_valid_email(email: str) -> bool:
@@ -159,24 +217,51 @@ def set_email():
             email_address = potential_email
         else:
             print("Invalid email address. Please try again.")
-    with open(".email", "w") as f:
+    with open(EMAIL_FILE, "w") as f:
         json.dump({"email": email_address}, f)
 
 
-def _get_email():
-    if not os.path.exists(".email"):
-        return None
-    with open(".email", "r") as f:
+def _read_email_file() -> Dict[str, Any]:
+    if not os.path.exists(EMAIL_FILE):
+        return {}
+    with open(EMAIL_FILE, "r") as f:
         try:
-            email_dict = json.load(f)
+            return json.load(f)
         except json.decoder.JSONDecodeError:
-            email_dict = {"email": None}
+            return {"email": None}
+
+
+def _get_email():
+    email_dict = _read_email_file()
+    if not email_dict:
+        return None
     return email_dict["email"]
 
 
+def _email_registered() -> bool:
+    "Whether a previous run already found the email in the server's db"
+    return bool(_read_email_file().get("registered"))
+
+
+def _mark_email_registered(email: str):
+    if _email_registered():
+        return
+    with open(EMAIL_FILE, "w") as f:
+        json.dump({"email": email, "registered": True}, f)
+
+
+def _forget_email_registered():
+    email_dict = _read_email_file()
+    if email_dict.pop("registered", None):
+        with open(EMAIL_FILE, "w") as f:
+            json.dump(email_dict, f)
+
+
 def _check_email(email: str) -> str:
     "Returns truthy string if email is in db"
-    response = requests.get(URL + "/email_in_db", params={"email": email})
+    response = _get_session().get(
+        URL + "/email_in_db", params={"email": email}, timeout=TIMEOUT
+    )
     if response and (response.status_code == 200):
         return response.json()["present_in_db"]
     else:
@@ -1,22 +1,52 @@
 import os
+from functools import lru_cache
 
-from cryptography.fernet import Fernet
-from dotenv import load_dotenv
+MOCK_KEY = "Ev8c4pycMFdhUH7n_ZH__dqR30Nf_iJIbK0Sp2P55Ak="
 
-# If running locally, load environment variables from .env
-if os.environ.get("VERCEL") != "1":
-    load_dotenv()
 
-ENCRYPT_KEY = os.environ.get("ENCRYPT_KEY")
-MOCK_KEY = "Ev8c4pycMFdhUH7n_ZH__dqR30Nf_iJIbK0Sp2P55Ak="
-if ENCRYPT_KEY is None:
-    ENCRYPT_KEY = MOCK_KEY
-f = Fernet(ENCRYPT_KEY.encode())
+@lru_cache(maxsize=1)
+def _fernets():
+    """The current key's Fernet, then one per key in OLD_ENCRYPT_KEYS, so
+    tokens encrypted before a key rotation can still be read"""
+    # Imported on first use: only the server and the OAuth flow need these
+    from cryptography.fernet import Fernet
+    from dotenv import load_dotenv
+
+    # If running locally, load environment variables from .env
+    if os.environ.get("VERCEL") != "1":
+        load_dotenv()
+
+    encrypt_key = os.environ.get("ENCRYPT_KEY")
+    if encrypt_key is None:
+        encrypt_key = MOCK_KEY
+    old_keys = os.environ.get("OLD_ENCRYPT_KEYS", "").split(",")
+    keys = [encrypt_key] + [key.strip() for key in old_keys if key.strip()]
+    return tuple(Fernet(key.encode()) for key in keys)
+
+
+@lru_cache(maxsize=1)
+def _fernet():
+    from cryptography.fernet import MultiFernet
+
+    return MultiFernet(list(_fernets()))
 
 
 def encrypt(string):
-    return f.encrypt(string.encode()).decode()
+    return _fernet().encrypt(string.encode()).decode()
 
 
 def decrypt(string):
-    return f.decrypt(string.encode()).decode()
+    return _fernet().decrypt(string.encode()).decode()
+
+
+def rotate(string):
+    """Re-encrypt a token with the current key, or return it unchanged if it
+    already uses it. Raises InvalidToken if no key can decrypt it."""
+    from cryptography.fernet import InvalidToken
+
+    token = string.encode()
+    try:
+        _fernets()[0].decrypt(token)
+        return string
+    except InvalidToken:
+        return _fernet().rotate(token).decode()
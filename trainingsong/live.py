@@ -0,0 +1,211 @@
+"""Follow a live training run over one connection.
+
+Calling ts() every epoch repeats the token lookup, chart lookup and Spotify
+search each time. A live session opens one WebSocket to the API and streams
+the metric over it instead. The server keeps the session's Spotify client and
+only sends a song back when the metric moves into a different chart week:
+
+    from trainingsong.live import live
+
+    with live(autoplay=True) as session:
+        for epoch in range(epochs):
+            ...
+            session.update(val_accuracy)
+
+update() returns straight away; songs are reported and opened by a
+background thread. Live sessions need the websockets package
+(pip install websockets) and a server that supports WebSockets, such as one
+run with uvicorn; serverless deployments don't. Without either, updates fall
+back to ts_async().
+"""
+
+import json
+import threading
+from contextlib import ExitStack, contextmanager
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Union
+from urllib.parse import urlencode
+
+from trainingsong import core
+from trainingsong.server.resolve import song_bucket
+from trainingsong.ts_utils import LIVE_URL
+
+if TYPE_CHECKING:
+    from websockets.sync.client import ClientConnection
+
+# Longest close() waits for songs the server is still looking up
+FLUSH_TIMEOUT = 30
+
+
+def _registered() -> bool:
+    "Whether the email has Spotify tokens on the server already"
+    email = core._get_email()
+    if not email:
+        return False
+    if core._email_registered():
+        return True
+    if core._check_email(email):
+        core._mark_email_registered(email)
+        return True
+    return False
+
+
+class LiveSession:
+    "A connection that streams metric updates and receives song changes"
+
+    def __init__(
+        self,
+        chart: str = "hot-100",
+        autoplay: bool = True,
+        verbose: bool = True,
+        metric: str = "accuracy",
+        url: str = LIVE_URL,
+    ):
+        self.chart = chart
+        self.autoplay = autoplay
+        self.verbose = verbose
+        self.metric = metric
+        self.url = url
+        self._connection: Optional["ClientConnection"] = None
+        self._exit_stack = ExitStack()
+        self._receiver: Optional[threading.Thread] = None
+        # Set once the session can't be used, so updates go to ts_async
+        self._fallback = False
+        # The bucket of the last update sent, and how many song changes the
+        # server hasn't answered yet
+        self._bucket: Optional[str] = None
+        self._pending = 0
+        self._answered = threading.Condition()
+
+    def _connect(self) -> bool:
+        "Open the connection, returning False if it can't be used"
+        try:
+            from websockets.exceptions import WebSocketException
+            from websockets.sync.client import connect
+        except ImportError:
+            print("Live sessions need the websockets package. Using ts_async instead.")
+            return False
+
+        query = urlencode(
+            {
+                "email": core._get_email(),
+                "chart": self.chart,
+                "autoplay": str(self.autoplay).lower(),
+            }
+        )
+        try:
+            self._connection = self._exit_stack.enter_context(
+                connect(f"{self.url}?{query}", open_timeout=core.TIMEOUT[0])
+            )
+        except (OSError, WebSocketException) as e:
+            print(f"Couldn't open a live session ({e}). Using ts_async instead.")
+            return False
+        self._receiver = threading.Thread(
+            target=self._receive, name="trainingsong-live", daemon=True
+        )
+        self._receiver.start()
+        return True
+
+    def _receive(self) -> None:
+        from websockets.exceptions import WebSocketException
+
+        try:
+            for message in self._connection:
+                self._handle(json.loads(message))
+        except WebSocketException as e:
+            print(f"Live session closed: {e}")
+        finally:
+            with self._answered:
+                self._pending = 0
+                self._answered.notify_all()
+
+    def _handle(self, response: Dict[str, Any]) -> None:
+        if "song_info" in response:
+            core._report(response["percentage"], response, self.verbose, self.metric)
+            core._open_link(response)
+        elif response.get("errors"):
+            print(response["errors"])
+        with self._answered:
+            self._pending = max(0, self._pending - 1)
+            self._answered.notify_all()
+
+    def update(self, input_percentage: Union[float, List[float]]) -> None:
+        "Send the latest metric. Takes the same values as ts()"
+        accuracy = (
+            input_percentage
+            if isinstance(input_percentage, (float, int))
+            else input_percentage[-1]
+        )
+        bucket = song_bucket(accuracy * 100 if accuracy < 1 else accuracy)
+        if self._connection is None and not self._fallback:
+            if not _registered():
+                # Authorising with Spotify is interactive, so ts() does it
+                core.ts(
+                    accuracy,
+                    chart=self.chart,
+                    autoplay=self.autoplay,
+                    verbose=self.verbose,
+                    metric=self.metric,
+                )
+                self._bucket = bucket
+                return
+            self._fallback = not self._connect()
+        if not self._fallback and self._send(accuracy, bucket):
+            return
+        if bucket == self._bucket:
+            # Same song as the last update, as the server would have decided
+            return
+
+        from trainingsong.background import ts_async
+
+        ts_async(
+            accuracy,
+            chart=self.chart,
+            autoplay=self.autoplay,
+            verbose=self.verbose,
+            metric=self.metric,
+        )
+        self._bucket = bucket
+
+    def _send(self, accuracy: float, bucket: str) -> bool:
+        from websockets.exceptions import WebSocketException
+
+        with self._answered:
+            if bucket != self._bucket:
+                self._pending += 1
+        try:
+            self._connection.send(json.dumps({"p": accuracy}))
+        except (OSError, WebSocketException) as e:
+            print(f"Live session lost ({e}). Using ts_async instead.")
+            self._fallback = True
+            with self._answered:
+                self._pending = 0
+            return False
+        self._bucket = bucket
+        return True
+
+    def close(self, timeout: Optional[float] = FLUSH_TIMEOUT) -> None:
+        "Wait for songs still being looked up, then close the connection"
+        if self._connection is None:
+            return
+        with self._answered:
+            self._answered.wait_for(lambda: self._pending == 0, timeout)
+        self._exit_stack.close()
+        self._receiver.join(timeout)
+        self._connection = None
+
+
+@contextmanager
+def live(
+    chart: str = "hot-100",
+    autoplay: bool = True,
+    verbose: bool = True,
+    metric: str = "accuracy",
+) -> Iterator[LiveSession]:
+    "A LiveSession that's closed, after its last song, when the block exits"
+    session = LiveSession(
+        chart=chart, autoplay=autoplay, verbose=verbose, metric=metric
+    )
+    try:
+        yield session
+    finally:
+        session.close()
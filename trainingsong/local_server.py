@@ -0,0 +1,92 @@
+"""Local server that captures the Spotify OAuth code on first use
+
+wait_for_oauth_code serves /local_callback only until Spotify redirects
+there, then shuts the server down and frees the port.
+"""
+
+import os
+import socket
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+
+from trainingsong.ts_utils import LOCAL_REDIRECT_PORT, auth_url, local_redirect_uri
+
+# Port for the callback server. 0 picks a free port, e.g. on shared machines
+# where another user may already have 8000.
+OAUTH_PORT = int(os.environ.get("TRAININGSONG_OAUTH_PORT", str(LOCAL_REDIRECT_PORT)))
+# How long to wait for the user to authorise in the browser
+OAUTH_TIMEOUT = 5 * 60
+# How long to wait for the server thread to stop once it has the code
+SHUTDOWN_TIMEOUT = 5
+
+local_app = FastAPI()
+
+
+class _Callback:
+    "The query parameters of the next callback, and an event set when it arrives"
+
+    def __init__(self):
+        self.received = threading.Event()
+        self.params: Dict[str, str] = {}
+
+
+_callback = _Callback()
+
+
+@local_app.get("/local_callback")
+async def spotify_callback(request: Request):
+    "Callback for the local server to capture the OAuth code"
+    _callback.params = dict(request.query_params)
+    _callback.received.set()
+    if "code" not in _callback.params:
+        return "Spotify authorisation failed. You can close this window."
+    return "Success! You can close this window."
+
+
+def wait_for_oauth_code(
+    open_browser: Callable[[str], Any],
+    port: int = OAUTH_PORT,
+    timeout: Optional[float] = OAUTH_TIMEOUT,
+) -> Tuple[str, str]:
+    """Serve the callback, open the Spotify authorisation page with
+    open_browser, and wait for Spotify to redirect back with the code.
+    Returns (code, redirect_uri); the redirect URI is needed to exchange the
+    code for tokens. Raises TimeoutError if no code arrives within timeout."""
+    global _callback
+    _callback = _Callback()
+
+    # Listen before starting the server so a port of 0 resolves to a real port
+    # for the redirect URI, and an early redirect waits in the backlog
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", port))
+    sock.listen()
+    redirect_uri = local_redirect_uri(sock.getsockname()[1])
+
+    server = uvicorn.Server(uvicorn.Config(local_app, log_level="warning"))
+    thread = threading.Thread(
+        target=server.run,
+        kwargs={"sockets": [sock]},
+        name="trainingsong-oauth",
+        daemon=True,
+    )
+    thread.start()
+    try:
+        open_browser(auth_url(redirect_uri))
+        if not _callback.received.wait(timeout):
+            raise TimeoutError(
+                f"No Spotify authorisation after {timeout:.0f}s. Please run ts() again."
+            )
+    finally:
+        server.should_exit = True
+        thread.join(SHUTDOWN_TIMEOUT)
+        sock.close()
+
+    code = _callback.params.get("code")
+    if not code:
+        error = _callback.params.get("error", "no code returned")
+        raise ValueError(f"Spotify authorisation failed: {error}")
+    return code, redirect_uri
@@ -0,0 +1,176 @@
+"""On-disk cache of API responses for repeated ts() calls.
+
+Sweeps call ts() many times with metrics that land in the same chart week,
+and every percentage in a chart week resolves to the same song. Responses
+are stored in a SQLite database in the user cache dir, keyed by chart and
+that canonical bucket, so repeat calls skip the network. SQLite's locking
+lets any number of processes on the machine share the file.
+
+A hit opens the song's link rather than playing it, and only the first
+time in a process for each bucket, so a sweep's repeat calls don't open a
+tab each. ts() with autoplay still calls the API, so the song plays.
+
+Set TRAININGSONG_CACHE_TTL=0 to turn the cache off.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Optional, Set, Tuple
+
+from trainingsong.server.resolve import percentage_to_date, song_bucket
+from trainingsong.ts_utils import user_cache_dir
+
+if TYPE_CHECKING:
+    import sqlite3
+
+
+CACHE_DIR = Path(os.environ.get("TRAININGSONG_CACHE_DIR") or user_cache_dir())
+# Charts don't change, but Spotify links occasionally do
+CACHE_TTL = float(os.environ.get("TRAININGSONG_CACHE_TTL", str(7 * 24 * 60 * 60)))
+# Least recently used entries beyond this are evicted
+MAX_ENTRIES = 10_000
+# How long a process waits for another one holding the write lock
+LOCK_TIMEOUT = 10
+
+_connection: Optional["sqlite3.Connection"] = None
+_connection_pid: Optional[int] = None
+_lock = threading.Lock()
+# Buckets whose link this process has opened
+_opened: Set[Tuple[str, str]] = set()
+
+
+def _connect() -> "sqlite3.Connection":
+    "This process's connection, reopened after a fork"
+    global _connection, _connection_pid
+    if _connection is None or _connection_pid != os.getpid():
+        import sqlite3
+
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(
+            str(CACHE_DIR / "responses.sqlite3"),
+            timeout=LOCK_TIMEOUT,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        # Readers don't block the writer, or each other
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+                chart TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                response TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (chart, bucket)
+            )""")
+        _connection, _connection_pid = connection, os.getpid()
+    return _connection
+
+
+def _percentage(p: float) -> float:
+    # Same normalisation as the API
+    return p * 100 if p < 1 else p
+
+
+def cache_key(p: float, chart: str) -> Tuple[str, str]:
+    "(chart, bucket): every p in a bucket resolves to the same song"
+    return chart, song_bucket(_percentage(p))
+
+
+def _for_percentage(response: Dict[str, Any], p: float) -> Dict[str, Any]:
+    "The cached response, with the details that depend on the exact p"
+    response = dict(response, percentage=p, errors="")
+    if response.get("target_date"):
+        target_date = str(percentage_to_date(p))
+        response["song_info"] = re.sub(
+            r"song [\d.]+% through", f"song {p}% through", response["song_info"]
+        ).replace(response["target_date"], target_date)
+        response["target_date"] = target_date
+    # Playback needs the API, so open the song's link instead
+    response["open_link"] = "True" if response.get("spotify_link") else ""
+    return response
+
+
+def _open_once(key: Tuple[str, str], response: Dict[str, Any]) -> Dict[str, Any]:
+    "Only the first response for a bucket opens its link. Call with _lock held."
+    if key in _opened:
+        return dict(response, open_link="")
+    if response.get("open_link"):
+        _opened.add(key)
+    return response
+
+
+def get(p: float, chart: str) -> Optional[Dict[str, Any]]:
+    "The cached response for p, or None"
+    if CACHE_TTL <= 0:
+        return None
+    import sqlite3
+
+    now = time.time()
+    key = cache_key(p, chart)
+    try:
+        with _lock:
+            connection = _connect()
+            row = connection.execute(
+                "SELECT response FROM responses"
+                " WHERE chart = ? AND bucket = ? AND stored_at > ?",
+                (*key, now - CACHE_TTL),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE chart = ? AND bucket = ?",
+                (now, *key),
+            )
+            return _open_once(key, _for_percentage(json.loads(row[0]), _percentage(p)))
+    except sqlite3.Error as e:
+        # The cache is an optimisation; never fail ts() because of it
+        print(f"Response cache unavailable: {e}")
+        return None
+
+
+def put(p: float, chart: str, response: Dict[str, Any]) -> None:
+    "Cache a successful response for p's bucket"
+    if CACHE_TTL <= 0 or not response.get("spotify_link"):
+        return
+    import sqlite3
+
+    now = time.time()
+    key = cache_key(p, chart)
+    try:
+        with _lock:
+            if response.get("open_link"):
+                # ts() has just opened it
+                _opened.add(key)
+            connection = _connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (*key, json.dumps(response), now, now),
+            )
+            connection.execute(
+                """DELETE FROM responses WHERE rowid IN (
+                    SELECT rowid FROM responses ORDER BY accessed_at DESC
+                    LIMIT -1 OFFSET ?
+                )""",
+                (MAX_ENTRIES,),
+            )
+    except sqlite3.Error as e:
+        print(f"Response cache unavailable: {e}")
+
+
+def clear() -> None:
+    "Remove every cached response"
+    with _lock:
+        _connect().execute("DELETE FROM responses")
+
+
+def close() -> None:
+    global _connection
+    with _lock:
+        _opened.clear()
+        if _connection is not None:
+            _connection.close()
+            _connection = None
@@ -1,21 +1,138 @@
 """
 Main API file.
-"""
 
-from typing import Dict, Union
+Routes import the Billboard, Spotify and database modules when they first
+need them, so a cold start only pays for FastAPI and /hello never loads
+SQLAlchemy, spotipy or billboard.py. benchmarks/cold_start.py measures this.
+"""
 
-from fastapi import FastAPI, HTTPException, Query
+import asyncio
+import json
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Dict, List, TypeVar, Union
 
-from trainingsong.server.billboard_io import get_billboard_data
-from trainingsong.server.db import database_session, get_tokens
-from trainingsong.server.hard_coded import hard_coded_song
-from trainingsong.server.spotify import (
-    create_spotify_client,
-    spotify_link,
-    start_playback,
+from fastapi import (
+    FastAPI,
+    HTTPException,
+    Query,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
 )
+from fastapi.responses import PlainTextResponse
+
+from trainingsong.server import cache, concurrency, metrics
+from trainingsong.server.logs import get_logger
+
+log = get_logger(__name__)
+
+T = TypeVar("T")
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # The database pool is opened by the first query that needs it
+    yield
+    spotify = sys.modules.get("trainingsong.server.spotify")
+    if spotify is not None:
+        await spotify.stop_refreshing()
+    db = sys.modules.get("trainingsong.server.db")
+    if db is not None:
+        await db.disconnect()
+    await concurrency.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    "Time every request and report its stages in a Server-Timing header"
+    start = time.perf_counter()
+    with metrics.request_timings() as timings:
+        response = await call_next(request)
+    elapsed = time.perf_counter() - start
+
+    # Unknown paths share a label so they can't blow up the metric's size
+    paths = {route.path for route in app.routes}
+    route = request.url.path if request.url.path in paths else "other"
+    metrics.REQUEST_SECONDS.observe(elapsed, route, str(response.status_code))
+    response.headers["Server-Timing"] = metrics.server_timing(timings, elapsed)
+    log.info(
+        "served",
+        extra={
+            "route": route,
+            "status": response.status_code,
+            "ms": round(1000 * elapsed, 1),
+        },
+    )
+    return response
+
+
+# Seconds each stage of / may take before the request gives up on it. Billboard
+# scrapes are slow; the other stages are a database read or one Spotify call.
+STAGE_TIMEOUTS = {
+    "billboard": 30.0,
+    "spotify_client": 15.0,
+    "spotify_search": 10.0,
+    "devices": 10.0,
+    "playback": 10.0,
+}
+
+
+async def _run_stage(name: str, awaitable: Awaitable[T]) -> T:
+    "Time a stage of the request, failing with a 504 if it runs past its timeout"
+    with metrics.stage(name):
+        try:
+            return await asyncio.wait_for(awaitable, STAGE_TIMEOUTS[name])
+        except asyncio.TimeoutError:
+            log.warning("stage timed out", extra={"stage": name})
+            raise HTTPException(status_code=504, detail=f"{name} timed out")
+
+
+async def _gather(*awaitables: Awaitable[Any]) -> List[Any]:
+    """Run independent stages concurrently. If one fails the others are
+    cancelled and its error is raised."""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _song_results(p: float, chart: str):
+    "The song for p: hard coded before the chart starts, otherwise the number one"
+    from trainingsong.server.billboard_io import get_billboard_data_async
+    from trainingsong.server.hard_coded import hard_coded_song
+
+    if p < 52:
+        song_results = hard_coded_song(p, chart)
+        song_results.chart = chart
+        return song_results
+    try:
+        return await _run_stage("billboard", get_billboard_data_async(p, chart))
+    except HTTPException as e:
+        if e.status_code == 504:
+            raise
+        raise HTTPException(status_code=404, detail=str(e)) from e
 
-app = FastAPI()
+
+async def _spotify_client(
+    code: Union[str, None], email: str, redirect_uri: Union[str, None]
+):
+    "The user's Spotify client, or the HTTPException that stopped it being created"
+    from trainingsong.server.spotify import SPOTIFY_REDIRECT_URI, create_spotify_client
+
+    client = create_spotify_client(code, email, redirect_uri or SPOTIFY_REDIRECT_URI)
+    try:
+        return await _run_stage("spotify_client", client)
+    except HTTPException as e:
+        return e
 
 
 @app.get("/")
@@ -25,65 +142,66 @@ async def root(
     p: float = Query(..., ge=0, le=100),
     chart: str = "hot-100",
     autoplay: bool = False,
+    redirect_uri: Union[str, None] = None,
 ) -> Dict[str, Union[str, bool, float, None]]:
-    """The main API endpoint. It takes in a percentage p, interacts with the billboard api and then redirects to the callback for the Spotify API."""
+    """The main API endpoint. It takes in a percentage p, interacts with the billboard api and then redirects to the callback for the Spotify API.
+    Stages that don't depend on each other run concurrently: the chart lookup
+    with the token lookup, and the track search with the device listing."""
+    from trainingsong.server.spotify import is_local_redirect_uri
 
-    print("Hit root endpoint")
-    print(f"p: {p}")
-    print(f"chart: {chart}")
-    print(f"autoplay: {autoplay}")
+    log.info("song requested", extra={"p": p, "chart": chart, "autoplay": autoplay})
 
     if p < 1:
         # Turn a decimal into a percentage
         p *= 100
 
-    if p < 52:
-        song_results = hard_coded_song(p, chart)
-        song_results.chart = chart
-    else:
-        try:
-            song_results = get_billboard_data(p, chart)
-        except HTTPException as e:
-            raise HTTPException(status_code=404, detail=str(e)) from e
-
-    song_results.autoplay = autoplay
-
     if not spotify_client_code and not email:
         raise HTTPException(status_code=400, detail="Missing Spotify code and email")
+    if redirect_uri is not None and not is_local_redirect_uri(redirect_uri):
+        # Clients on another port than the registered callback send theirs
+        raise HTTPException(status_code=400, detail="Invalid redirect_uri")
+
+    song_results, sp = await _gather(
+        _song_results(p, chart),
+        _spotify_client(spotify_client_code, email, redirect_uri),
+    )
+    if isinstance(sp, HTTPException):
+        return {"errors": f"{sp.detail}. Failed to create Spotify client"}
+
+    return await _play_song(sp, song_results, chart, autoplay)
+
 
-    print("Got spotify code")
+async def _play_song(sp, song_results, chart: str, autoplay: bool) -> Dict[str, Any]:
+    "Find the song on Spotify, play it if asked, and describe it for the client"
+    from trainingsong.server.spotify import spotify_link
 
+    song_results.autoplay = autoplay
     song_info = song_results.song_info
     target_date = song_results.target_date
 
-    try:
-        if spotify_client_code is None and email is None:
-            raise HTTPException(
-                status_code=400, detail="Missing Spotify code and email"
-            )
-        sp = await create_spotify_client(spotify_client_code, email)
-    except HTTPException as e:
-        return {"errors": f"str(e). Failed to created Spotify client"}
-
-    link, _name, uri = spotify_link(
-        sp, song_results.song_name, song_results.artist_name
+    search = _run_stage(
+        "spotify_search",
+        spotify_link(sp, song_results.song_name, song_results.artist_name),
     )
 
-    print(link)
-
     open_link = ""
 
     if autoplay:
-        errors = attempt_play(sp, uri)
+        (link, _name, uri), devices = await _gather(
+            search, _run_stage("devices", sp.devices())
+        )
+        errors = await attempt_play(sp, uri, devices)
         if errors:
             errors += " Failed to start playback"
             open_link = "True"
     else:
+        link, _name, uri = await search
         errors = ""
         open_link = "True"
 
-    print(f"errors: {errors}")
-    print(f"open_link: {open_link}")
+    log.info(
+        "song found", extra={"link": link, "errors": errors, "open_link": open_link}
+    )
 
     output = {
         "spotify_link": link,
@@ -100,30 +218,142 @@ async def root(
     return output
 
 
+# A live session's Spotify client is recreated once its token is this close
+# to expiring. Active users' tokens are refreshed in the background, so this
+# picks up the new one.
+LIVE_TOKEN_MARGIN = 60
+
+
+def _live_percentage(message: str) -> float:
+    'The percentage in a live update, which looks like {"p": 0.71}'
+    try:
+        p = float(json.loads(message)["p"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError('Send updates as {"p": <metric>}') from e
+    if not 0 <= p <= 100:
+        raise ValueError("p must be between 0 and 100")
+    return p * 100 if p < 1 else p
+
+
+@app.websocket("/live")
+async def live(
+    websocket: WebSocket,
+    email: str,
+    spotify_client_code: Union[str, None] = None,
+    chart: str = "hot-100",
+    autoplay: bool = False,
+    redirect_uri: Union[str, None] = None,
+):
+    """Follow a training run over one connection. The client sends each new
+    metric as {"p": 0.71} and is sent the same response as / only when the
+    metric moves into a different chart week. The Spotify client is created
+    once for the session, so other updates cost no lookups at all."""
+    from trainingsong.server.resolve import song_bucket
+    from trainingsong.server.spotify import SpotifyError, is_local_redirect_uri
+
+    if redirect_uri is not None and not is_local_redirect_uri(redirect_uri):
+        await websocket.close(code=1008, reason="Invalid redirect_uri")
+        return
+    await websocket.accept()
+    log.info("live session opened", extra={"chart": chart, "autoplay": autoplay})
+
+    sp, bucket = None, None
+    try:
+        while True:
+            try:
+                p = _live_percentage(await websocket.receive_text())
+            except ValueError as e:
+                await websocket.send_json({"errors": str(e)})
+                continue
+            if song_bucket(p) == bucket:
+                metrics.LIVE_UPDATES.inc("unchanged")
+                continue
+            metrics.LIVE_UPDATES.inc("changed")
+
+            if sp is None or (
+                sp.expires_at is not None
+                and sp.expires_at - time.time() < LIVE_TOKEN_MARGIN
+            ):
+                try:
+                    sp = await _spotify_client(spotify_client_code, email, redirect_uri)
+                except ValueError as e:
+                    sp = HTTPException(status_code=400, detail=str(e))
+                if isinstance(sp, HTTPException):
+                    await websocket.send_json(
+                        {"errors": f"{sp.detail}. Failed to create Spotify client"}
+                    )
+                    await websocket.close(code=1008)
+                    return
+                # The code has been exchanged for tokens, which are stored
+                spotify_client_code = None
+
+            try:
+                output = await _play_song(
+                    sp, await _song_results(p, chart), chart, autoplay
+                )
+            except HTTPException as e:
+                await websocket.send_json({"percentage": p, "errors": e.detail})
+                continue
+            except SpotifyError as e:
+                # e.g. a revoked token, or rate limited past the retries
+                if e.http_status == 401:
+                    # Create the client again for the next update
+                    sp = None
+                await websocket.send_json({"percentage": p, "errors": str(e)})
+                continue
+            bucket = song_bucket(p)
+            await websocket.send_json(output)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        log.info("live session closed", extra={"chart": chart})
+
+
 @app.get("/hello")
 async def hello():
     return {"hello": "world"}
 
 
+@app.get("/cache_stats")
+async def cache_stats() -> Dict[str, Dict[str, Union[int, float]]]:
+    "Hit and miss counts for the in-process caches created so far"
+    return {c.name: c.stats() for c in cache.CACHES}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics() -> str:
+    "Stage latencies, upstream outcomes and cache stats for Prometheus"
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/email_in_db")
 async def email_in_db(email: str) -> Dict[str, str]:
-    with database_session() as session:
-        result = get_tokens(email)
+    from trainingsong.server.db import get_tokens_async
+
+    result = await get_tokens_async(email)
     return {"present_in_db": ("" if result is None else "True")}
 
 
-def attempt_play(sp, uri) -> str:
-    "Attempt to play the song on Spotify"
+async def attempt_play(sp, uri, devices=None) -> str:
+    """Attempt to play the song on Spotify.
+    Pass devices if they've already been listed."""
+    from trainingsong.server.spotify import start_playback
+
     errors = ""
-    devices = sp.devices()
+    if devices is None:
+        devices = await _run_stage("devices", sp.devices())
     active_devices = devices["devices"] if devices else None
 
     if not active_devices:
         errors = "Unable to start playback because there are no active devices available. Please ensure that Spotify is active on one of your devices and try again."
     else:
         try:
-            start_playback(sp, uri)
+            await _run_stage("playback", start_playback(sp, uri))
 
+        except HTTPException as e:
+            errors = f"{e.detail}. Unable to start playback."
         except ValueError as e:
             errors = f"{str(e)}. Unable to start playback. Please ensure that Spotify is active on one of your devices and try again."
     return errors
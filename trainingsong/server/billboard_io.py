@@ -1,22 +1,58 @@
 "Billboard API calls and data processing"
 
 import datetime
-from dataclasses import dataclass
-from typing import Tuple
+from typing import TYPE_CHECKING, Optional, Tuple
 
-import billboard
 from fastapi import HTTPException
 
-from trainingsong.server.spotify import StateData
+from trainingsong.server import ratelimit
+from trainingsong.server.cache import PERSISTENT_CACHE, LRUCache
+from trainingsong.server.chart_index import Song, load_index
+from trainingsong.server.concurrency import SingleFlight, get_http_client, run_sync
+from trainingsong.server.resolve import (
+    StateData,
+    chart_week,
+    number_one_state,
+    percentage_to_date,
+)
 
+if TYPE_CHECKING:
+    import billboard
 
-@dataclass
-class Song:
-    """A dataclass to store the song name, artist name and number of weeks on the chart"""
+# billboard.py, BeautifulSoup, httpx and the database are imported when a
+# lookup first misses the chart index and cache, to keep cold starts short
 
-    artist: str
-    weeks: int
-    title: str
+BILLBOARD_CHARTS_URL = "https://www.billboard.com/charts"
+BILLBOARD_TIMEOUT = 25
+
+
+class ChartTableBackend:
+    "Persistent backend for CHART_CACHE using the chart_cache table"
+
+    def load(self, key: Tuple[str, datetime.date]) -> Optional[Song]:
+        from trainingsong.server import db
+
+        row = db.get_chart_song(*key)
+        if row is None:
+            return None
+        return Song(artist=row["artist"], weeks=row["weeks"], title=row["title"])
+
+    def save(self, key: Tuple[str, datetime.date], song) -> None:
+        from trainingsong.server import db
+
+        db.store_chart_song(*key, song.title, song.artist, song.weeks)
+
+
+# Number one songs keyed by (chart, chart week). Chart history never changes
+# so entries don't expire; the size bound keeps memory flat.
+CHART_CACHE = LRUCache(
+    maxsize=4096,
+    backend=ChartTableBackend() if PERSISTENT_CACHE else None,
+    name="chart_cache",
+)
+
+# Concurrent misses for the same (chart, chart week) share one scrape
+CHART_FLIGHTS = SingleFlight()
 
 
 def get_billboard_data(
@@ -32,46 +68,136 @@ def get_billboard_data(
     except HTTPException:
         raise HTTPException(status_code=404, detail="No chart data found")
 
-    song_name = number_one_song.title
-    artist_name = number_one_song.artist
+    return number_one_state(percentage, chart, number_one_song, target_date)
 
-    song_info = f"""The Number 1 song {percentage}% through the 1900s on the {chart} chart was {song_name} by {artist_name}. \nThe date was {target_date} and the song was on the chart for {number_one_song.weeks} weeks."""
-    result = StateData(
-        song_name=song_name,
-        artist_name=artist_name,
-        autoplay=None,
-        song_info=song_info,
-        target_date=str(target_date),
-        percentage=percentage,
-        chart=chart,
-    )
-    return result
+
+async def get_billboard_data_async(
+    percentage: float,
+    chart: str = "hot-100",
+) -> StateData:
+    """Non-blocking get_billboard_data for the API's event loop"""
+    if percentage > 100 or percentage < 0:
+        raise ValueError("Please enter a percentage between 0 and 100")
+
+    try:
+        number_one_song, target_date = await get_number_one_song_async(
+            percentage, chart
+        )
+    except HTTPException:
+        raise HTTPException(status_code=404, detail="No chart data found")
+
+    return number_one_state(percentage, chart, number_one_song, target_date)
+
+
+def _indexed_number_one(chart: str, target_date: datetime.date):
+    index = load_index(chart)
+    if index is not None:
+        found = index.lookup(target_date)
+        if found is not None:
+            return found[0]
+    return None
 
 
 def get_number_one_song(
     percentage: float, chart: str = "hot-100"
 ) -> Tuple[Song, datetime.date]:
-    """Get the number one song on the chosen Billboard chart on date that is percentage% through the 1900s"""
-    target_year = int(percentage)
-
-    # Calculate the target date based on the fractional part of the percentage
-    fractional_percentage = percentage % 1
-    days_in_year = (
-        366
-        if target_year % 4 == 0 and (target_year % 100 != 0 or target_year % 400 == 0)
-        else 365
-    )
-    target_day = int(days_in_year * fractional_percentage)
-
-    target_date = datetime.date(1900 + target_year, 1, 1) + datetime.timedelta(
-        days=target_day
-    )
-
-    chart_output = billboard.ChartData(chart, date=target_date)
-
-    if chart_output:
-        number_one_song = chart_output[0]
-    else:
-        raise HTTPException(status_code=404, detail="No chart data found")
+    """Get the number one song on the chosen Billboard chart on date that is percentage% through the 1900s.
+    Uses the local chart index when it covers the date, then the chart week cache, and only then scrapes billboard.com.
+    """
+    target_date = percentage_to_date(percentage)
+
+    number_one_song = _indexed_number_one(chart, target_date)
+    if number_one_song is not None:
+        return number_one_song, target_date
+
+    week = chart_week(target_date)
+    key = (chart, week)
+    number_one_song = CHART_CACHE.get(key)
+    if number_one_song is None:
+        import billboard
+
+        # Fetch the week rather than target_date, so everything stored under
+        # the key is the same chart. Before 1962 charts are dated on Mondays,
+        # and a week's days would otherwise straddle two of them.
+        chart_output = billboard.ChartData(chart, date=str(week))
+
+        if chart_output:
+            number_one_song = chart_output[0]
+        else:
+            raise HTTPException(status_code=404, detail="No chart data found")
+
+        CHART_CACHE.set(key, number_one_song)
 
     return number_one_song, target_date
+
+
+async def get_number_one_song_async(
+    percentage: float, chart: str = "hot-100"
+) -> Tuple[Song, datetime.date]:
+    """Non-blocking get_number_one_song: scrapes billboard.com over the shared
+    async HTTP client instead of billboard.py's blocking requests session."""
+    target_date = percentage_to_date(percentage)
+
+    number_one_song = _indexed_number_one(chart, target_date)
+    if number_one_song is not None:
+        return number_one_song, target_date
+
+    week = chart_week(target_date)
+    key = (chart, week)
+    number_one_song = await CHART_CACHE.aget(key)
+    if number_one_song is None:
+
+        async def fetch_number_one():
+            # The week, not target_date, as in get_number_one_song
+            chart_output = await fetch_chart(chart, week)
+
+            if not chart_output:
+                raise HTTPException(status_code=404, detail="No chart data found")
+
+            await CHART_CACHE.aset(key, chart_output[0])
+            return chart_output[0]
+
+        number_one_song = await CHART_FLIGHTS.do(key, fetch_number_one)
+
+    return number_one_song, target_date
+
+
+async def fetch_chart(chart: str, target_date: datetime.date) -> "billboard.ChartData":
+    """Async equivalent of billboard.ChartData(chart, date=target_date)"""
+    import billboard
+    import httpx
+
+    chart_data = billboard.ChartData(chart, date=str(target_date), fetch=False)
+
+    try:
+        response = await ratelimit.send(
+            "billboard",
+            lambda: get_http_client().get(
+                f"{BILLBOARD_CHARTS_URL}/{chart}/{target_date}",
+                timeout=BILLBOARD_TIMEOUT,
+                follow_redirects=True,
+            ),
+        )
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Billboard request failed: {e}")
+    if response.status_code == 404:
+        raise HTTPException(status_code=404, detail="No chart data found")
+    if response.is_error:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Billboard request failed with status {response.status_code}",
+        )
+
+    # Parsing the page is CPU bound, so keep it off the event loop
+    await run_sync(_parse_chart_page, chart_data, response.text)
+    return chart_data
+
+
+def _parse_chart_page(chart_data: "billboard.ChartData", html: str) -> None:
+    """Fill chart_data from a chart page. The one place that relies on
+    billboard.py's internals, which is why pyproject pins its version; the
+    tests check it against recorded pages."""
+    from bs4 import BeautifulSoup
+
+    # billboard.py only exposes its parser through the blocking fetchEntries
+    chart_data._parsePage(BeautifulSoup(html, "html.parser"))
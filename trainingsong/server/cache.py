@@ -0,0 +1,170 @@
+"""In-process caches for upstream lookups, optionally backed by a database table."""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from trainingsong.server.concurrency import run_sync
+from trainingsong.server.logs import get_logger
+
+log = get_logger(__name__)
+
+# Set PERSISTENT_CACHE=1 to back the chart cache with the chart_cache table
+PERSISTENT_CACHE = os.environ.get("PERSISTENT_CACHE") == "1"
+
+# Every cache created so far, for reporting stats
+CACHES: List["LRUCache"] = []
+
+
+class Expiring(NamedTuple):
+    "A backend value that should only be kept in process for ttl more seconds"
+
+    value: Any
+    ttl: float
+
+
+class LRUCache:
+    """A size-bounded LRU cache with optional expiry and a persistent backend.
+
+    The backend is any object with load(key) -> Optional[value] and
+    save(key, value) methods. It is consulted on an in-process miss and
+    written through on set. Backend failures are logged and treated as misses
+    so a database outage never fails a request.
+
+    ttl_for picks a per-value expiry, e.g. to keep negative results for less
+    time than positive ones. It applies to set() calls without an explicit
+    ttl and to values loaded from the backend, unless load returns an
+    Expiring with the time the stored value has left."""
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: Optional[float] = None,
+        backend: Any = None,
+        name: str = "cache",
+        ttl_for: Optional[Callable[[Any], Optional[float]]] = None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.ttl_for = ttl_for
+        self.backend = backend
+        self.name = name
+        self._data: "OrderedDict[Hashable, Tuple[Any, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        CACHES.append(self)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._get_local(key) is not None
+
+    def _get_local(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def _set_local(self, key: Hashable, value: Any, ttl: Optional[float]) -> None:
+        if ttl is None and self.ttl_for is not None:
+            ttl = self.ttl_for(value)
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        "Return the cached value for key, or None on a miss"
+        value = self._get_local(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        if self.backend is not None:
+            try:
+                value = self.backend.load(key)
+            except Exception as e:  # pylint: disable=broad-except
+                log.warning(
+                    "cache backend load failed",
+                    extra={"cache": self.name, "error": str(e)},
+                )
+                value = None
+            if value is not None:
+                ttl = None
+                if isinstance(value, Expiring):
+                    value, ttl = value
+                self.backend_hits += 1
+                self._set_local(key, value, ttl)
+                return value
+
+        self.misses += 1
+        return None
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        ttl: Optional[float] = None,
+        persist: bool = True,
+    ) -> None:
+        "Cache value under key, writing it through to the backend if there is one"
+        self._set_local(key, value, ttl)
+        if persist and self.backend is not None:
+            try:
+                self.backend.save(key, value)
+            except Exception as e:  # pylint: disable=broad-except
+                log.warning(
+                    "cache backend save failed",
+                    extra={"cache": self.name, "error": str(e)},
+                )
+
+    async def aget(self, key: Hashable) -> Optional[Any]:
+        "get() that runs backend I/O on the thread pool instead of the event loop"
+        if self.backend is None:
+            return self.get(key)
+        return await run_sync(self.get, key)
+
+    async def aset(
+        self, key: Hashable, value: Any, ttl: Optional[float] = None
+    ) -> None:
+        "set() that runs backend I/O on the thread pool instead of the event loop"
+        if self.backend is None:
+            return self.set(key, value, ttl)
+        return await run_sync(self.set, key, value, ttl)
+
+    def delete(self, key: Hashable) -> None:
+        "Drop key from the in-process cache"
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        "Drop all in-process entries and reset the counters"
+        with self._lock:
+            self._data.clear()
+        self.hits = self.backend_hits = self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.backend_hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "backend_hits": self.backend_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.backend_hits) / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,206 @@
+"""Compact on-disk index of chart number ones, read through mmap.
+
+File layout (all integers little-endian uint32):
+
+    header   MAGIC, VERSION, N
+    weeks    N chart-week dates as proleptic ordinals, sorted ascending
+    offsets  N + 1 offsets into the string table
+    strings  N utf-8 records of the form "title\\0artist\\0weeks"
+
+Lookups bisect the weeks array in place, so opening an index costs a single
+mmap and each lookup only decodes the one record it returns.
+"""
+
+import csv
+import datetime
+import mmap
+import os
+import struct
+import sys
+from bisect import bisect_left
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+MAGIC = b"TSCI"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+UINT = struct.Struct("<I")
+SEPARATOR = "\0"
+
+# The indexes the package ships, which `ingest --index` writes
+CHART_INDEX_DIR = Path(
+    os.environ.get("CHART_INDEX_DIR", Path(__file__).parent.parent / "data")
+)
+
+
+@dataclass
+class Song:
+    """A dataclass to store the song name, artist name and number of weeks on the chart"""
+
+    artist: str
+    weeks: int
+    title: str
+
+
+class _UIntArray:
+    "Read-only sequence view over a packed uint32 array, usable with bisect"
+
+    def __init__(self, buffer, start: int, length: int):
+        self._buffer = buffer
+        self._start = start
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, i: int) -> int:
+        if not 0 <= i < self._length:
+            raise IndexError(i)
+        return UINT.unpack_from(self._buffer, self._start + i * UINT.size)[0]
+
+
+class ChartIndex:
+    """A memory-mapped index of the number one song for each week of a chart"""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f"{self.path} is not a version {VERSION} chart index")
+
+        weeks_start = HEADER.size
+        offsets_start = weeks_start + count * UINT.size
+        self._strings_start = offsets_start + (count + 1) * UINT.size
+        self._weeks = _UIntArray(self._mmap, weeks_start, count)
+        self._offsets = _UIntArray(self._mmap, offsets_start, count + 1)
+
+    def __len__(self) -> int:
+        return len(self._weeks)
+
+    def week(self, i: int) -> datetime.date:
+        "Date of the i-th chart week"
+        return datetime.date.fromordinal(self._weeks[i])
+
+    def song(self, i: int) -> Song:
+        "Number one song of the i-th chart week"
+        start = self._strings_start + self._offsets[i]
+        end = self._strings_start + self._offsets[i + 1]
+        title, artist, weeks = self._mmap[start:end].decode().split(SEPARATOR)
+        return Song(artist=artist, weeks=int(weeks), title=title)
+
+    def week_index(self, target_date: datetime.date) -> Optional[int]:
+        """Position of the chart week that covers target_date.
+
+        Like billboard.com, dates between chart weeks round up to the next
+        published week, within a week. Dates further from an indexed week,
+        outside the index or in a gap in it, return None since the index
+        can't know which song was number one then."""
+        ordinal = target_date.toordinal()
+        i = bisect_left(self._weeks, ordinal)
+        if i == len(self) or self._weeks[i] - ordinal >= 7:
+            return None
+        return i
+
+    def lookup(
+        self, target_date: datetime.date
+    ) -> Optional[Tuple[Song, datetime.date]]:
+        "Return (number one song, chart week) for target_date, or None if not covered"
+        i = self.week_index(target_date)
+        if i is None:
+            return None
+        return self.song(i), self.week(i)
+
+    def close(self) -> None:
+        self._mmap.close()
+
+
+def write_index(
+    path: Union[str, Path], rows: Iterable[Tuple[datetime.date, Song]]
+) -> int:
+    """Write a chart index from (chart week, number one song) rows.
+    Rows may be in any order; the last row wins for a duplicated week.
+    Returns the number of weeks written."""
+    by_week = {week.toordinal(): song for week, song in rows}
+    weeks = sorted(by_week)
+
+    records = []
+    offsets = [0]
+    for week in weeks:
+        song = by_week[week]
+        record = SEPARATOR.join((song.title, song.artist, str(int(song.weeks))))
+        records.append(record.encode())
+        offsets.append(offsets[-1] + len(records[-1]))
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(weeks)))
+        f.write(struct.pack(f"<{len(weeks)}I", *weeks))
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        f.write(b"".join(records))
+    # Swap atomically so readers never map a half-written file
+    os.replace(tmp_path, path)
+    return len(weeks)
+
+
+def index_path(chart: str, directory: Optional[Union[str, Path]] = None) -> Path:
+    return Path(directory or CHART_INDEX_DIR) / f"{chart}.idx"
+
+
+# Open indexes by path, with the file version they map
+_INDEXES: Dict[Path, Tuple[Tuple[int, int, int], ChartIndex]] = {}
+
+
+def load_index(
+    chart: str, directory: Optional[Union[str, Path]] = None
+) -> Optional[ChartIndex]:
+    """The index for a chart, or None if there isn't one. Each file is mapped
+    once, and mapped again if it's rebuilt while the process runs."""
+    path = index_path(chart, directory)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        _INDEXES.pop(path, None)
+        return None
+    version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _INDEXES.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    # A replaced index's old mapping stays valid for lookups already holding
+    # it, and is unmapped once they drop it
+    index = ChartIndex(path)
+    _INDEXES[path] = (version, index)
+    return index
+
+
+def clear_indexes() -> None:
+    "Forget the open indexes, so the next lookups map the files again"
+    _INDEXES.clear()
+
+
+def read_csv(path: Union[str, Path]) -> Iterable[Tuple[datetime.date, Song]]:
+    "Read (week, song) rows from a CSV with date,title,artist,weeks columns"
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            yield datetime.date.fromisoformat(row["date"]), Song(
+                artist=row["artist"], weeks=int(row["weeks"]), title=row["title"]
+            )
+
+
+def main():
+    "Usage: python -m trainingsong.server.chart_index <chart> <chart.csv>"
+    if len(sys.argv) != 3:
+        return print(main.__doc__)
+    chart, csv_path = sys.argv[1:]
+    count = write_index(index_path(chart), read_csv(csv_path))
+    print(f"Wrote {count} weeks to {index_path(chart)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Shared async HTTP client, a bounded thread pool for blocking calls, and
+single-flight deduplication of concurrent upstream lookups.
+
+All are bound to the running event loop. uvicorn keeps one loop per worker,
+but some serverless runtimes and the test client start a fresh loop per
+request, and pooled connections and tasks can't cross loops.
+"""
+
+import asyncio
+import os
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from anyio import CapacityLimiter, to_thread
+
+if TYPE_CHECKING:
+    import httpx
+
+T = TypeVar("T")
+
+# Max blocking calls (DB, OAuth, HTML parsing) running at once per worker
+THREAD_POOL_SIZE = int(os.environ.get("THREAD_POOL_SIZE", "8"))
+HTTP_TIMEOUT = 10.0
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE = 20
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_client: Optional["httpx.AsyncClient"] = None
+_limiter: Optional[CapacityLimiter] = None
+
+
+def _bind_to_running_loop() -> None:
+    global _loop, _client, _limiter
+    loop = asyncio.get_running_loop()
+    if loop is not _loop:
+        _loop = loop
+        _client = None
+        _limiter = None
+
+
+def get_http_client() -> "httpx.AsyncClient":
+    "The pooled httpx client for the running event loop"
+    global _client
+    _bind_to_running_loop()
+    if _client is None or _client.is_closed:
+        import httpx
+
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            ),
+        )
+    return _client
+
+
+async def run_sync(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    "Run a blocking function on the bounded thread pool without blocking the loop"
+    global _limiter
+    _bind_to_running_loop()
+    if _limiter is None:
+        _limiter = CapacityLimiter(THREAD_POOL_SIZE)
+    return await to_thread.run_sync(partial(func, *args, **kwargs), limiter=_limiter)
+
+
+async def aclose() -> None:
+    "Close the pooled client, e.g. at app shutdown"
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+class SingleFlight:
+    """Shares one in-flight call per key between concurrent callers.
+
+    The first caller for a key starts the call; callers that arrive while it
+    is running wait for the same result or error instead of repeating it.
+    The call runs as its own task, so a caller timing out or being cancelled
+    doesn't cancel it for the others."""
+
+    def __init__(self):
+        self._calls: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        loop = asyncio.get_running_loop()
+        call_key = (loop, key)
+        task = self._calls.get(call_key)
+        if task is None:
+            task = loop.create_task(func())
+            self._calls[call_key] = task
+            task.add_done_callback(lambda t: self._finished(call_key, t))
+        return await asyncio.shield(task)
+
+    def _finished(self, call_key, task: asyncio.Task) -> None:
+        self._calls.pop(call_key, None)
+        if not task.cancelled():
+            # Mark the error retrieved in case every caller has gone
+            task.exception()
@@ -1,14 +1,37 @@
-"""Database module for storing and retrieving user tokens from database."""
+"""Database module for storing and retrieving user tokens from database.
+
+The sync engine and the async pool are created on first use rather than at
+import, so serverless cold starts and routes that don't touch the database
+don't pay for connecting.
+"""
+
 import os
+import time
 from contextlib import contextmanager
-from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
 
 import sqlalchemy
 from dotenv import load_dotenv
-from sqlalchemy import BigInteger, Column, String, Table, create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    Date,
+    Integer,
+    String,
+    Table,
+    create_engine,
+)
+from sqlalchemy.dialects import postgresql, sqlite
 
 from trainingsong.db_utils import decrypt, encrypt
+from trainingsong.server.cache import LRUCache
+from trainingsong.server.concurrency import run_sync
+from trainingsong.server.logs import get_logger
+
+if TYPE_CHECKING:
+    import databases
+
+log = get_logger(__name__)
 
 # If running locally, load environment variables from .env
 if os.environ.get("VERCEL") != "1":
@@ -19,8 +42,49 @@ if DATABASE_URL is None:
     # raise ValueError("DATABASE_URL environment variable not set or empty")
     DATABASE_URL = "sqlite:///test.db"
 
-engine = create_engine(DATABASE_URL, future=True)
-Session = sessionmaker(bind=engine)
+# Serverless instances are short lived and run few requests at once, so keep
+# the pool small and drop connections the server may have closed while idle
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "2"))
+POOL_MAX_OVERFLOW = int(os.environ.get("DB_POOL_MAX_OVERFLOW", "3"))
+POOL_RECYCLE = 5 * 60
+
+
+def _engine_options(url):
+    options = {"pool_pre_ping": True, "pool_recycle": POOL_RECYCLE}
+    if not url.startswith("sqlite"):
+        # SQLite doesn't use a sized QueuePool
+        options.update(pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW)
+    return options
+
+
+_engine = None
+
+
+def get_engine():
+    "The sync engine, created on first use"
+    global _engine
+    if _engine is None:
+        _engine = create_engine(
+            DATABASE_URL, future=True, **_engine_options(DATABASE_URL)
+        )
+    return _engine
+
+
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Async connection pool used by the API, opened by connect() on first use.
+# None when it isn't open; if it can't be opened the *_async functions fall
+# back to the sync engine on the thread pool, and connecting is tried again
+# after a backoff, doubling per failure up to CONNECT_RETRY_MAX seconds.
+database: Optional["databases.Database"] = None
+CONNECT_RETRY_MIN = 5
+CONNECT_RETRY_MAX = 5 * 60
+_connect_failures = 0
+_connect_retry_at = 0.0
 
 metadata = sqlalchemy.MetaData()
 tokens = Table(
@@ -32,33 +96,135 @@ tokens = Table(
     Column("expires_at", BigInteger),
 )
 
+# Number one song per (chart, chart week). Billboard history never changes so
+# rows are written once and never expire.
+chart_cache = Table(
+    "chart_cache",
+    metadata,
+    Column("chart", String, primary_key=True),
+    Column("week", Date, primary_key=True),
+    Column("title", String),
+    Column("artist", String),
+    Column("weeks", Integer),
+)
 
-def store_tokens(email, access_token, refresh_token, expires_at):
-    with engine.connect() as connection:
-        query = tokens.insert().values(
-            email=email,
-            access_token=encrypt(access_token),
-            refresh_token=encrypt(refresh_token),
-            expires_at=expires_at,
+# How far each chart has been ingested with no gaps, so backfills resume from
+# there (see ingest.py)
+chart_ingest = Table(
+    "chart_ingest",
+    metadata,
+    Column("chart", String, primary_key=True),
+    Column("done_through", Date),
+    Column("updated_at", BigInteger),
+)
+
+# Spotify search results per (song, artist). A NULL uri records that the
+# search found nothing, as of cached_at.
+track_cache = Table(
+    "track_cache",
+    metadata,
+    Column("song_name", String, primary_key=True),
+    Column("artist_name", String, primary_key=True),
+    Column("link", String),
+    Column("name", String),
+    Column("uri", String),
+    Column("cached_at", BigInteger),
+)
+
+# Upper bound on how long a decrypted token record is trusted before it is
+# re-read, so tokens refreshed by another worker are picked up
+TOKEN_CACHE_TTL = 5 * 60
+
+
+def _token_ttl(record):
+    "Never keep a record past its access token's expiry"
+    return max(0.0, min(TOKEN_CACHE_TTL, record["expires_at"] - time.time()))
+
+
+# Decrypted token records keyed by email, kept current by the write functions
+TOKEN_CACHE = LRUCache(maxsize=1024, name="token_cache", ttl_for=_token_ttl)
+
+
+def _cache_tokens(email, access_token, refresh_token, expires_at):
+    TOKEN_CACHE.set(
+        email,
+        {
+            "email": email,
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "expires_at": expires_at,
+        },
+    )
+
+
+@contextmanager
+def _connection(connection=None):
+    "Reuse the caller's connection, or run a transaction on a pooled one"
+    if connection is not None:
+        yield connection
+    else:
+        with get_engine().begin() as connection:
+            yield connection
+
+
+def _insert(table, dialect=None):
+    "An INSERT that supports ON CONFLICT for the database's dialect"
+    dialect = dialect or sqlalchemy.engine.make_url(DATABASE_URL).get_backend_name()
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    return insert(table)
+
+
+def _upsert(table, keys, update=True, dialect=None, **values):
+    """A single INSERT ... ON CONFLICT statement keyed on the keys columns.
+    With update=False an existing row is left as it is."""
+    query = _insert(table, dialect).values(**values)
+    if not update:
+        return query.on_conflict_do_nothing(index_elements=keys)
+    return query.on_conflict_do_update(
+        index_elements=keys,
+        set_={column: value for column, value in values.items() if column not in keys},
+    )
+
+
+def _tokens_upsert(email, access_token, refresh_token, expires_at, dialect=None):
+    return _upsert(
+        tokens,
+        ["email"],
+        dialect=dialect,
+        email=email,
+        access_token=encrypt(access_token),
+        refresh_token=encrypt(refresh_token),
+        expires_at=expires_at,
+    )
+
+
+def store_tokens(email, access_token, refresh_token, expires_at, connection=None):
+    "Store a user's tokens, replacing any they already have"
+    with _connection(connection) as connection:
+        connection.execute(
+            _tokens_upsert(email, access_token, refresh_token, expires_at)
         )
-        connection.execute(query)
-        connection.commit()
+    _cache_tokens(email, access_token, refresh_token, expires_at)
 
 
-# @lru_cache(maxsize=1)
-def get_tokens(email):
-    with engine.connect() as connection:
+def get_tokens(email, connection=None):
+    cached = TOKEN_CACHE.get(email)
+    if cached is not None:
+        return dict(cached)
+
+    with _connection(connection) as connection:
         query = tokens.select().where(tokens.c.email == email)
         result = connection.execute(query).fetchone()
         if result:
-            result = dict(result)
+            result = dict(result._mapping)
             result["access_token"] = decrypt(result["access_token"])
             result["refresh_token"] = decrypt(result["refresh_token"])
+            TOKEN_CACHE.set(email, dict(result))
         return result
 
 
-def update_tokens(email, access_token, refresh_token, expires_at):
-    with engine.connect() as connection:
+def update_tokens(email, access_token, refresh_token, expires_at, connection=None):
+    with _connection(connection) as connection:
         query = (
             tokens.update()
             .where(tokens.c.email == email)
@@ -68,15 +234,293 @@ def update_tokens(email, access_token, refresh_token, expires_at):
                 expires_at=expires_at,
             )
         )
-        execute = connection.execute(query)
-        connection.commit()
+        connection.execute(query)
+    _cache_tokens(email, access_token, refresh_token, expires_at)
 
 
-def delete_tokens(email):
-    with engine.connect() as connection:
+def delete_tokens(email, connection=None):
+    with _connection(connection) as connection:
         query = tokens.delete().where(tokens.c.email == email)
         connection.execute(query)
-        connection.commit()
+    TOKEN_CACHE.delete(email)
+
+
+async def connect():
+    "Open the async connection pool shared by the *_async functions"
+    global database, _connect_failures, _connect_retry_at
+    if database is not None and database.is_connected:
+        return
+    options = {}
+    if DATABASE_URL.startswith("postgresql"):
+        options.update(min_size=1, max_size=POOL_SIZE + POOL_MAX_OVERFLOW)
+    try:
+        import databases
+
+        pool = databases.Database(DATABASE_URL, **options)
+        await pool.connect()
+    except Exception as e:  # pylint: disable=broad-except
+        # e.g. the database restarting, or SQLite without an async driver
+        _connect_failures += 1
+        retry_in = min(
+            CONNECT_RETRY_MIN * 2 ** (_connect_failures - 1), CONNECT_RETRY_MAX
+        )
+        _connect_retry_at = time.monotonic() + retry_in
+        log.warning(
+            "async database unavailable, using the sync engine",
+            extra={"error": str(e), "retry_in": retry_in},
+        )
+        return
+    _connect_failures = 0
+    if database is not None and database.is_connected:
+        # Another request opened a pool while we were connecting
+        await pool.disconnect()
+    else:
+        database = pool
+
+
+async def disconnect():
+    global database
+    if database is not None:
+        await database.disconnect()
+        database = None
+
+
+async def _async_ready():
+    "Whether the async pool is usable, opening it on first use"
+    if database is None and time.monotonic() >= _connect_retry_at:
+        await connect()
+    return database is not None and database.is_connected
+
+
+async def store_tokens_async(email, access_token, refresh_token, expires_at):
+    if not await _async_ready():
+        return await run_sync(
+            store_tokens, email, access_token, refresh_token, expires_at
+        )
+    query = _tokens_upsert(
+        email, access_token, refresh_token, expires_at, dialect=database.url.dialect
+    )
+    await database.execute(query)
+    _cache_tokens(email, access_token, refresh_token, expires_at)
+
+
+async def get_tokens_async(email):
+    cached = TOKEN_CACHE.get(email)
+    if cached is not None:
+        return dict(cached)
+    if not await _async_ready():
+        return await run_sync(get_tokens, email)
+
+    query = tokens.select().where(tokens.c.email == email)
+    result = await database.fetch_one(query)
+    if result:
+        result = dict(result._mapping)
+        result["access_token"] = decrypt(result["access_token"])
+        result["refresh_token"] = decrypt(result["refresh_token"])
+        TOKEN_CACHE.set(email, dict(result))
+    return result
+
+
+async def update_tokens_async(email, access_token, refresh_token, expires_at):
+    if not await _async_ready():
+        return await run_sync(
+            update_tokens, email, access_token, refresh_token, expires_at
+        )
+    query = (
+        tokens.update()
+        .where(tokens.c.email == email)
+        .values(
+            access_token=encrypt(access_token),
+            refresh_token=encrypt(refresh_token),
+            expires_at=expires_at,
+        )
+    )
+    await database.execute(query)
+    _cache_tokens(email, access_token, refresh_token, expires_at)
+
+
+async def delete_tokens_async(email):
+    if not await _async_ready():
+        return await run_sync(delete_tokens, email)
+    query = tokens.delete().where(tokens.c.email == email)
+    await database.execute(query)
+    TOKEN_CACHE.delete(email)
+
+
+def get_chart_song(chart, week):
+    with _connection() as connection:
+        query = chart_cache.select().where(
+            (chart_cache.c.chart == chart) & (chart_cache.c.week == week)
+        )
+        result = connection.execute(query).fetchone()
+        return dict(result._mapping) if result else None
+
+
+def store_chart_song(chart, week, title, artist, weeks):
+    with _connection() as connection:
+        # Another request may have stored the same week first
+        query = _upsert(
+            chart_cache,
+            ["chart", "week"],
+            update=False,
+            chart=chart,
+            week=week,
+            title=title,
+            artist=artist,
+            weeks=weeks,
+        )
+        connection.execute(query)
+
+
+def get_chart_weeks(chart, start, end):
+    "The weeks between start and end, inclusive, stored for a chart"
+    with _connection() as connection:
+        query = sqlalchemy.select(chart_cache.c.week).where(
+            (chart_cache.c.chart == chart)
+            & (chart_cache.c.week >= start)
+            & (chart_cache.c.week <= end)
+        )
+        return {row.week for row in connection.execute(query)}
+
+
+def get_chart_history(chart):
+    "Every stored week of a chart, as (week, title, artist, weeks) in week order"
+    with _connection() as connection:
+        query = (
+            sqlalchemy.select(
+                chart_cache.c.week,
+                chart_cache.c.title,
+                chart_cache.c.artist,
+                chart_cache.c.weeks,
+            )
+            .where(chart_cache.c.chart == chart)
+            .order_by(chart_cache.c.week)
+        )
+        return [tuple(row) for row in connection.execute(query)]
+
+
+def get_ingest_checkpoint(chart):
+    "The week a chart has been ingested through with no gaps, or None"
+    with _connection() as connection:
+        query = sqlalchemy.select(chart_ingest.c.done_through).where(
+            chart_ingest.c.chart == chart
+        )
+        return connection.execute(query).scalar()
+
+
+def store_chart_batch(chart, rows, done_through=None):
+    """Store (week, title, artist, weeks) rows for a chart in one statement,
+    and move its checkpoint to done_through in the same transaction"""
+    with _connection() as connection:
+        if rows:
+            query = _insert(chart_cache).on_conflict_do_nothing(
+                index_elements=["chart", "week"]
+            )
+            connection.execute(
+                query,
+                [
+                    {
+                        "chart": chart,
+                        "week": week,
+                        "title": title,
+                        "artist": artist,
+                        "weeks": weeks,
+                    }
+                    for week, title, artist, weeks in rows
+                ],
+            )
+        if done_through is not None:
+            connection.execute(
+                _upsert(
+                    chart_ingest,
+                    ["chart"],
+                    chart=chart,
+                    done_through=done_through,
+                    updated_at=int(time.time()),
+                )
+            )
+
+
+def get_track(song_name, artist_name):
+    with _connection() as connection:
+        query = track_cache.select().where(
+            (track_cache.c.song_name == song_name)
+            & (track_cache.c.artist_name == artist_name)
+        )
+        result = connection.execute(query).fetchone()
+        return dict(result._mapping) if result else None
+
+
+def store_track(song_name, artist_name, link, name, uri):
+    "Store a search result, replacing any earlier one for the same track"
+    with _connection() as connection:
+        query = _upsert(
+            track_cache,
+            ["song_name", "artist_name"],
+            song_name=song_name,
+            artist_name=artist_name,
+            link=link,
+            name=name,
+            uri=uri,
+            cached_at=int(time.time()),
+        )
+        connection.execute(query)
+
+
+def store_tracks(rows):
+    """Store (song_name, artist_name, link, name, uri) search results in one
+    statement, replacing earlier ones for the same tracks"""
+    query = _insert(track_cache)
+    query = query.on_conflict_do_update(
+        index_elements=["song_name", "artist_name"],
+        set_={
+            column: query.excluded[column]
+            for column in ("link", "name", "uri", "cached_at")
+        },
+    )
+    cached_at = int(time.time())
+    with _connection() as connection:
+        connection.execute(
+            query,
+            [
+                {
+                    "song_name": song_name,
+                    "artist_name": artist_name,
+                    "link": link,
+                    "name": name,
+                    "uri": uri,
+                    "cached_at": cached_at,
+                }
+                for song_name, artist_name, link, name, uri in rows
+            ],
+        )
+
+
+def get_track_ages():
+    "When each stored track was searched for, and whether it was found"
+    with _connection() as connection:
+        query = sqlalchemy.select(
+            track_cache.c.song_name,
+            track_cache.c.artist_name,
+            track_cache.c.uri,
+            track_cache.c.cached_at,
+        )
+        return {
+            (row.song_name, row.artist_name): (row.uri is not None, row.cached_at)
+            for row in connection.execute(query)
+        }
+
+
+def has_table(name):
+    "Whether the database has the named table"
+    return sqlalchemy.inspect(get_engine()).has_table(name)
+
+
+def get_chart_songs():
+    "Every distinct (title, artist) stored in chart_cache"
+    with _connection() as connection:
+        query = sqlalchemy.select(chart_cache.c.title, chart_cache.c.artist).distinct()
+        return {(row.title, row.artist) for row in connection.execute(query)}
 
 
 def create():
@@ -84,30 +528,36 @@ def create():
     if check != "y":
         return print("Aborting")
 
-    with engine.connect() as connection:
+    with get_engine().begin() as connection:
         connection.execute(sqlalchemy.text("DROP TABLE IF EXISTS tokens"))
-    metadata.create_all(engine)
+    metadata.create_all(get_engine())
     print("Created fresh database")
 
 
 @contextmanager
 def database_session():
-    session = Session()
-    full_db = None
-    try:
-        yield session
-        session.commit()
-        full_db = session.query(tokens).limit(5).all()
-    except:
-        session.rollback()
-        raise
-    finally:
-        session.close()
-        # print(full_db)
-
-
-def main():
-    pass
+    """One pooled connection and transaction for a unit of work.
+    Pass the yielded connection to the token functions to share it;
+    the transaction commits on success and rolls back on error."""
+    with get_engine().begin() as connection:
+        yield connection
+
+
+def create_cache_tables():
+    "Create the cache tables that don't exist yet, leaving tokens untouched"
+    metadata.create_all(
+        get_engine(), tables=[chart_cache, chart_ingest, track_cache], checkfirst=True
+    )
+    print("Created cache tables")
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the database schema")
+    parser.add_argument("command", choices=["create-cache-tables"])
+    parser.parse_args(argv)
+    create_cache_tables()
 
 
 if __name__ == "__main__":
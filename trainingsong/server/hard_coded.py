@@ -1,4 +1,4 @@
-from trainingsong.server.spotify import StateData
+from trainingsong.server.resolve import StateData
 
 
 def hard_coded_song(percentage, chart):
@@ -8,8 +8,7 @@ def hard_coded_song(percentage, chart):
         song_name = HARD_CODED_DICT[p][0]
         artist_name = HARD_CODED_DICT[p][1]
     else:
-        song_name = "Never Gonna Give You Up"
-        artist_name = "Rick Astley"
+        song_name, artist_name = FALLBACK_SONG
 
     return StateData(
         song_name=song_name,
@@ -36,4 +35,7 @@ HARD_CODED_DICT = {
     42: ["42", "Coldplay"],
 }
 
+# For percentages with no song of their own
+FALLBACK_SONG = ["Never Gonna Give You Up", "Rick Astley"]
+
 CHART_START_YEAR = 1952
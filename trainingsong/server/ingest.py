@@ -0,0 +1,303 @@
+"""Backfill Billboard chart history into the chart_cache table.
+
+    python -m trainingsong.server.ingest hot-100 --workers 4
+
+Walks a chart a week at a time with a pool of workers. Every fetch goes
+through the Billboard rate limiter (BILLBOARD_RATE_LIMIT, or --rate), so
+workers only overlap page parsing and waiting on billboard.com; they never
+exceed the rate. Number ones are written in batches, together with a
+checkpoint of the last week before which nothing is missing. Re-running the
+command resumes from the checkpoint, which also tops up weeks published
+since the last run. Weeks stored out of order, or by the API's chart cache,
+aren't fetched again. A week without a chart only counts as done when a
+later week has one; otherwise it may just not be published yet, so the
+checkpoint stops before it and the next run asks again.
+
+With --pages DIR, pages are read from DIR/<chart>/<week>.html instead of
+billboard.com, e.g. to test against recorded pages. With --index, the
+chart's stored history is then written to the chart index the package
+bundles, which the API reads (or to the given path). It's only written
+once every week through the end is stored; otherwise the command exits
+non-zero.
+"""
+
+import asyncio
+import datetime
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple, Union
+
+from fastapi import HTTPException
+
+from trainingsong.server import db, ratelimit
+from trainingsong.server.billboard_io import _parse_chart_page, fetch_chart
+from trainingsong.server.chart_index import Song, index_path, write_index
+from trainingsong.server.concurrency import run_sync
+from trainingsong.server.logs import get_logger
+from trainingsong.server.resolve import chart_week
+
+log = get_logger(__name__)
+
+# The first Hot 100 is dated Monday 1958-08-04, the chart billboard.com
+# serves for the week ending this Saturday
+DEFAULT_START = datetime.date(1958, 8, 2)
+WORKERS = 4
+# Rows written per transaction, which is also the most a crash can lose
+BATCH_SIZE = 100
+
+WEEK = datetime.timedelta(days=7)
+
+Fetch = Callable[[str, datetime.date], Awaitable[Any]]
+
+
+@dataclass
+class IngestReport:
+    "What an ingestion run did"
+
+    weeks: int = 0
+    fetched: int = 0
+    stored: int = 0
+    empty: int = 0
+    failed: List[datetime.date] = field(default_factory=list)
+    checkpoint: Optional[datetime.date] = None
+    end: Optional[datetime.date] = None
+
+    @property
+    def complete(self) -> bool:
+        "Whether every week through end is stored"
+        return (
+            not self.failed
+            and self.checkpoint is not None
+            and self.checkpoint >= self.end
+        )
+
+
+def latest_week(today: Optional[datetime.date] = None) -> datetime.date:
+    """The latest chart week that's surely published. Charts come out a few
+    days before the Saturday they're dated."""
+    return chart_week((today or datetime.date.today()) - WEEK)
+
+
+def recorded_pages(directory: Union[str, Path]) -> Fetch:
+    "A fetch that reads saved pages from directory/<chart>/<week>.html"
+
+    async def fetch(chart: str, week: datetime.date):
+        import billboard
+
+        path = Path(directory) / chart / f"{week}.html"
+        if not path.exists():
+            raise HTTPException(status_code=404, detail="No chart data found")
+        chart_data = billboard.ChartData(chart, date=str(week), fetch=False)
+        await run_sync(_parse_chart_page, chart_data, path.read_text())
+        return chart_data
+
+    return fetch
+
+
+class _Ingestion:
+    "The state of one run: which weeks are done, and rows not yet written"
+
+    def __init__(self, chart: str, weeks: List[datetime.date], done: Set):
+        self.chart = chart
+        self.weeks = weeks
+        self.done = done
+        # Done weeks without a chart
+        self.empty: Set[datetime.date] = set()
+        self.report = IngestReport(weeks=len(weeks))
+        self._rows: List[Tuple[datetime.date, str, str, int]] = []
+        self._checkpointed = 0
+        self._write_lock = asyncio.Lock()
+
+    def record(self, week: datetime.date, song) -> None:
+        if song is None:
+            self.report.empty += 1
+            self.empty.add(week)
+        else:
+            self._rows.append((week, song.title, song.artist, int(song.weeks or 0)))
+        self.done.add(week)
+
+    @property
+    def pending(self) -> int:
+        return len(self._rows)
+
+    def _advance_checkpoint(self) -> Optional[datetime.date]:
+        charted = self.done - self.empty
+        last_charted = max(charted) if charted else None
+        while self._checkpointed < len(self.weeks):
+            week = self.weeks[self._checkpointed]
+            if week not in self.done:
+                break
+            if week in self.empty and (last_charted is None or week > last_charted):
+                # Maybe not published yet, rather than never charted
+                break
+            self._checkpointed += 1
+        if self._checkpointed == 0:
+            return None
+        return self.weeks[self._checkpointed - 1]
+
+    async def flush(self) -> None:
+        "Write the rows so far, and the checkpoint they complete"
+        async with self._write_lock:
+            # Every done week is either written already or in this batch
+            rows, self._rows = self._rows, []
+            checkpoint = self._advance_checkpoint()
+            if not rows and checkpoint == self.report.checkpoint:
+                return
+            await run_sync(db.store_chart_batch, self.chart, rows, checkpoint)
+            self.report.stored += len(rows)
+            self.report.checkpoint = checkpoint or self.report.checkpoint
+            log.info(
+                "stored chart weeks",
+                extra={"chart": self.chart, "rows": len(rows), "through": checkpoint},
+            )
+
+
+async def _number_one(fetch: Fetch, chart: str, week: datetime.date):
+    "The week's number one, or None if billboard.com has no chart for it"
+    try:
+        chart_data = await fetch(chart, week)
+    except HTTPException as e:
+        if e.status_code == 404:
+            return None
+        raise
+    # billboard.com serves the next chart for dates between charts, so older
+    # charts dated on other weekdays fall in the 7 days from the week. Pages
+    # further off are the nearest chart to a week without one, e.g. before a
+    # chart started.
+    page_date = getattr(chart_data, "date", None)
+    if page_date and not (week <= datetime.date.fromisoformat(page_date) < week + WEEK):
+        return None
+    return chart_data[0] if chart_data else None
+
+
+async def ingest(
+    chart: str,
+    start: Optional[datetime.date] = None,
+    end: Optional[datetime.date] = None,
+    workers: int = WORKERS,
+    batch_size: int = BATCH_SIZE,
+    fetch: Fetch = fetch_chart,
+) -> IngestReport:
+    """Fetch and store the number one of every week of chart from start, or
+    the checkpoint, through end. Weeks that fail are left for the next run."""
+    first = chart_week(start or DEFAULT_START)
+    checkpoint = await run_sync(db.get_ingest_checkpoint, chart)
+    if checkpoint is not None and checkpoint >= first:
+        first = checkpoint + WEEK
+    last = chart_week(end) if end else latest_week()
+
+    weeks = []
+    week = first
+    while week <= last:
+        weeks.append(week)
+        week += WEEK
+    stored = await run_sync(db.get_chart_weeks, chart, first, last) if weeks else set()
+
+    run = _Ingestion(chart, weeks, done=set(stored))
+    run.report.checkpoint = checkpoint
+    run.report.end = last
+    queue: "asyncio.Queue[datetime.date]" = asyncio.Queue()
+    for week in weeks:
+        if week not in stored:
+            queue.put_nowait(week)
+    log.info(
+        "ingesting chart",
+        extra={"chart": chart, "first": first, "last": last, "todo": queue.qsize()},
+    )
+
+    async def worker():
+        while not queue.empty():
+            week = queue.get_nowait()
+            try:
+                song = await _number_one(fetch, chart, week)
+            except Exception as e:  # pylint: disable=broad-except
+                # The checkpoint stops before this week, so the next run retries it
+                log.warning(
+                    "chart week failed",
+                    extra={"chart": chart, "week": week, "error": str(e)},
+                )
+                run.report.failed.append(week)
+                continue
+            run.report.fetched += 1
+            run.record(week, song)
+            if run.pending >= batch_size:
+                await run.flush()
+
+    await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+    await run.flush()
+    run.report.failed.sort()
+    return run.report
+
+
+def write_chart_index(chart: str, path: Union[str, Path]) -> int:
+    "Write a chart's stored history to a chart index, returning the weeks written"
+    rows = db.get_chart_history(chart)
+    return write_index(
+        path,
+        (
+            (week, Song(artist=artist, weeks=weeks, title=title))
+            for week, title, artist, weeks in rows
+        ),
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import argparse
+
+    from trainingsong.server import concurrency
+
+    parser = argparse.ArgumentParser(
+        description="Backfill a Billboard chart's number ones into the database"
+    )
+    parser.add_argument("chart", help="e.g. hot-100")
+    parser.add_argument("--start", type=datetime.date.fromisoformat)
+    parser.add_argument("--end", type=datetime.date.fromisoformat)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--rate", type=float, help="billboard.com calls a second")
+    parser.add_argument("--pages", help="read recorded pages from this directory")
+    parser.add_argument(
+        "--index",
+        nargs="?",
+        const="",
+        help="then write the chart index, by default the one the package bundles",
+    )
+    args = parser.parse_args(argv)
+
+    if args.rate:
+        ratelimit.LIMITERS["billboard"].rate = args.rate
+    db.metadata.create_all(db.get_engine())
+
+    async def run():
+        try:
+            return await ingest(
+                args.chart,
+                start=args.start,
+                end=args.end,
+                workers=args.workers,
+                batch_size=args.batch_size,
+                fetch=recorded_pages(args.pages) if args.pages else fetch_chart,
+            )
+        finally:
+            await concurrency.aclose()
+
+    report = asyncio.run(run())
+    print(
+        f"{args.chart}: {report.fetched} of {report.weeks} weeks fetched,"
+        f" {report.stored} stored, {report.empty} without a chart,"
+        f" {len(report.failed)} failed. Done through {report.checkpoint}."
+    )
+    if report.failed:
+        print("Run again to retry the failed weeks.")
+    if args.index is not None:
+        if not report.complete:
+            # A partial index would serve gaps as weeks without a chart
+            raise SystemExit(
+                f"Not writing the chart index: {args.chart} isn't stored through {report.end}."
+            )
+        path = args.index or index_path(args.chart)
+        print(f"Wrote {write_chart_index(args.chart, path)} weeks to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Structured logging for the server.
+
+Log lines are logfmt key=value pairs, with anything passed in `extra` added
+as fields:
+
+    log.info("served", extra={"route": "/", "status": 200})
+
+Set LOG_LEVEL (default INFO) to turn it down, e.g. LOG_LEVEL=WARNING.
+"""
+
+import datetime
+import json
+import logging
+import os
+from typing import Any
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# Every module logs under trainingsong.server, so one handler covers them all
+ROOT_LOGGER = "trainingsong.server"
+
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def _value(value: Any) -> str:
+    text = str(value)
+    if not text or any(c in text for c in ' ="\n'):
+        return json.dumps(text)
+    return text
+
+
+class LogfmtFormatter(logging.Formatter):
+    "Formats records as key=value pairs, including their extra fields"
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields.update(
+            (key, value)
+            for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES
+        )
+        line = " ".join(f"{key}={_value(value)}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+def get_logger(name: str) -> logging.Logger:
+    "A logger under trainingsong.server, configured on first use"
+    root = logging.getLogger(ROOT_LOGGER)
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(LogfmtFormatter())
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+    return logging.getLogger(name)
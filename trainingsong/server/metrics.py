@@ -0,0 +1,238 @@
+"""Request timings and upstream metrics.
+
+stage() times one step of a request, such as a Billboard lookup or a Spotify
+search. Each timing goes into a histogram served by /metrics in the
+Prometheus text format, and into the request's Server-Timing header.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from trainingsong.server import cache
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _labels(names: Sequence[str], values: Labels, **extra: str) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    "A monotonically increasing count per label set"
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Labels = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    "A value per label set that can go up and down"
+
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+    "Counts of observations per bucket, with their sum, per label set"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Labels = (),
+        buckets: Sequence[float] = BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # Per label set: observations per bucket (the last is +Inf), and the sum
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            counts, total = self._values.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def count(self, *labels: str) -> int:
+        counts, _total = self._values.get(labels, ([0], [0.0]))
+        return sum(counts)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            for labels, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        f"{self.name}_bucket"
+                        f"{_labels(self.labelnames, labels, le=le)} {cumulative}"
+                    )
+                label_text = _labels(self.labelnames, labels)
+                lines.append(f"{self.name}_sum{label_text} {total[0]}")
+                lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "trainingsong_request_seconds",
+    "Time to serve a request, by route and status",
+    ("route", "status"),
+)
+STAGE_SECONDS = Histogram(
+    "trainingsong_stage_seconds",
+    "Time spent in each stage of a request",
+    ("stage",),
+)
+UPSTREAM_REQUESTS = Counter(
+    "trainingsong_upstream_requests_total",
+    "Calls to Billboard and Spotify, by outcome",
+    ("upstream", "outcome"),
+)
+UPSTREAM_RETRIES = Counter(
+    "trainingsong_upstream_retries_total",
+    "Calls to Billboard and Spotify that were retried, by reason",
+    ("upstream", "reason"),
+)
+UPSTREAM_QUEUE_DEPTH = Gauge(
+    "trainingsong_upstream_queue_depth",
+    "Calls waiting on an upstream's rate limiter",
+    ("upstream",),
+)
+UPSTREAM_WAIT_SECONDS = Histogram(
+    "trainingsong_upstream_wait_seconds",
+    "Time calls spent waiting on an upstream's rate limiter",
+    ("upstream",),
+)
+LIVE_UPDATES = Counter(
+    "trainingsong_live_updates_total",
+    "Metric updates on live sessions, by whether they changed the song",
+    ("outcome",),
+)
+
+# The stage timings of the request being served, for its Server-Timing header
+_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar(
+    "timings", default=None
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    "Time a step of the current request"
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, name)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+@contextmanager
+def request_timings() -> Iterator[List[Tuple[str, float]]]:
+    "Collect the stage timings of the request served inside the block"
+    timings: List[Tuple[str, float]] = []
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def record_upstream(upstream: str, ok: bool) -> None:
+    UPSTREAM_REQUESTS.inc(upstream, "ok" if ok else "error")
+
+
+def server_timing(timings: List[Tuple[str, float]], total: float) -> str:
+    "A Server-Timing header value, with durations in milliseconds"
+    entries = [(name, elapsed) for name, elapsed in timings] + [("total", total)]
+    return ", ".join(f"{name};dur={1000 * elapsed:.1f}" for name, elapsed in entries)
+
+
+def _cache_lines() -> List[str]:
+    stats = [(c.name, c.stats()) for c in cache.CACHES]
+    lines = []
+    for metric, key, kind, documentation in (
+        ("trainingsong_cache_hits_total", "hits", "counter", "In-memory cache hits"),
+        (
+            "trainingsong_cache_backend_hits_total",
+            "backend_hits",
+            "counter",
+            "Cache misses served by the persistent backend",
+        ),
+        ("trainingsong_cache_misses_total", "misses", "counter", "Cache misses"),
+        ("trainingsong_cache_hit_ratio", "hit_rate", "gauge", "Share of hits"),
+        ("trainingsong_cache_size", "size", "gauge", "Entries in the cache"),
+    ):
+        lines.append(f"# HELP {metric} {documentation}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, values in stats:
+            lines.append(f"{metric}{_labels(('cache',), (name,))} {values[key]}")
+    return lines
+
+
+def render() -> str:
+    "Every metric in the Prometheus text exposition format"
+    lines: List[str] = []
+    for instrument in (
+        REQUEST_SECONDS,
+        STAGE_SECONDS,
+        UPSTREAM_REQUESTS,
+        UPSTREAM_RETRIES,
+        UPSTREAM_QUEUE_DEPTH,
+        UPSTREAM_WAIT_SECONDS,
+        LIVE_UPDATES,
+    ):
+        lines.extend(instrument.render())
+    lines.extend(_cache_lines())
+    return "\n".join(lines) + "\n"
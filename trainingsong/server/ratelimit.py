@@ -0,0 +1,173 @@
+"""Outbound rate limiting and retries for Billboard and Spotify.
+
+Each upstream has a token bucket that queues calls once its burst is used
+up. send() makes a call through the bucket. On a 429 it pauses the whole
+upstream for the Retry-After period and tries again. Connection errors and
+5xx responses are retried with jittered exponential backoff. Either way it
+gives up once the next attempt would start after the deadline.
+
+Buckets are per process, so with several workers each gets the full rate.
+"""
+
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Optional
+
+from trainingsong.server import metrics
+from trainingsong.server.logs import get_logger
+
+if TYPE_CHECKING:
+    import httpx
+
+log = get_logger(__name__)
+
+# Sustained calls per second, and how many may go at once after a quiet spell
+SPOTIFY_RATE = float(os.environ.get("SPOTIFY_RATE_LIMIT", "10"))
+SPOTIFY_BURST = 20
+BILLBOARD_RATE = float(os.environ.get("BILLBOARD_RATE_LIMIT", "2"))
+BILLBOARD_BURST = 4
+
+# Seconds from the first attempt after which a call is not retried. Kept
+# under the per-stage timeouts in api.STAGE_TIMEOUTS.
+DEADLINES = {"spotify": 8.0, "billboard": 25.0}
+BACKOFF_BASE = 0.25
+BACKOFF_MAX = 4.0
+
+
+class TokenBucket:
+    """Allows rate calls per second with bursts of up to burst calls.
+
+    acquire() reserves the next free slot and sleeps until it comes round,
+    so waiting callers go in arrival order without a lock held across the
+    await. pause() holds every call back, e.g. for a Retry-After."""
+
+    def __init__(self, name: str, rate: float, burst: int):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        "Take a token, returning how long to wait before it can be used"
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def _refund(self) -> None:
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> float:
+        "Wait for a slot. Returns the time spent waiting"
+        wait = self._reserve()
+        if wait > 0:
+            metrics.UPSTREAM_QUEUE_DEPTH.inc(self.name)
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                # Cancelled while queued, so the slot goes back
+                self._refund()
+                raise
+            finally:
+                metrics.UPSTREAM_QUEUE_DEPTH.inc(self.name, amount=-1)
+        metrics.UPSTREAM_WAIT_SECONDS.observe(wait, self.name)
+        return wait
+
+
+LIMITERS: Dict[str, TokenBucket] = {
+    "spotify": TokenBucket("spotify", SPOTIFY_RATE, SPOTIFY_BURST),
+    "billboard": TokenBucket("billboard", BILLBOARD_RATE, BILLBOARD_BURST),
+}
+
+
+def retry_after(response: "httpx.Response") -> Optional[float]:
+    "Seconds to wait from a Retry-After header, given as seconds or a date"
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def backoff(attempt: int) -> float:
+    "Full-jitter exponential backoff for the given retry attempt, from 0"
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+async def send(
+    upstream: str,
+    request: Callable[[], Awaitable["httpx.Response"]],
+    deadline: Optional[float] = None,
+) -> "httpx.Response":
+    """Make request() through upstream's rate limiter, retrying 429s, 5xx
+    responses and connection errors until deadline seconds have passed.
+    Returns the last response, or raises the last connection error."""
+    import httpx
+
+    limiter = LIMITERS[upstream]
+    give_up_at = time.monotonic() + (
+        DEADLINES[upstream] if deadline is None else deadline
+    )
+    attempt = 0
+    while True:
+        await limiter.acquire()
+        try:
+            response = await request()
+        except httpx.TransportError as e:
+            metrics.record_upstream(upstream, ok=False)
+            delay, reason, error = backoff(attempt), "connection", e
+        else:
+            error = None
+            if response.status_code == 429:
+                metrics.UPSTREAM_REQUESTS.inc(upstream, "throttled")
+                delay = retry_after(response)
+                if delay is None:
+                    delay = backoff(attempt)
+                # Everyone else calling this upstream has to wait too
+                limiter.pause(delay)
+                reason = "throttled"
+            elif response.status_code >= 500:
+                metrics.record_upstream(upstream, ok=False)
+                delay, reason = backoff(attempt), "server_error"
+            else:
+                metrics.record_upstream(upstream, ok=True)
+                return response
+
+        if time.monotonic() + delay > give_up_at:
+            if error is not None:
+                raise error
+            return response
+
+        metrics.UPSTREAM_RETRIES.inc(upstream, reason)
+        log.info(
+            "retrying upstream call",
+            extra={"upstream": upstream, "reason": reason, "delay": round(delay, 3)},
+        )
+        attempt += 1
+        if reason != "throttled":
+            # The limiter already holds calls back for a Retry-After
+            await asyncio.sleep(delay)
@@ -0,0 +1,78 @@
+"""Dependency-free parts of song resolution, shared by the API and the
+client's response cache and live sessions."""
+
+import datetime
+from dataclasses import dataclass
+from typing import Optional
+
+# Percentages before the chart starts in 1952 get hard-coded songs
+CHART_START_PERCENTAGE = 52
+
+
+@dataclass
+class StateData:
+    """Dataclass for authenticate_spotify function"""
+
+    song_name: str
+    artist_name: str
+    autoplay: Optional[bool]
+    song_info: str
+    target_date: str
+    percentage: float
+    chart: str
+
+
+def percentage_to_date(percentage: float) -> datetime.date:
+    "The date that is percentage% through the 1900s"
+    target_year = int(percentage)
+
+    # Calculate the target date based on the fractional part of the percentage
+    fractional_percentage = percentage % 1
+    days_in_year = (
+        366
+        if target_year % 4 == 0 and (target_year % 100 != 0 or target_year % 400 == 0)
+        else 365
+    )
+    target_day = int(days_in_year * fractional_percentage)
+
+    target_date = datetime.date(1900 + target_year, 1, 1) + datetime.timedelta(
+        days=target_day
+    )
+    return target_date
+
+
+def chart_week(target_date: datetime.date) -> datetime.date:
+    """The canonical chart week for target_date.
+    Billboard charts are dated on Saturdays and billboard.com rounds other
+    dates up to the next chart, so every day maps to the following Saturday.
+    Charts are fetched by this date too, so a week always gets one chart even
+    where they're dated on other days, like the Mondays of 1958-62."""
+    return target_date + datetime.timedelta(days=(5 - target_date.weekday()) % 7)
+
+
+def song_bucket(percentage: float) -> str:
+    """Every percentage in a bucket resolves to the same song: the chart week,
+    or the whole percentage for the hard-coded songs before the chart starts"""
+    if percentage < CHART_START_PERCENTAGE:
+        return f"hard-coded-{int(percentage)}"
+    return chart_week(percentage_to_date(percentage)).isoformat()
+
+
+def number_one_state(
+    percentage: float, chart: str, number_one_song, target_date: datetime.date
+) -> StateData:
+    "The StateData describing the number one song for percentage"
+    song_name = number_one_song.title
+    artist_name = number_one_song.artist
+
+    song_info = f"""The Number 1 song {percentage}% through the 1900s on the {chart} chart was {song_name} by {artist_name}. \nThe date was {target_date} and the song was on the chart for {number_one_song.weeks} weeks."""
+    result = StateData(
+        song_name=song_name,
+        artist_name=artist_name,
+        autoplay=None,
+        song_info=song_info,
+        target_date=str(target_date),
+        percentage=percentage,
+        chart=chart,
+    )
+    return result
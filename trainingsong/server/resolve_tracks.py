@@ -0,0 +1,199 @@
+"""Resolve every chart number one to a Spotify track ahead of requests.
+
+    python -m trainingsong.server.resolve_tracks --workers 8
+
+Collects each distinct (title, artist) from the chart_cache table, the chart
+indexes and the hard-coded songs, and searches Spotify for those missing
+from the track_cache table or stale there. Searches run concurrently through
+the Spotify rate limiter (SPOTIFY_RATE_LIMIT), with an app token from
+CLIENT_ID and CLIENT_SECRET, and pick the original recording over covers
+with spotify.pick_track. Results are written in batches, so re-running only
+searches songs that are new, or were last searched too long ago.
+
+The API then finds each track with a key lookup in track_cache instead of
+a search.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from trainingsong.server import db
+from trainingsong.server.chart_index import CHART_INDEX_DIR, ChartIndex
+from trainingsong.server.concurrency import run_sync
+from trainingsong.server.hard_coded import FALLBACK_SONG, HARD_CODED_DICT
+from trainingsong.server.logs import get_logger
+from trainingsong.server.spotify import (
+    CLIENT_ID,
+    CLIENT_SECRET,
+    NOT_FOUND,
+    NOT_FOUND_TTL,
+    AsyncSpotify,
+    _track_key,
+    search_track,
+)
+
+log = get_logger(__name__)
+
+WORKERS = 8
+# Search results written per transaction
+BATCH_SIZE = 200
+# Found tracks are searched again after this long, in case a better match
+# has appeared. Searches that found nothing are retried after NOT_FOUND_TTL.
+TRACK_MAX_AGE = 180 * 24 * 60 * 60
+
+Song = Tuple[str, str]
+
+
+@dataclass
+class ResolveReport:
+    "What a resolution run did"
+
+    songs: int = 0
+    searched: int = 0
+    found: int = 0
+    not_found: int = 0
+    failed: int = 0
+
+
+def chart_songs(index_dir: Optional[Union[str, Path]] = None) -> Set[Song]:
+    "Every distinct (title, artist) the API can resolve a percentage to"
+    songs = set(db.get_chart_songs())
+    for path in sorted(Path(index_dir or CHART_INDEX_DIR).glob("*.idx")):
+        index = ChartIndex(path)
+        try:
+            songs.update(
+                (song.title, song.artist)
+                for song in (index.song(i) for i in range(len(index)))
+            )
+        finally:
+            index.close()
+    songs.update((title, artist) for title, artist in HARD_CODED_DICT.values())
+    songs.add((FALLBACK_SONG[0], FALLBACK_SONG[1]))
+    return songs
+
+
+def stale_songs(
+    songs: Set[Song],
+    ages: Dict[Tuple[str, str], Tuple[bool, int]],
+    now: Optional[float] = None,
+) -> List[Song]:
+    """The songs with no stored search, or one older than TRACK_MAX_AGE
+    (NOT_FOUND_TTL if it found nothing). ages is db.get_track_ages()."""
+    now = time.time() if now is None else now
+    stale: Dict[Tuple[str, str], Song] = {}
+    for song in sorted(songs):
+        key = _track_key(*song)
+        if key in stale:
+            # The same track with different capitalisation
+            continue
+        found, cached_at = ages.get(key, (False, None))
+        max_age = TRACK_MAX_AGE if found else NOT_FOUND_TTL
+        if cached_at is None or cached_at + max_age < now:
+            stale[key] = song
+    return list(stale.values())
+
+
+async def app_client() -> AsyncSpotify:
+    "A client authorised as the app rather than a user, which is enough to search"
+    from spotipy.oauth2 import SpotifyClientCredentials
+
+    credentials = SpotifyClientCredentials(
+        client_id=CLIENT_ID, client_secret=CLIENT_SECRET
+    )
+    return AsyncSpotify(
+        auth=await run_sync(credentials.get_access_token, as_dict=False)
+    )
+
+
+async def resolve_tracks(
+    sp: AsyncSpotify,
+    songs: Set[Song],
+    workers: int = WORKERS,
+    batch_size: int = BATCH_SIZE,
+) -> ResolveReport:
+    "Search Spotify for the stale songs among songs and store the results"
+    ages = await run_sync(db.get_track_ages)
+    queue: "asyncio.Queue[Song]" = asyncio.Queue()
+    for song in stale_songs(songs, ages):
+        queue.put_nowait(song)
+    report = ResolveReport(songs=len(songs))
+    log.info("resolving tracks", extra={"songs": len(songs), "todo": queue.qsize()})
+
+    rows: List[Tuple[str, str, Optional[str], Optional[str], Optional[str]]] = []
+    write_lock = asyncio.Lock()
+
+    async def flush():
+        nonlocal rows
+        async with write_lock:
+            batch, rows = rows, []
+            if batch:
+                await run_sync(db.store_tracks, batch)
+                log.info("stored tracks", extra={"rows": len(batch)})
+
+    async def worker():
+        while not queue.empty():
+            song_name, artist_name = queue.get_nowait()
+            try:
+                track = await search_track(sp, song_name, artist_name)
+            except Exception as e:  # pylint: disable=broad-except
+                # Left missing or stale, so the next run tries again
+                log.warning(
+                    "track search failed",
+                    extra={"song": song_name, "artist": artist_name, "error": str(e)},
+                )
+                report.failed += 1
+                continue
+            report.searched += 1
+            if track == NOT_FOUND:
+                report.not_found += 1
+                link, name, uri = None, None, None
+            else:
+                report.found += 1
+                link, name, uri = track
+            rows.append((*_track_key(song_name, artist_name), link, name, uri))
+            if len(rows) >= batch_size:
+                await flush()
+
+    await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+    await flush()
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import argparse
+
+    from trainingsong.server import concurrency
+
+    parser = argparse.ArgumentParser(
+        description="Store a Spotify track for every chart number one"
+    )
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--index-dir", help="chart indexes to include")
+    args = parser.parse_args(argv)
+
+    db.metadata.create_all(db.get_engine())
+
+    async def run():
+        try:
+            return await resolve_tracks(
+                await app_client(),
+                chart_songs(args.index_dir),
+                workers=args.workers,
+                batch_size=args.batch_size,
+            )
+        finally:
+            await concurrency.aclose()
+
+    report = asyncio.run(run())
+    print(
+        f"{report.searched} of {report.songs} songs searched: {report.found} found,"
+        f" {report.not_found} not on Spotify, {report.failed} failed."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Re-encrypt stored tokens with a new ENCRYPT_KEY, so users don't have to
+authorise with Spotify again when the key changes.
+
+1. Set ENCRYPT_KEY to the new key and OLD_ENCRYPT_KEYS to the old one, and
+   deploy. The API reads tokens under either key, and writes the new one.
+2. Run python -m trainingsong.server.rotate_keys
+3. Once it reports no failures, remove the old key from OLD_ENCRYPT_KEYS.
+
+Rows are streamed from a server-side cursor in email order (or read a page
+at a time on databases without them, like SQLite), re-encrypted in
+parallel chunks by a process pool, and each chunk is written in its own
+short transaction, so memory stays bounded and no rows stay locked. An
+update only applies if the row still holds the tokens that were read, so a
+refresh by the API in the meantime isn't overwritten. Rows already under
+the new key are skipped, so an interrupted run can simply be run again, or
+resumed with --after the last email it logged.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy import bindparam
+
+from trainingsong.db_utils import rotate
+from trainingsong.server.db import get_engine, tokens
+from trainingsong.server.logs import get_logger
+
+log = get_logger(__name__)
+
+# Rows per chunk, which is also the rows written per transaction
+BATCH_SIZE = 500
+WORKERS = os.cpu_count() or 1
+
+Row = Tuple[str, Optional[str], Optional[str]]
+
+_UPDATE = (
+    tokens.update()
+    .where(
+        (tokens.c.email == bindparam("b_email"))
+        & (tokens.c.access_token == bindparam("b_access_token"))
+        & (tokens.c.refresh_token == bindparam("b_refresh_token"))
+    )
+    .values(
+        access_token=bindparam("new_access_token"),
+        refresh_token=bindparam("new_refresh_token"),
+    )
+)
+
+
+@dataclass
+class RotationReport:
+    "What a rotation run did"
+
+    scanned: int = 0
+    rotated: int = 0
+    failed: List[str] = field(default_factory=list)
+    last_email: Optional[str] = None
+
+
+def _rotate_chunk(rows: List[Row]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """The updates that move a chunk of rows to the current key, and the
+    emails of rows no key could decrypt. Runs in the worker processes."""
+    from cryptography.fernet import InvalidToken
+
+    updates, failed = [], []
+    for email, access_token, refresh_token in rows:
+        if access_token is None or refresh_token is None:
+            continue
+        try:
+            new_access_token = rotate(access_token)
+            new_refresh_token = rotate(refresh_token)
+        except InvalidToken:
+            failed.append(email)
+            continue
+        if (new_access_token, new_refresh_token) != (access_token, refresh_token):
+            updates.append(
+                {
+                    "b_email": email,
+                    "b_access_token": access_token,
+                    "b_refresh_token": refresh_token,
+                    "new_access_token": new_access_token,
+                    "new_refresh_token": new_refresh_token,
+                }
+            )
+    return updates, failed
+
+
+def _stream_rows(batch_size: int, after: Optional[str] = None) -> Iterator[List[Row]]:
+    "Every token row after the email `after`, in email order, a chunk at a time"
+    query = sqlalchemy.select(
+        tokens.c.email, tokens.c.access_token, tokens.c.refresh_token
+    ).order_by(tokens.c.email)
+    engine = get_engine()
+    if engine.dialect.supports_server_side_cursors:
+        if after is not None:
+            query = query.where(tokens.c.email > after)
+        with engine.connect() as connection:
+            result = connection.execution_options(
+                stream_results=True, max_row_buffer=batch_size
+            ).execute(query)
+            for partition in result.partitions(batch_size):
+                yield [tuple(row) for row in partition]
+        return
+
+    # e.g. SQLite, where an open read would block the writes: page by email
+    while True:
+        page = query.limit(batch_size)
+        if after is not None:
+            page = page.where(tokens.c.email > after)
+        with engine.connect() as connection:
+            rows = [tuple(row) for row in connection.execute(page)]
+        if not rows:
+            return
+        yield rows
+        after = rows[-1][0]
+
+
+def rotate_tokens(
+    batch_size: int = BATCH_SIZE,
+    workers: int = WORKERS,
+    after: Optional[str] = None,
+) -> RotationReport:
+    "Re-encrypt every stored token that isn't under the current key yet"
+    report = RotationReport()
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    # Chunks being re-encrypted, in order so progress is only logged once
+    # every earlier row is written
+    pending: Deque[Tuple[List[Row], Future]] = deque()
+
+    def write_oldest():
+        rows, future = pending.popleft()
+        updates, failed = future.result()
+        if updates:
+            with get_engine().begin() as connection:
+                connection.execute(_UPDATE, updates)
+        report.scanned += len(rows)
+        report.rotated += len(updates)
+        report.failed.extend(failed)
+        report.last_email = rows[-1][0]
+        log.info(
+            "rotated tokens",
+            extra={
+                "scanned": report.scanned,
+                "rotated": report.rotated,
+                "through": report.last_email,
+            },
+        )
+
+    try:
+        for rows in _stream_rows(batch_size, after):
+            if executor is None:
+                future: Future = Future()
+                future.set_result(_rotate_chunk(rows))
+            else:
+                future = executor.submit(_rotate_chunk, rows)
+            pending.append((rows, future))
+            # Bound how many chunks are held in memory
+            while len(pending) > 2 * workers:
+                write_oldest()
+        while pending:
+            write_oldest()
+    finally:
+        if executor is not None:
+            for _rows, future in pending:
+                future.cancel()
+            executor.shutdown()
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Re-encrypt stored tokens with the current ENCRYPT_KEY"
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--after", help="resume after this email")
+    args = parser.parse_args(argv)
+
+    report = rotate_tokens(args.batch_size, args.workers, args.after)
+    print(f"Re-encrypted {report.rotated} of {report.scanned} users' tokens.")
+    if report.failed:
+        print(
+            f"{len(report.failed)} users' tokens couldn't be decrypted with any key:"
+            f" {', '.join(report.failed)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
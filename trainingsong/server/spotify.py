@@ -1,23 +1,38 @@
-"""Spotify API functions"""
+"""Spotify API functions
 
+spotipy is only imported for the OAuth token calls, so requests served from
+cached tokens don't pay for importing it. Tokens of active users are
+refreshed in the background before they expire, so requests rarely wait on
+a refresh.
+"""
+
+import asyncio
 import os
+import re
 import time
-from dataclasses import dataclass
-from typing import Optional, Tuple, Union
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple, Union
 from urllib.error import HTTPError
+from urllib.parse import urlparse
 
-import spotipy
 from dotenv import load_dotenv
 from fastapi import HTTPException
-from spotipy import SpotifyException
-from spotipy.oauth2 import SpotifyOAuth
 
+from trainingsong.server import db, metrics, ratelimit
+from trainingsong.server.cache import Expiring, LRUCache
+from trainingsong.server.concurrency import SingleFlight, get_http_client, run_sync
 from trainingsong.server.db import (
-    database_session,
-    get_tokens,
-    store_tokens,
-    update_tokens,
+    get_tokens_async,
+    store_tokens_async,
+    update_tokens_async,
 )
+from trainingsong.server.logs import get_logger
+from trainingsong.server.resolve import StateData
+
+if TYPE_CHECKING:
+    from spotipy.oauth2 import SpotifyOAuth
+
+log = get_logger(__name__)
 
 SCOPE = "user-modify-playback-state user-read-currently-playing user-read-recently-played user-read-playback-state"
 
@@ -30,99 +45,437 @@ CLIENT_ID = os.environ.get("CLIENT_ID")
 CLIENT_SECRET = os.environ.get("CLIENT_SECRET")
 
 SPOTIFY_REDIRECT_URI = "http://localhost:8000/local_callback"
+SPOTIFY_API_URL = "https://api.spotify.com/v1"
+
+# How long a search that found nothing is remembered before Spotify is asked again
+NOT_FOUND_TTL = 60 * 60
+NOT_FOUND: Tuple[str, str, str] = ("", "", "")
+
+
+class SpotifyError(Exception):
+    "An error response from the Spotify Web API"
 
+    def __init__(self, http_status: int, msg: str, headers=None):
+        super().__init__(f"http status: {http_status}, {msg}")
+        self.http_status = http_status
+        self.msg = msg
+        self.headers = headers or {}
 
-@dataclass
-class StateData:
-    """Dataclass for authenticate_spotify function"""
 
-    song_name: str
-    artist_name: str
-    autoplay: Optional[bool]
-    song_info: str
-    target_date: str
-    percentage: float
-    chart: str
+class AsyncSpotify:
+    """Minimal non-blocking Spotify Web API client for the calls the API makes.
+    Mirrors the spotipy.Spotify method signatures, but sends requests over the
+    shared pooled httpx client, through the Spotify rate limiter, and raises
+    SpotifyError."""
 
+    def __init__(self, auth: str, expires_at: Optional[float] = None):
+        self.auth = auth
+        # When auth expires, for clients that outlive a request
+        self.expires_at = expires_at
+
+    async def _request(self, method: str, path: str, **kwargs) -> Optional[Any]:
+        response = await ratelimit.send(
+            "spotify",
+            lambda: get_http_client().request(
+                method,
+                SPOTIFY_API_URL + path,
+                headers={"Authorization": f"Bearer {self.auth}"},
+                **kwargs,
+            ),
+        )
+        if response.status_code >= 400:
+            try:
+                msg = response.json()["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                msg = response.text or "error"
+            raise SpotifyError(
+                response.status_code,
+                f"{response.request.url}:\n {msg}",
+                headers=response.headers,
+            )
+        if not response.content:
+            return None
+        return response.json()
+
+    async def search(self, q: str, limit: int = 10, type: str = "track"):
+        return await self._request(
+            "GET", "/search", params={"q": q, "limit": limit, "type": type}
+        )
 
-async def create_spotify_client(code: Union[str, None], email: str) -> spotipy.Spotify:
-    """Create a Spotify client using the code from the Spotify API callback"""
+    async def devices(self):
+        return await self._request("GET", "/me/player/devices")
 
-    sp_oauth = SpotifyOAuth(
+    async def start_playback(
+        self, device_id: Optional[str] = None, uris: Optional[List[str]] = None
+    ):
+        params = {"device_id": device_id} if device_id else None
+        return await self._request(
+            "PUT", "/me/player/play", params=params, json={"uris": uris}
+        )
+
+
+def _spotify_oauth(redirect_uri: str = SPOTIFY_REDIRECT_URI) -> "SpotifyOAuth":
+    from spotipy.oauth2 import SpotifyOAuth
+
+    return SpotifyOAuth(
         client_id=CLIENT_ID,
         client_secret=CLIENT_SECRET,
-        redirect_uri=SPOTIFY_REDIRECT_URI,
+        redirect_uri=redirect_uri,
         scope=SCOPE,
     )
 
-    with database_session() as session:
-        token_info = get_tokens(email)
 
+# Tokens are refreshed this long before they expire, off the request path
+REFRESH_AHEAD = 10 * 60
+# refresh_loop keeps tokens fresh for users seen within ACTIVE_WINDOW, checking
+# every REFRESH_INTERVAL seconds. TOKEN_REFRESH_INTERVAL=0 turns it off, and
+# that's the default on Vercel: instances are frozen between requests, so the
+# loop would wake inside a request. Requests still refresh tokens that are
+# about to expire in the background there.
+REFRESH_INTERVAL = float(
+    os.environ.get(
+        "TOKEN_REFRESH_INTERVAL", "0" if os.environ.get("VERCEL") == "1" else "60"
+    )
+)
+ACTIVE_WINDOW = 30 * 60
+MAX_ACTIVE_USERS = 1024
+
+# One refresh in flight per email, shared by every request that needs it
+TOKEN_REFRESHES = SingleFlight()
+# Last time each recently active email made a request, oldest first
+_active_users: "OrderedDict[str, float]" = OrderedDict()
+_background_tasks: Set[asyncio.Task] = set()
+_refresh_loop: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Task]] = None
+
+
+def _mark_active(email: str) -> None:
+    _active_users[email] = time.time()
+    _active_users.move_to_end(email)
+    while len(_active_users) > MAX_ACTIVE_USERS:
+        _active_users.popitem(last=False)
+
+
+async def refresh_tokens(email: str, refresh_token: str) -> Dict[str, Any]:
+    """Refresh and store a user's tokens. Concurrent calls for the same email
+    share one refresh, so they can't overwrite each other's tokens."""
+
+    async def refresh():
+        try:
+            token_info = await run_sync(
+                _spotify_oauth().refresh_access_token, refresh_token
+            )
+        except Exception:
+            metrics.record_upstream("spotify_accounts", ok=False)
+            raise
+        metrics.record_upstream("spotify_accounts", ok=bool(token_info))
         if not token_info:
-            print("Getting access token...")
-            if code is None:
-                raise ValueError("No code provided")
-            try:
-                token_info = sp_oauth.get_access_token(code)
-            except:
-                raise HTTPException(status_code=400, detail="Invalid Spotify code")
-            if not token_info:
-                raise HTTPException(status_code=400, detail="Invalid Spotify code")
-
-            store_tokens(
-                email,
-                token_info["access_token"],
-                token_info["refresh_token"],
-                token_info["expires_at"],
+            raise ValueError("Failed to refresh access token. Please try again. ")
+
+        await update_tokens_async(
+            email,
+            token_info["access_token"],
+            token_info["refresh_token"],
+            token_info["expires_at"],
+        )
+        return token_info
+
+    return await TOKEN_REFRESHES.do(email, refresh)
+
+
+async def _refresh_quietly(email: str, refresh_token: str) -> None:
+    try:
+        await refresh_tokens(email, refresh_token)
+    except Exception as e:  # pylint: disable=broad-except
+        # The token is still valid; the next request or pass tries again
+        log.warning("background token refresh failed", extra={"error": str(e)})
+
+
+def _refresh_in_background(email: str, refresh_token: str) -> None:
+    task = asyncio.get_running_loop().create_task(
+        _refresh_quietly(email, refresh_token)
+    )
+    # Keep a reference so the task isn't garbage collected while it runs
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def refresh_active_tokens() -> None:
+    "Refresh the tokens of recently active users that expire soon"
+    now = time.time()
+    for email, last_seen in list(_active_users.items()):
+        if now - last_seen > ACTIVE_WINDOW:
+            _active_users.pop(email, None)
+            continue
+        token_info = await get_tokens_async(email)
+        if token_info and token_info["expires_at"] - now < REFRESH_AHEAD:
+            await _refresh_quietly(email, token_info["refresh_token"])
+
+
+async def refresh_loop(interval: float = REFRESH_INTERVAL) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh_active_tokens()
+        except Exception as e:  # pylint: disable=broad-except
+            log.warning("token refresh pass failed", extra={"error": str(e)})
+
+
+def _ensure_refresh_loop() -> None:
+    "Start refresh_loop on the running event loop once there are users"
+    global _refresh_loop
+    if REFRESH_INTERVAL <= 0:
+        return
+    loop = asyncio.get_running_loop()
+    if _refresh_loop is None or _refresh_loop[0] is not loop or _refresh_loop[1].done():
+        _refresh_loop = (loop, loop.create_task(refresh_loop()))
+
+
+async def stop_refreshing() -> None:
+    "Cancel the refresh loop and background refreshes, e.g. at app shutdown"
+    global _refresh_loop
+    tasks = list(_background_tasks)
+    if _refresh_loop is not None and not _refresh_loop[1].done():
+        tasks.append(_refresh_loop[1])
+    _refresh_loop = None
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def is_local_redirect_uri(redirect_uri: str) -> bool:
+    "Whether redirect_uri is the client's local OAuth callback on some port"
+    url = urlparse(redirect_uri)
+    return (
+        url.scheme == "http"
+        and url.hostname in ("localhost", "127.0.0.1")
+        and url.path == "/local_callback"
+    )
+
+
+async def _exchange_code(code: str, email: str, redirect_uri: str) -> Dict[str, Any]:
+    "Trade an authorisation code for the user's tokens, and store them"
+    with metrics.stage("token_exchange"):
+        try:
+            token_info = await run_sync(
+                _spotify_oauth(redirect_uri).get_access_token, code
             )
+        except:
+            metrics.record_upstream("spotify_accounts", ok=False)
+            raise HTTPException(status_code=400, detail="Invalid Spotify code")
+        metrics.record_upstream("spotify_accounts", ok=bool(token_info))
+        if not token_info:
+            raise HTTPException(status_code=400, detail="Invalid Spotify code")
 
-        if token_info["expires_at"] < time.time():
-            print("Refreshing access token...")
-            token_info = sp_oauth.refresh_access_token(token_info["refresh_token"])
+        await store_tokens_async(
+            email,
+            token_info["access_token"],
+            token_info["refresh_token"],
+            token_info["expires_at"],
+        )
+    return token_info
 
-            if token_info:
-                update_tokens(
-                    email,
-                    token_info["access_token"],
-                    token_info["refresh_token"],
-                    token_info["expires_at"],
-                )
-            else:
-                raise ValueError("Failed to refresh access token. Please try again. ")
 
-    access_token = token_info["access_token"] if token_info else None
+def _exchange_done(task: "asyncio.Task") -> None:
+    _background_tasks.discard(task)
+    # The request may have stopped waiting; a failure is still worth a log
+    if not task.cancelled() and task.exception() is not None:
+        log.warning(
+            "authorisation code exchange failed",
+            extra={"error": str(task.exception())},
+        )
 
-    print("Got access token!")
 
-    sp = spotipy.Spotify(auth=access_token)
-    print("Created Spotify client")
+async def create_spotify_client(
+    code: Union[str, None],
+    email: str,
+    redirect_uri: str = SPOTIFY_REDIRECT_URI,
+) -> AsyncSpotify:
+    """Create a Spotify client using the code from the Spotify API callback.
+    redirect_uri must be the one the code was requested with."""
+
+    with metrics.stage("token_fetch"):
+        token_info = await get_tokens_async(email)
+
+    if not token_info:
+        log.info("getting access token")
+        if code is None:
+            raise ValueError("No code provided")
+        # A code can only be exchanged once, so finish exchanging and storing
+        # it even if the request is cancelled, e.g. by its chart lookup failing
+        exchange = asyncio.ensure_future(_exchange_code(code, email, redirect_uri))
+        _background_tasks.add(exchange)
+        exchange.add_done_callback(_exchange_done)
+        token_info = await asyncio.shield(exchange)
+
+    _mark_active(email)
+    expires_in = token_info["expires_at"] - time.time()
+    if expires_in < 0:
+        # Only users who haven't been seen for a while get here
+        log.info("refreshing access token")
+        with metrics.stage("token_refresh"):
+            token_info = await refresh_tokens(email, token_info["refresh_token"])
+    elif expires_in < REFRESH_AHEAD:
+        # Still valid, so use it and refresh off the request path
+        _refresh_in_background(email, token_info["refresh_token"])
+    _ensure_refresh_loop()
+
+    access_token = token_info["access_token"] if token_info else None
+
+    sp = AsyncSpotify(auth=access_token, expires_at=token_info["expires_at"])
+    log.debug("created Spotify client")
 
     return sp
 
 
-def spotify_link(
-    sp: spotipy.Spotify, song_name: str, artist_name: str
+class TrackTableBackend:
+    """Persistent backend for TRACK_CACHE using the track_cache table.
+
+    resolve_tracks fills the table ahead of requests, so it's read whenever
+    it exists. Whether it does is checked once per process."""
+
+    def __init__(self):
+        self._exists: Optional[bool] = None
+
+    def exists(self) -> bool:
+        if self._exists is None:
+            self._exists = db.has_table("track_cache")
+        return self._exists
+
+    def load(self, key: Tuple[str, str]) -> Optional[Any]:
+        if not self.exists():
+            return None
+        row = db.get_track(*key)
+        if row is None:
+            return None
+        if row["uri"] is None:
+            # Keep the empty search for what's left of its TTL, not a fresh one
+            remaining = row["cached_at"] + NOT_FOUND_TTL - time.time()
+            if remaining <= 0:
+                return None
+            return Expiring(NOT_FOUND, remaining)
+        return row["link"], row["name"], row["uri"]
+
+    def save(self, key: Tuple[str, str], track: Tuple[str, str, str]) -> None:
+        if not self.exists():
+            return
+        link, name, uri = track if track != NOT_FOUND else (None, None, None)
+        db.store_track(*key, link, name, uri)
+
+
+# (link, name, uri) per (song, artist) search, or NOT_FOUND for a search with
+# no results. Track URIs are stable so found tracks don't expire.
+TRACK_CACHE = LRUCache(
+    maxsize=4096,
+    backend=TrackTableBackend(),
+    name="track_cache",
+    ttl_for=lambda track: NOT_FOUND_TTL if track == NOT_FOUND else None,
+)
+
+# Concurrent misses for the same (song, artist) share one search
+TRACK_FLIGHTS = SingleFlight()
+# Statuses that fail a search because of the searching user's token, not
+# the track, so other users waiting on the search try their own
+USER_AUTH_ERRORS = (401, 403)
+
+
+def _track_key(song_name: str, artist_name: str) -> Tuple[str, str]:
+    return song_name.strip().casefold(), artist_name.strip().casefold()
+
+
+# Results considered per search. The first is often a cover or karaoke version.
+SEARCH_LIMIT = 5
+# Words in a track, album or artist name that mark something other than the
+# original recording
+NOT_ORIGINAL = re.compile(
+    r"\b(karaoke|tribute|covers?|made famous|originally performed|in the style of"
+    r"|instrumental|backing track|re-?recorded)\b",
+    re.IGNORECASE,
+)
+
+
+def _normalise(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+
+def pick_track(
+    items: List[Dict[str, Any]], song_name: str, artist_name: str
+) -> Dict[str, Any]:
+    """The search result most likely to be the original recording: not a
+    karaoke or cover version, by the charting artist, with the charting
+    title, and then the most popular. Ties keep Spotify's order."""
+    title = _normalise(song_name)
+    artist = _normalise(artist_name)
+
+    def score(item: Dict[str, Any]) -> Tuple[bool, bool, bool, int]:
+        artists = [_normalise(a.get("name", "")) for a in item.get("artists", [])]
+        names = " ".join(
+            [item.get("name", ""), item.get("album", {}).get("name", "")] + artists
+        )
+        return (
+            not NOT_ORIGINAL.search(names),
+            # Billboard credits features in the artist, e.g. "A Featuring B"
+            any(name and name in artist for name in artists),
+            _normalise(item.get("name", "")).startswith(title),
+            item.get("popularity", 0),
+        )
+
+    return max(items, key=score)
+
+
+async def search_track(
+    sp: AsyncSpotify, song_name: str, artist_name: str
+) -> Tuple[str, str, str]:
+    "Search Spotify for a song, returning (link, name, uri) or NOT_FOUND"
+    search_result = await sp.search(
+        q=f"{song_name} {artist_name}", type="track", limit=SEARCH_LIMIT
+    )
+    items = search_result["tracks"]["items"] if search_result else None
+    if not items:
+        return NOT_FOUND
+    song = pick_track(items, song_name, artist_name)
+    return song["external_urls"]["spotify"], song["name"], song["uri"]
+
+
+async def spotify_link(
+    sp: AsyncSpotify, song_name: str, artist_name: str
 ) -> Tuple[str, str, str]:
-    """Get the Spotify link for the song using the Spotify API"""
-    search_result = sp.search(q=f"{song_name} {artist_name}", type="track", limit=1)
-    if search_result:
-        song = search_result["tracks"]["items"][0]
-    else:
+    """Get the Spotify link for the song using the Spotify API.
+    Results, including searches that found nothing, are cached in TRACK_CACHE,
+    and concurrent searches for the same track share one request."""
+    key = _track_key(song_name, artist_name)
+    track = await TRACK_CACHE.aget(key)
+
+    if track is None:
+        searched = False
+
+        async def search():
+            nonlocal searched
+            searched = True
+            found = await search_track(sp, song_name, artist_name)
+            await TRACK_CACHE.aset(key, found)
+            return found
+
+        try:
+            track = await TRACK_FLIGHTS.do(key, search)
+        except SpotifyError as e:
+            # The shared search ran with another user's client, and failed on
+            # their token; ours may well be fine
+            if searched or e.http_status not in USER_AUTH_ERRORS:
+                raise
+            track = await search()
+
+    if track == NOT_FOUND:
         raise HTTPException(
             status_code=404,
             detail=f"Song {song_name} by {artist_name} not found on Spotify",
         )
 
-    link = song["external_urls"]["spotify"]
-    name = song["name"]
-    uri = song["uri"]
-
-    return link, name, uri
+    return track
 
 
-def start_playback(sp, uri, device_id=None) -> None:
+async def start_playback(sp, uri, device_id=None) -> None:
     """Start playing the song on Spotify"""
     try:
-        sp.start_playback(device_id=device_id, uris=[uri])
-    except (HTTPError, SpotifyException) as e:
-        ValueError(f"Spotify playback failed: {e}")
+        await sp.start_playback(device_id=device_id, uris=[uri])
+    except (HTTPError, SpotifyError) as e:
+        raise ValueError(f"Spotify playback failed: {e}") from e
@@ -0,0 +1,162 @@
+"""Play one song for a whole hyperparameter sweep.
+
+Inside a sweep, ts() doesn't call the API. Each trial appends its metric to
+a shared file for the sweep, which is safe from any number of processes on
+the machine. Once the trials are done, collect() reduces the metrics to one
+and makes a single ts() call for the sweep:
+
+    from trainingsong.sweep import sweep
+
+    with sweep("lr-search", reduce="max"):
+        study.optimize(objective, n_trials=500, n_jobs=8)  # objective calls ts()
+
+sweep() sets TRAININGSONG_SWEEP, which child processes inherit. Trials
+started some other way, e.g. by a job scheduler, can set it themselves and
+the sweep can be collected afterwards with
+
+    python -m trainingsong.sweep lr-search --reduce max
+"""
+
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from trainingsong.ts_utils import user_cache_dir
+
+SWEEP_ENV = "TRAININGSONG_SWEEP"
+SWEEP_DIR = Path(
+    os.environ.get("TRAININGSONG_SWEEP_DIR") or user_cache_dir() / "sweeps"
+)
+REDUCTIONS = ("max", "min", "last", "top-k")
+
+
+def active_sweep() -> Optional[str]:
+    "The sweep this process is reporting to, if any"
+    return os.environ.get(SWEEP_ENV) or None
+
+
+def _path(name: str) -> Path:
+    return SWEEP_DIR / (re.sub(r"[^\w.-]", "_", name) + ".jsonl")
+
+
+def report(metric: float, name: Optional[str] = None) -> None:
+    "Record a trial's metric for the sweep"
+    name = name or active_sweep()
+    if not name:
+        raise ValueError(f"No sweep given and {SWEEP_ENV} isn't set")
+    SWEEP_DIR.mkdir(parents=True, exist_ok=True)
+    line = json.dumps({"metric": metric, "time": time.time(), "pid": os.getpid()})
+    # A single short O_APPEND write is atomic, so concurrent trials don't
+    # interleave lines
+    fd = os.open(_path(name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (line + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+def metrics(name: str) -> List[float]:
+    "The metrics reported to the sweep so far, in the order they arrived"
+    try:
+        with open(_path(name)) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return []
+    values = []
+    for line in lines:
+        try:
+            values.append(float(json.loads(line)["metric"]))
+        except (ValueError, KeyError, TypeError):
+            # e.g. a trial killed mid-write
+            continue
+    return values
+
+
+def reduce_metrics(values: List[float], reduce: str = "max", k: int = 3) -> float:
+    """One metric for the sweep: the best (max or min), the last reported,
+    or the mean of the k best (top-k)."""
+    if not values:
+        raise ValueError("No metrics reported to the sweep")
+    if reduce == "max":
+        return max(values)
+    if reduce == "min":
+        return min(values)
+    if reduce == "last":
+        return values[-1]
+    if reduce == "top-k":
+        best = sorted(values, reverse=True)[:k]
+        return sum(best) / len(best)
+    raise ValueError(f"reduce must be one of {REDUCTIONS}, not {reduce!r}")
+
+
+def collect(
+    name: str,
+    reduce: str = "max",
+    k: int = 3,
+    **ts_kwargs: Any,
+) -> Tuple[float, Dict[str, Any]]:
+    """Reduce the sweep's metrics and make one ts() call for them, then clear
+    the sweep. Takes ts()'s keyword arguments and returns what it returns."""
+    from trainingsong.core import ts
+
+    metric = reduce_metrics(metrics(name), reduce, k)
+    # The collector itself calls the API, even inside the sweep
+    previous = os.environ.pop(SWEEP_ENV, None)
+    try:
+        result = ts(metric, **ts_kwargs)
+    finally:
+        if previous is not None:
+            os.environ[SWEEP_ENV] = previous
+    _path(name).unlink()
+    return result
+
+
+@contextmanager
+def sweep(
+    name: str, reduce: str = "max", k: int = 3, **ts_kwargs: Any
+) -> Iterator[str]:
+    """Report ts() calls made inside the block, including by child processes,
+    to the sweep, then play one song for it on exit"""
+    if reduce not in REDUCTIONS:
+        raise ValueError(f"reduce must be one of {REDUCTIONS}, not {reduce!r}")
+    # Start from a clean slate if an earlier sweep had the same name
+    _path(name).unlink(missing_ok=True)
+    previous = os.environ.get(SWEEP_ENV)
+    os.environ[SWEEP_ENV] = name
+    try:
+        yield name
+    finally:
+        if previous is None:
+            os.environ.pop(SWEEP_ENV, None)
+        else:
+            os.environ[SWEEP_ENV] = previous
+    if metrics(name):
+        collect(name, reduce, k, **ts_kwargs)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Play one song for a sweep")
+    parser.add_argument("name", help="the sweep's TRAININGSONG_SWEEP name")
+    parser.add_argument("--reduce", choices=REDUCTIONS, default="max")
+    parser.add_argument("-k", type=int, default=3, help="how many metrics top-k uses")
+    parser.add_argument("--chart", default="hot-100")
+    parser.add_argument("--no-autoplay", action="store_true")
+    args = parser.parse_args(argv)
+
+    collect(
+        args.name,
+        args.reduce,
+        args.k,
+        chart=args.chart,
+        autoplay=not args.no_autoplay,
+    )
+
+
+if __name__ == "__main__":
+    main()
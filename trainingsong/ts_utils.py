@@ -1,26 +1,55 @@
+import os
+import sys
+from pathlib import Path
 from urllib.parse import urlencode, urlunparse
 
 PROD_API = True
 
-OAUTH_CODE = None
 if PROD_API:
     URL = "https://training-song-api.vercel.app"
 else:
     URL = "https://training-song-api-koayon.vercel.app"
 
-LOCAL_REDIRECT_URI = "http://localhost:8000/local_callback"
+# WebSocket endpoint for live sessions (see trainingsong.live)
+LIVE_URL = URL.replace("https://", "wss://", 1) + "/live"
+
+LOCAL_REDIRECT_PORT = 8000
+LOCAL_REDIRECT_URI = f"http://localhost:{LOCAL_REDIRECT_PORT}/local_callback"
 
 CLIENT_ID = "4259770654fb4353813dbf19d8b20608"
 
 AUTH_BASE = "https://accounts.spotify.com/authorize"
 SCOPE = "user-modify-playback-state user-read-currently-playing user-read-recently-played user-read-playback-state"
-query = urlencode(
-    {
-        "client_id": CLIENT_ID,
-        "response_type": "code",
-        "redirect_uri": LOCAL_REDIRECT_URI,
-        "scope": SCOPE,
-    }
-)
-
-AUTH_URL = urlunparse(("https", "accounts.spotify.com", "/authorize", "", query, ""))
+
+
+def local_redirect_uri(port: int = LOCAL_REDIRECT_PORT) -> str:
+    "The registered redirect URI, or a loopback one for any other port"
+    if port == LOCAL_REDIRECT_PORT:
+        return LOCAL_REDIRECT_URI
+    # Spotify accepts any port on a loopback IP address (RFC 8252)
+    return f"http://127.0.0.1:{port}/local_callback"
+
+
+def auth_url(redirect_uri: str = LOCAL_REDIRECT_URI) -> str:
+    query = urlencode(
+        {
+            "client_id": CLIENT_ID,
+            "response_type": "code",
+            "redirect_uri": redirect_uri,
+            "scope": SCOPE,
+        }
+    )
+    return urlunparse(("https", "accounts.spotify.com", "/authorize", "", query, ""))
+
+
+AUTH_URL = auth_url()
+
+
+def user_cache_dir() -> Path:
+    "Where trainingsong keeps files on this machine, per platform convention"
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Caches" / "trainingsong"
+    if sys.platform == "win32" and os.environ.get("LOCALAPPDATA"):
+        return Path(os.environ["LOCALAPPDATA"]) / "trainingsong" / "Cache"
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "trainingsong"